@@ -0,0 +1,157 @@
+from collections import OrderedDict
+
+import numpy as np
+import orjson
+from opentelemetry import metrics
+
+# Summaries of the hourly temperature series of a cached forecast, computed with NumPy on the arrays
+# of the cache entry without converting them to Python lists:
+#
+#   daily        min, max and mean per day and the hours that had a value
+#   rolling      mean over the last `rolling_hours` hours, hourly from the first hour that has that many
+#                hours up to it
+#   percentiles  of the whole series
+#   anomalies    hours further than `anomaly_z` standard deviations from the mean of the same hour of
+#                the day, so the daily cycle doesn't count as an anomaly
+#   crossings    hours where the series goes above or below `threshold`
+#
+# Missing values (NaN in the cache entry, null from Open-Meteo) are left out of every statistic and
+# come out as null where a statistic has no values at all.
+
+# Creates a meter from the global meter provider
+meter = metrics.get_meter("my.meter.name")
+
+summaries_counter = meter.create_counter(
+    "aggregate.summaries", unit="1", description="Counts forecast summaries served, by whether they were memoized"
+)
+
+
+class SummaryOptions:
+    __slots__ = ('rolling_hours', 'percentiles', 'anomaly_z', 'threshold', 'key')
+
+    def __init__(self, rolling_hours=0, percentiles=(), anomaly_z=0.0, threshold=None):
+        self.rolling_hours = rolling_hours
+        self.percentiles = tuple(percentiles)
+        self.anomaly_z = anomaly_z
+        self.threshold = threshold
+        self.key = (rolling_hours, self.percentiles, anomaly_z, threshold)
+
+
+def summarize(forecast, options):
+    times = np.frombuffer(forecast.times, dtype=np.int64)
+    values = np.frombuffer(forecast.temperatures, dtype=np.float64)
+    summary = {'daily': daily(times, values)}
+    if options.rolling_hours:
+        summary['rolling'] = rolling_mean(times, values, options.rolling_hours)
+    if options.percentiles:
+        summary['percentiles'] = percentiles(values, options.percentiles)
+    if options.anomaly_z:
+        summary['anomalies'] = anomalies(times, values, options.anomaly_z)
+    if options.threshold is not None:
+        summary['crossings'] = crossings(times, values, options.threshold)
+    return summary
+
+
+def daily(times, values):
+    if not len(times):
+        return {'date': [], 'min': [], 'max': [], 'mean': [], 'hours': []}
+    # The series is sorted, so every day is one run of hours starting at `starts`
+    days = times // 86400
+    starts = np.flatnonzero(np.diff(days, prepend=days[0] - 1))
+    valid = ~np.isnan(values)
+    hours = np.add.reduceat(valid.astype(np.int64), starts)
+    sums = np.add.reduceat(np.where(valid, values, 0.0), starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / hours
+    return {
+        'date': np.datetime_as_string(days[starts].astype('datetime64[D]')).tolist(),
+        # fmin and fmax skip NaN unless a whole day is NaN
+        'min': np.fmin.reduceat(values, starts),
+        'max': np.fmax.reduceat(values, starts),
+        'mean': np.round(means, 2),
+        'hours': hours,
+    }
+
+
+def rolling_mean(times, values, window):
+    if len(values) < window:
+        return {'hours': window, 'start': None, 'mean': []}
+    valid = ~np.isnan(values)
+    # Window sums as differences of running sums, O(n) for any window length
+    sums = np.concatenate(([0.0], np.cumsum(np.where(valid, values, 0.0))))
+    counts = np.concatenate(([0], np.cumsum(valid)))
+    window_counts = counts[window:] - counts[:-window]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = (sums[window:] - sums[:-window]) / window_counts
+    # One value per hour, the times are implied by the first one
+    return {'hours': window, 'start': _format_times(times[window - 1:window])[0], 'mean': np.round(means, 2)}
+
+
+def percentiles(values, percents):
+    valid = values[~np.isnan(values)]
+    if not len(valid):
+        return {_percent_name(p): None for p in percents}
+    return {_percent_name(p): round(float(v), 2) for p, v in zip(percents, np.percentile(valid, percents))}
+
+
+def anomalies(times, values, z):
+    valid = ~np.isnan(values)
+    hour_of_day = (times % 86400) // 3600
+    # What is left after taking out the mean of every hour of the day, so the daily cycle doesn't count.
+    # A forecast has only a week of every hour, the spread is taken over the residuals of all hours.
+    counts = np.bincount(hour_of_day, weights=valid, minlength=24)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.bincount(hour_of_day, weights=np.where(valid, values, 0.0), minlength=24) / counts
+    residuals = values - means[hour_of_day]
+    spread = np.sqrt(np.mean(np.square(residuals[valid]))) if valid.any() else 0.0
+    if not spread > 1e-9:
+        return {'z': z, 'time': [], 'value': [], 'score': []}
+    scores = residuals / spread
+    flagged = np.flatnonzero(valid & (np.abs(scores) > z))
+    return {'z': z, 'time': _format_times(times[flagged]), 'value': values[flagged], 'score': np.round(scores[flagged], 2)}
+
+
+def crossings(times, values, threshold):
+    above = values > threshold
+    # Missing hours don't cross anything, compare each valid hour with the previous valid one
+    valid = np.flatnonzero(~np.isnan(values))
+    changed = valid[1:][above[valid[1:]] != above[valid[:-1]]]
+    return {
+        'threshold': threshold,
+        'time': _format_times(times[changed]),
+        'direction': np.where(above[changed], 'up', 'down').tolist(),
+    }
+
+
+def _format_times(times):
+    # Same format as the hourly times of Open-Meteo, e.g. 2024-01-01T13:00
+    return np.datetime_as_string(times.astype('datetime64[s]'), unit='m').tolist()
+
+
+def _percent_name(percent):
+    return 'p%g' % percent
+
+
+class SummaryCache:
+    # Serialized summaries by cache key, version of the cache entry (its fetched_at) and options.
+    # A refreshed forecast has a new fetched_at, so summaries of the old one are never served for it
+    # and age out of the LRU.
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def get(self, key, forecast, options):
+        memo_key = (key, forecast.fetched_at, options.key)
+        body = self._entries.get(memo_key)
+        if body is not None:
+            self._entries.move_to_end(memo_key)
+            summaries_counter.add(1, {"memoized": True})
+            return body
+        body = orjson.dumps(summarize(forecast, options), option=orjson.OPT_SERIALIZE_NUMPY)
+        summaries_counter.add(1, {"memoized": False})
+        if self.max_size > 0:
+            self._entries[memo_key] = body
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return body
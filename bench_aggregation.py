@@ -0,0 +1,56 @@
+import argparse
+import timeit
+
+import orjson
+
+import aggregation
+import cache_codec
+from bench_cache_codec import sample_forecast
+
+# Compares what POST /weather/aggregate costs per location with serving the whole forecast: the stored
+# JSON body of /weather, computing the summary from the cached arrays, and the memoized summary.
+#
+#   python bench_aggregation.py --hours 168
+
+
+def measure(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hours', type=int, default=168, help='length of the hourly series')
+    parser.add_argument('--number', type=int, default=2000, help='iterations per measurement')
+    parser.add_argument('--rolling-hours', type=int, default=24)
+    args = parser.parse_args()
+
+    forecast = cache_codec.decode(cache_codec.encode(sample_forecast(args.hours)))
+    options = aggregation.SummaryOptions(args.rolling_hours, (10, 50, 90), 3.0, 8.0)
+    summaries = aggregation.SummaryCache(1)
+    summaries.get('key', forecast, options)
+
+    def compute():
+        return orjson.dumps(aggregation.summarize(forecast, options), option=orjson.OPT_SERIALIZE_NUMPY)
+
+    def python_daily():
+        # What a client does with the raw forecast, for comparison
+        days = {}
+        for time, value in zip(forecast.times, forecast.temperatures):
+            days.setdefault(time // 86400, []).append(value)
+        return [(min(v), max(v), sum(v) / len(v)) for v in days.values()]
+
+    rows = [
+        ('raw forecast (stored body)', forecast.json_body),
+        ('summary, computed', compute),
+        ('summary, memoized', lambda: summaries.get('key', forecast, options)),
+        ('daily only, plain Python', lambda: orjson.dumps(python_daily())),
+    ]
+    print('%d hourly values, %d iterations, rolling mean over %d hours'
+          % (args.hours, args.number, args.rolling_hours))
+    print('%-30s %10s %16s' % ('body', 'bytes', 'cpu (us)'))
+    for name, render in rows:
+        print('%-30s %10d %16.1f' % (name, len(render()), measure(render, args.number)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import argparse
+import ast
+import json
+import math
+import timeit
+
+import cache_codec
+
+# Compares the size and encode/decode cost of cached forecasts:
+# the old str(data) repr, plain JSON and the binary cache format with and without compression,
+# without the response bodies, see bench_responses.py for those.
+#
+#   python bench_cache_codec.py --hours 168
+
+
+def sample_forecast(hours):
+    # Shaped like an Open-Meteo response for latitude=52.374&longitude=4.8897&hourly=temperature_2m
+    return {
+        'latitude': 52.38,
+        'longitude': 4.8999996,
+        'generationtime_ms': 0.0400543212890625,
+        'utc_offset_seconds': 0,
+        'timezone': 'GMT',
+        'timezone_abbreviation': 'GMT',
+        'elevation': 2.0,
+        'hourly_units': {'time': 'iso8601', 'temperature_2m': '°C'},
+        'hourly': {
+            'time': ['2024-01-%02dT%02d:00' % (1 + i // 24, i % 24) for i in range(hours)],
+            'temperature_2m': [round(6 + 4 * math.sin(i / 24 * 2 * math.pi) + (i % 7) / 10, 1) for i in range(hours)],
+        },
+    }
+
+
+def measure(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hours', type=int, default=168, help='length of the hourly series')
+    parser.add_argument('--number', type=int, default=2000, help='iterations per measurement')
+    args = parser.parse_args()
+
+    data = sample_forecast(args.hours)
+    raw = cache_codec.encode(data, encodings=())
+    compressed = cache_codec.encode(data, compress=True, encodings=())
+    repr_bytes = str(data).encode()
+    json_bytes = json.dumps(data).encode()
+
+    rows = [
+        ('repr (current)', len(repr_bytes),
+         lambda: str(data).encode(), lambda: ast.literal_eval(repr_bytes.decode())),
+        ('json', len(json_bytes),
+         lambda: json.dumps(data).encode(), lambda: json.loads(json_bytes)),
+        ('binary', len(raw),
+         lambda: cache_codec.encode(data, encodings=()), lambda: cache_codec.decode(raw)),
+        ('binary + zlib', len(compressed),
+         lambda: cache_codec.encode(data, compress=True, encodings=()), lambda: cache_codec.decode(compressed)),
+        ('binary to dict', len(raw),
+         lambda: cache_codec.encode(data, encodings=()), lambda: cache_codec.decode(raw).to_dict()),
+    ]
+
+    print('%d hourly values, %d iterations' % (args.hours, args.number))
+    print('%-16s %10s %14s %14s' % ('format', 'bytes', 'encode (us)', 'decode (us)'))
+    for name, size, encode, decode in rows:
+        print('%-16s %10d %14.1f %14.1f' % (name, size, measure(encode, args.number), measure(decode, args.number)))
+
+
+if __name__ == '__main__':
+    main()
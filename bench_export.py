@@ -0,0 +1,120 @@
+import argparse
+import asyncio
+import os
+
+import httpx
+
+import loadgen
+from bench_workers import start, stop, wait_for_port
+
+# Shows that request latency doesn't depend on the state of the telemetry collector. Starts
+# fake_open_meteo.py, then for every scenario the service with an in-process fake Redis and second
+# service, sends open loop load at a fixed rate and reads the export queues of the service afterwards
+# from GET /admin/telemetry/export.
+#
+#   off        nothing is exported, the baseline
+#   healthy    fake_otlp_collector.py answers right away
+#   slow       every export call takes --slow-ms
+#   rejecting  every export call is answered with UNAVAILABLE and retried by the exporter
+#   down       nothing listens on the collector's port
+#
+#   python bench_export.py --rps 200 --duration 20
+#
+# Queue size, batch size and drop policy are taken from the WEATHER_EXPORT_* variables of the environment.
+# GET /weather answers half of the requests with a random 500 by design, they are in the errors column
+# of every scenario.
+
+APP_PORT = 8000
+OPEN_METEO_PORT = 8002
+COLLECTOR_PORT = 4327
+
+SCENARIOS = ('off', 'healthy', 'slow', 'rejecting', 'down')
+
+
+def collector_env(scenario, args):
+    if scenario == 'slow':
+        return {'FAKE_OTLP_LATENCY': 'fixed:%g' % args.slow_ms}
+    if scenario == 'rejecting':
+        return {'FAKE_OTLP_ERROR_RATE': '1'}
+    return {}
+
+
+def measure(args, scenario):
+    argv = [
+        '--url', 'http://127.0.0.1:%d' % APP_PORT, '--mode', 'open', '--label', scenario,
+        '--rps', str(args.rps), '--duration', str(args.duration), '--warmup', str(args.warmup),
+        '--distribution', args.distribution, '--keys', str(args.keys),
+    ]
+    report = asyncio.run(loadgen.run(loadgen.build_parser().parse_args(argv)))
+    export = httpx.get('http://127.0.0.1:%d/admin/telemetry/export' % APP_PORT).json()
+    return report, {queue['signal']: queue for queue in export['queues']}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated, of %s' % ', '.join(SCENARIOS))
+    parser.add_argument('--rps', type=float, default=200, help='request rate')
+    parser.add_argument('--duration', type=float, default=20, help='seconds to measure per scenario')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds of load before measuring')
+    parser.add_argument('--slow-ms', type=float, default=2000, help='duration of an export call of the slow collector')
+    parser.add_argument('--distribution', choices=['hot', 'zipf', 'uniform'], default='zipf')
+    parser.add_argument('--keys', type=int, default=1000, help='number of distinct locations')
+    args = parser.parse_args()
+
+    env = dict(
+        os.environ,
+        WEATHER_REDIS_URL='fakeredis://',
+        WEATHER_REDIS_URLS='fakeredis://',
+        WEATHER_OPEN_METEO_URL='http://127.0.0.1:%d/v1/forecast' % OPEN_METEO_PORT,
+        WEATHER_SECOND_SERVICE_IN_PROCESS='true',
+        WEATHER_DISK_CACHE_DIR='',
+        WEATHER_PREWARM_SNAPSHOT_PATH='',
+        WEATHER_METRICS_EXPORT_INTERVAL_MS='1000',
+        OTEL_EXPORTER_OTLP_ENDPOINT='http://127.0.0.1:%d' % COLLECTOR_PORT,
+        OTEL_EXPORTER_OTLP_INSECURE='true',
+    )
+    open_meteo = start(['uvicorn', 'fake_open_meteo:app', '--port', str(OPEN_METEO_PORT), '--log-level', 'warning'], env)
+    rows = []
+    try:
+        wait_for_port(OPEN_METEO_PORT)
+        for scenario in args.scenarios.split(','):
+            exporter = 'none' if scenario == 'off' else 'otlp'
+            app_env = dict(env, WEATHER_TRACES_EXPORTER=exporter, WEATHER_LOGS_EXPORTER=exporter,
+                           WEATHER_METRICS_EXPORTER=exporter)
+            collector = None
+            if scenario not in ('off', 'down'):
+                collector = start(['python', 'fake_otlp_collector.py', '--port', str(COLLECTOR_PORT),
+                                   '--report-interval', '0'], dict(env, **collector_env(scenario, args)))
+                wait_for_port(COLLECTOR_PORT)
+            app = start(['uvicorn', 'main:app', '--port', str(APP_PORT), '--log-level', 'warning'], app_env)
+            try:
+                wait_for_port(APP_PORT)
+                report, queues = measure(args, scenario)
+            finally:
+                # The service may wait up to the export timeout for the collector while shutting down
+                stop(app)
+                if collector is not None:
+                    stop(collector)
+            loadgen.print_report(report)
+            spans = queues.get('traces', {})
+            logs = queues.get('logs', {})
+            rows.append((
+                scenario, report['throughput_rps'], report['latency']['p50_ms'], report['latency']['p99_ms'],
+                sum(e['count'] for e in report['by_error'].values()),
+                spans.get('exported', 0), spans.get('dropped', 0), logs.get('exported', 0), logs.get('dropped', 0),
+            ))
+    finally:
+        stop(open_meteo)
+
+    print('\n%.0f req/s offered, export queues of %s items, %s' % (
+        args.rps, os.environ.get('WEATHER_EXPORT_QUEUE_SIZE', '2048'),
+        os.environ.get('WEATHER_EXPORT_DROP_POLICY', 'drop_newest')))
+    print('%10s %9s %10s %10s %7s %15s %13s %14s %12s' % (
+        'collector', 'req/s', 'p50 (ms)', 'p99 (ms)', 'errors',
+        'spans exported', 'spans dropped', 'logs exported', 'logs dropped'))
+    for row in rows:
+        print('%10s %9.1f %10.2f %10.2f %7d %15d %13d %14d %12d' % row)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import argparse
+import asyncio
+import time
+
+from opentelemetry import trace
+from opentelemetry.sdk.metrics.export import InMemoryMetricReader
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter, SpanExportResult
+
+import telemetry
+
+# Stage histograms are recorded as in the service but never exported, this has to happen before
+# stage_timing creates them
+telemetry.setup_metrics(readers=[InMemoryMetricReader()])
+
+import stage_timing
+from orchestration import run_concurrently
+
+# Measures what tracing adds to a request served from the cache: the stages of GET /weather on a hit,
+# with no tracing at all, with a span per stage as the decorators in part2-part5 do, and with
+# stage_timing's light mode. Stages don't do any work, so everything measured is overhead.
+#
+#   python bench_instrumentation.py --requests 20000
+#
+# Spans go through a BatchSpanProcessor into an exporter that drops them and metrics are kept in memory,
+# so exporting isn't measured.
+
+STAGES = ['maybe_raise_random_error', 'request_second_service_http_request', 'get_data_from_redis']
+
+
+class DiscardingExporter(SpanExporter):
+
+    def export(self, spans):
+        return SpanExportResult.SUCCESS
+
+
+tracer = trace.get_tracer("open-telemetry.example.bench")
+
+
+async def span_stage(name):
+    # What @tracer.start_as_current_span does around a helper
+    with tracer.start_as_current_span(name):
+        return None
+
+
+async def timed_stage(name):
+    with stage_timing.stage(name):
+        return None
+
+
+async def untraced_request():
+    stage_timing.mode = 'off'
+    await run_concurrently({name: timed_stage(name) for name in STAGES})
+
+
+async def spans_request():
+    # The root span stands in for the one FastAPIInstrumentor creates, it exists in every mode but "none"
+    with tracer.start_as_current_span("GET /weather"):
+        stage_timing.mode = 'spans'
+        await run_concurrently({name: span_stage(name) for name in STAGES})
+
+
+@stage_timing.instrumented_route('bench', STAGES)
+async def light_endpoint():
+    await run_concurrently({name: timed_stage(name) for name in STAGES})
+
+
+async def light_request():
+    with tracer.start_as_current_span("GET /weather"):
+        stage_timing.mode = 'light'
+        await light_endpoint()
+
+
+async def measure(request, number):
+    for _ in range(min(number, 1000)):
+        await request()
+    start = time.perf_counter()
+    for _ in range(number):
+        await request()
+    return (time.perf_counter() - start) / number * 1e6
+
+
+async def run(args):
+    provider = TracerProvider()
+    processor = BatchSpanProcessor(DiscardingExporter(), max_queue_size=100000)
+    provider.add_span_processor(processor)
+    trace.set_tracer_provider(provider)
+
+    rows = [('none', untraced_request), ('spans', spans_request), ('light', light_request)]
+    results = {}
+    for _ in range(args.repeat):
+        for name, request in rows:
+            took = await measure(request, args.requests)
+            results[name] = min(results.get(name, took), took)
+            # Don't let a full export queue slow down the next mode
+            processor.force_flush()
+
+    print('%d stages per request, %d requests, best of %d' % (len(STAGES), args.requests, args.repeat))
+    print('%-8s %16s %16s' % ('mode', 'request (us)', 'overhead (us)'))
+    for name, _ in rows:
+        print('%-8s %16.1f %16.1f' % (name, results[name], results[name] - results['none']))
+    provider.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=20000, help='requests per measurement')
+    parser.add_argument('--repeat', type=int, default=3, help='measurements per mode, the fastest one counts')
+    parser.add_argument('--promote-ratio', type=float, default=0.01,
+                        help='share of light mode requests whose stages become spans')
+    args = parser.parse_args()
+    stage_timing.config.INSTRUMENTATION_PROMOTE_RATIO = args.promote_ratio
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import argparse
+import gzip
+import json
+import timeit
+
+import orjson
+from fastapi.responses import JSONResponse
+from starlette.responses import Response
+
+import cache_codec
+from bench_cache_codec import sample_forecast
+
+# Compares the bytes and CPU per /weather response body: the dict FastAPI serializes with the standard
+# JSON encoder, orjson, compressing on every request, and the bodies stored with the cached forecast.
+#
+#   python bench_responses.py --hours 168
+
+
+def measure(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hours', type=int, default=168, help='length of the hourly series')
+    parser.add_argument('--number', type=int, default=2000, help='iterations per measurement')
+    args = parser.parse_args()
+
+    data = sample_forecast(args.hours)
+    forecast = cache_codec.decode(cache_codec.encode(data))
+    rows = [
+        ('JSONResponse(dict)', lambda: JSONResponse(content=data).body),
+        ('JSONResponse(to_dict)', lambda: JSONResponse(content=forecast.to_dict()).body),
+        ('orjson(dict)', lambda: Response(content=orjson.dumps(data)).body),
+        ('gzip per request', lambda: Response(content=gzip.compress(orjson.dumps(data), 6)).body),
+        ('stored identity', lambda: Response(content=forecast.json_body()).body),
+        ('stored gzip', lambda: Response(content=bytes(forecast.bodies['gzip'])).body),
+    ]
+    if 'br' in forecast.bodies:
+        rows.append(('stored br', lambda: Response(content=bytes(forecast.bodies['br'])).body))
+    else:
+        print('brotli is not installed, skipping br')
+
+    print('%d hourly values, %d iterations, response body only' % (args.hours, args.number))
+    print('%-24s %10s %16s' % ('body', 'bytes', 'cpu (us)'))
+    for name, render in rows:
+        print('%-24s %10d %16.1f' % (name, len(render()), measure(render, args.number)))
+
+    # What storing a forecast costs extra for having the bodies ready
+    store_without = measure(lambda: cache_codec.encode(data, encodings=()), args.number // 10)
+    store_with = measure(lambda: cache_codec.encode(data), args.number // 10)
+    print('\nencoding a cache entry: %.1f us without bodies, %.1f us with %s'
+          % (store_without, store_with, ', '.join(forecast.bodies)))
+    assert json.loads(forecast.json_body()) == data
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+import loadgen
+
+# Measures how the throughput of GET /weather scales with the number of gunicorn workers, see
+# gunicorn.conf.py. Starts redis-server, fake_open_meteo.py and second_service.py on this machine, then
+# for every worker count starts the service, sends closed loop load from several loadgen.py processes
+# and stops it again.
+#
+#   python bench_workers.py --workers 1,2,4 --duration 20
+#
+# Load generator, upstreams and workers share the cores of this machine, so the speedup flattens once
+# they compete for them. Leave a core or two for the load generator, or point --url at a service started
+# on another machine with start_workers.sh.
+
+APP_PORT = 8000
+SECOND_SERVICE_PORT = 8001
+OPEN_METEO_PORT = 8002
+REDIS_PORT = 6380
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('Nothing is listening on port %d after %ds' % (port, timeout))
+
+
+def start(command, env):
+    return subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL)
+
+
+def stop(process):
+    process.terminate()
+    try:
+        process.wait(timeout=35)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def run_client(argv):
+    # Runs in a process of its own, one Python process can't send enough requests to keep several workers busy
+    return asyncio.run(loadgen.run(loadgen.build_parser().parse_args(argv)))
+
+
+def measure(args, workers):
+    argv = [
+        '--url', 'http://127.0.0.1:%d' % APP_PORT, '--mode', 'closed', '--label', '%d workers' % workers,
+        '--concurrency', str(args.concurrency), '--duration', str(args.duration), '--warmup', str(args.warmup),
+        '--distribution', args.distribution, '--keys', str(args.keys),
+    ]
+    with multiprocessing.Pool(args.clients) as pool:
+        return pool.map(run_client, [argv + ['--seed', str(seed)] for seed in range(args.clients)])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', default='1,2,4', help='comma separated worker counts to measure')
+    parser.add_argument('--clients', type=int, default=2, help='load generator processes')
+    parser.add_argument('--concurrency', type=int, default=32, help='clients per load generator process')
+    parser.add_argument('--duration', type=float, default=20, help='seconds to measure per worker count')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds of load before measuring')
+    parser.add_argument('--distribution', choices=['hot', 'zipf', 'uniform'], default='zipf')
+    parser.add_argument('--keys', type=int, default=1000, help='number of distinct locations')
+    args = parser.parse_args()
+    worker_counts = [int(n) for n in args.workers.split(',')]
+
+    if not shutil.which('redis-server'):
+        # Workers are separate processes, the in-process fake Redis of start_offline.sh isn't shared between them
+        sys.exit('redis-server is needed to share the cache between workers')
+
+    env = dict(
+        os.environ,
+        WEATHER_REDIS_URL='redis://127.0.0.1:%d/0' % REDIS_PORT,
+        WEATHER_OPEN_METEO_URL='http://127.0.0.1:%d/v1/forecast' % OPEN_METEO_PORT,
+        WEATHER_SECOND_SERVICE_URL='http://127.0.0.1:%d/test' % SECOND_SERVICE_PORT,
+        # No collector runs here, exporting is left out of the measurement
+        WEATHER_METRICS_EXPORTER='none',
+        WEATHER_TRACES_EXPORTER='none',
+        WEATHER_LOGS_EXPORTER='none',
+    )
+    upstream_workers = str(max(worker_counts))
+    upstreams = [
+        start(['redis-server', '--port', str(REDIS_PORT), '--save', '', '--appendonly', 'no'], env),
+        start(['uvicorn', 'fake_open_meteo:app', '--port', str(OPEN_METEO_PORT), '--log-level', 'warning'], env),
+        # The second service is called on every request, it gets as many workers as the service at most
+        # has so it doesn't become the bottleneck
+        start(['gunicorn', '-k', 'uvicorn.workers.UvicornWorker', '-w', upstream_workers,
+               '-b', '127.0.0.1:%d' % SECOND_SERVICE_PORT, '--log-level', 'warning', 'second_service:app'], env),
+    ]
+    rows = []
+    try:
+        for port in (REDIS_PORT, OPEN_METEO_PORT, SECOND_SERVICE_PORT):
+            wait_for_port(port)
+        for workers in worker_counts:
+            subprocess.run(['redis-cli', '-p', str(REDIS_PORT), 'flushall'], check=True, stdout=subprocess.DEVNULL)
+            app = start(['gunicorn', '-c', 'gunicorn.conf.py', '-b', '127.0.0.1:%d' % APP_PORT,
+                         '-w', str(workers), '--log-level', 'warning', 'main:app'],
+                        dict(env, WEATHER_WORKERS=str(workers)))
+            try:
+                wait_for_port(APP_PORT)
+                reports = measure(args, workers)
+            finally:
+                stop(app)
+            for report in reports:
+                loadgen.print_report(report)
+            rows.append((
+                workers,
+                sum(report['throughput_rps'] for report in reports),
+                # Percentiles of separate load generators can't be merged, the worst one is reported
+                max(report['latency']['p50_ms'] for report in reports),
+                max(report['latency']['p99_ms'] for report in reports),
+                sum(sum(e['count'] for e in report['by_error'].values()) for report in reports),
+            ))
+    finally:
+        for process in upstreams:
+            stop(process)
+
+    print('\n%d cores, %d load generator processes with %d clients each'
+          % (os.cpu_count(), args.clients, args.concurrency))
+    print('%8s %12s %9s %10s %10s %8s' % ('workers', 'req/s', 'speedup', 'p50 (ms)', 'p99 (ms)', 'errors'))
+    for workers, throughput, p50, p99, errors in rows:
+        print('%8d %12.1f %8.2fx %10.2f %10.2f %8d' % (workers, throughput, throughput / rows[0][1], p50, p99, errors))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+import bisect
+import time
+from array import array
+from collections import OrderedDict
+
+from opentelemetry.metrics import Observation
+
+import config
+
+# Ages in seconds used to bucket how old a cached forecast is when it is asked for, finer around
+# the soft TTLs that make sense for forecasts
+AGE_BUCKETS_SECONDS = [0.1, 0.25, 0.5, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 45, 60, 120, 300, 600, 1800, 3600]
+
+
+class CountMinSketch:
+    # Estimates how often each key was seen in constant memory. Estimates are never too low,
+    # collisions can only make them too high.
+
+    def __init__(self, width, depth):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('L', bytes(array('L').itemsize * width)) for _ in range(depth)]
+
+    def add(self, key):
+        # Conservative update: only the counters that hold the current estimate are raised
+        cells = [(row, hash((i, key)) % self.width) for i, row in enumerate(self.rows)]
+        estimate = min(row[j] for row, j in cells) + 1
+        for row, j in cells:
+            if row[j] < estimate:
+                row[j] = estimate
+        return estimate
+
+    def estimate(self, key):
+        return min(row[hash((i, key)) % self.width] for i, row in enumerate(self.rows))
+
+    def halve(self):
+        for row in self.rows:
+            for j in range(self.width):
+                row[j] >>= 1
+
+
+class TopK:
+    # The k keys with the highest estimated count, fed with the estimates of a CountMinSketch
+
+    def __init__(self, k):
+        self.k = k
+        self.counts = {}
+        self._min_key = None
+
+    def offer(self, key, count):
+        if key in self.counts:
+            self.counts[key] = count
+            if key == self._min_key:
+                self._min_key = None
+            return
+        if len(self.counts) < self.k:
+            self.counts[key] = count
+            self._min_key = None
+            return
+        if self._min_key is None:
+            self._min_key = min(self.counts, key=self.counts.get)
+        if count > self.counts[self._min_key]:
+            del self.counts[self._min_key]
+            self.counts[key] = count
+            self._min_key = None
+
+    def __contains__(self, key):
+        return key in self.counts
+
+    def halve(self):
+        self.counts = {key: count >> 1 for key, count in self.counts.items()}
+
+    def top(self):
+        return sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+
+
+class AgeHistogram:
+    # Counts per AGE_BUCKETS_SECONDS bucket, the last bucket holds everything older
+
+    def __init__(self):
+        self.counts = array('q', bytes(8 * (len(AGE_BUCKETS_SECONDS) + 1)))
+        self.count = 0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(AGE_BUCKETS_SECONDS, seconds)] += 1
+        self.count += 1
+
+    def share_within(self, seconds):
+        # Share of the recorded ages up to `seconds`, assuming ages are spread evenly inside a bucket
+        if not self.count:
+            return 0.0
+        within = 0.0
+        lower = 0
+        for upper, count in zip(AGE_BUCKETS_SECONDS, self.counts):
+            if seconds >= upper:
+                within += count
+            elif seconds > lower:
+                within += count * (seconds - lower) / (upper - lower)
+            lower = upper
+        return within / self.count
+
+    def percentile(self, share):
+        # Interpolated age below which `share` of the recorded ages fall, None if it's in the open last bucket
+        if not self.count:
+            return None
+        target = share * self.count
+        seen = 0
+        lower = 0
+        for upper, count in zip(AGE_BUCKETS_SECONDS, self.counts):
+            if count and seen + count >= target:
+                return lower + (upper - lower) * (target - seen) / count
+            seen += count
+            lower = upper
+        return None
+
+    def summary(self):
+        return {
+            'count': self.count,
+            **{'p%d_seconds' % p: _round(self.percentile(p / 100)) for p in (50, 90, 99)},
+        }
+
+    def halve(self):
+        for i in range(len(self.counts)):
+            self.counts[i] >>= 1
+        self.count = sum(self.counts)
+
+
+class CacheAnalytics:
+    # Which coordinates dominate traffic and whether the cache TTL fits the way they are asked for.
+    #
+    # Every /weather request is classified by the popularity of its key:
+    #
+    #   hot   one of the top WEATHER_ANALYTICS_TOP_K keys
+    #   warm  asked for before in the current window
+    #   cold  asked for the first time in the current window, even while the top keys aren't all known yet
+    #
+    # and counted as hit, stale or miss per class. For every request whose key was fetched before we
+    # know the age of its forecast, from those ages a soft TTL is recommended that would have served
+    # WEATHER_ANALYTICS_TARGET_HIT_RATIO of them from the cache. Counts are halved every
+    # WEATHER_ANALYTICS_DECAY_SECONDS, so everything reflects recent traffic.
+
+    def __init__(self, meter):
+        self.sketch = CountMinSketch(config.ANALYTICS_SKETCH_WIDTH, config.ANALYTICS_SKETCH_DEPTH)
+        self.top_keys = TopK(config.ANALYTICS_TOP_K)
+        # key class -> cache status -> requests
+        self.requests = {key_class: {'hit': 0, 'stale': 0, 'miss': 0} for key_class in ('hot', 'warm', 'cold')}
+        # Age of the forecast at every request, and for requests past the soft TTL how far past it they were
+        self.ages = AgeHistogram()
+        self.reuse_after_expiry = AgeHistogram()
+        # key -> fetched_at of the last forecast served for it, to know the age on a miss
+        self._fetched = OrderedDict()
+        self._window_start = time.monotonic()
+
+        self._requests_counter = meter.create_counter(
+            "cache.requests", unit="1", description="Counts /weather cache lookups by key class and cache status"
+        )
+        self._reuse_histogram = meter.create_histogram(
+            "cache.reuse_after_expiry", unit="s",
+            description="How long after a cached forecast went stale it was asked for again",
+        )
+        meter.create_observable_gauge(
+            "cache.recommended_ttl", callbacks=[self._observe_recommended_ttl], unit="s",
+            description="Soft TTL that would serve the target share of requests from the cache",
+        )
+
+    def record(self, key, status, fetched_at):
+        # `status` is hit, stale or miss, `fetched_at` belongs to the forecast that was served
+        now_monotonic = time.monotonic()
+        if now_monotonic - self._window_start > config.ANALYTICS_DECAY_SECONDS:
+            self._decay(now_monotonic)
+
+        count = self.sketch.add(key)
+        self.top_keys.offer(key, count)
+        key_class = 'cold' if count == 1 else 'hot' if key in self.top_keys else 'warm'
+        self.requests[key_class][status] += 1
+        self._requests_counter.add(1, {"key_class": key_class, "cache.status": status})
+
+        now = time.time()
+        previous = fetched_at if status != 'miss' else self._fetched.get(key)
+        if previous is not None:
+            age = now - previous
+            self.ages.record(age)
+            past_ttl = age - config.CACHE_SOFT_TTL_SECONDS
+            if status != 'hit' and past_ttl > 0:
+                self.reuse_after_expiry.record(past_ttl)
+                self._reuse_histogram.record(past_ttl, {"key_class": key_class})
+
+        self._fetched[key] = fetched_at
+        self._fetched.move_to_end(key)
+        if len(self._fetched) > config.ANALYTICS_TRACKED_KEYS:
+            self._fetched.popitem(last=False)
+
+    def recommended_ttl(self):
+        # The shortest soft TTL under which the target share of requests would have found a fresh
+        # forecast, never above the hard TTL since entries are gone from Redis by then
+        ttl = self.ages.percentile(config.ANALYTICS_TARGET_HIT_RATIO)
+        if ttl is None:
+            return None if not self.ages.count else config.CACHE_HARD_TTL_SECONDS
+        return min(ttl, config.CACHE_HARD_TTL_SECONDS)
+
+    def report(self):
+        by_class = {}
+        for key_class, statuses in self.requests.items():
+            total = sum(statuses.values())
+            by_class[key_class] = {
+                **statuses,
+                'requests': total,
+                'hit_ratio': round(statuses['hit'] / total, 4) if total else None,
+            }
+        return {
+            'window_seconds': round(time.monotonic() - self._window_start, 1),
+            'top_keys': [{'key': key, 'estimated_requests': count} for key, count in self.top_keys.top()],
+            'by_key_class': by_class,
+            'forecast_age': self.ages.summary(),
+            'reuse_after_expiry': self.reuse_after_expiry.summary(),
+            'soft_ttl_seconds': config.CACHE_SOFT_TTL_SECONDS,
+            'hit_ratio_at_soft_ttl': round(self.ages.share_within(config.CACHE_SOFT_TTL_SECONDS), 4),
+            'target_hit_ratio': config.ANALYTICS_TARGET_HIT_RATIO,
+            'recommended_soft_ttl_seconds': _round(self.recommended_ttl()),
+        }
+
+    def _decay(self, now_monotonic):
+        self.sketch.halve()
+        self.top_keys.halve()
+        self.ages.halve()
+        self.reuse_after_expiry.halve()
+        for statuses in self.requests.values():
+            for status in statuses:
+                statuses[status] >>= 1
+        self._window_start = now_monotonic
+
+    def _observe_recommended_ttl(self, options):
+        ttl = self.recommended_ttl()
+        if ttl is not None:
+            yield Observation(ttl)
+
+
+def _round(value):
+    return round(value, 3) if value is not None else None
@@ -0,0 +1,157 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+
+import redis.asyncio as redis
+from opentelemetry import metrics
+from redis.exceptions import ConnectionError, TimeoutError
+
+# Creates a meter from the global meter provider
+meter = metrics.get_meter("my.meter.name")
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+node_failures_counter = meter.create_counter(
+    "cache.node.failures", unit="1", description="Counts Redis calls that failed because a cache node was unreachable"
+)
+
+# Errors that mean a node is unreachable, as opposed to errors in a command
+NODE_ERRORS = (ConnectionError, TimeoutError)
+
+# In-process fake Redis servers by name, so fakeredis://a and fakeredis://b are separate nodes
+_fake_servers = {}
+
+
+def connect(url, max_connections=100):
+    if url.startswith('fakeredis://'):
+        # In-process fake for offline benchmarks, only shared inside this process
+        import fakeredis
+        server = _fake_servers.setdefault(url, fakeredis.FakeServer())
+        return fakeredis.aioredis.FakeRedis(server=server)
+    return redis.from_url(url, max_connections=max_connections)
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+class CacheNode:
+    # One Redis server with its own connection pool. A node that fails a call is skipped for
+    # `retry_seconds`, after that the next call tries it again.
+
+    def __init__(self, url, retry_seconds):
+        parts = urlsplit(url)
+        # Without the credentials, used in logs and metrics
+        self.name = (parts.hostname or parts.netloc or url) + (':%d' % parts.port if parts.port else '') + parts.path
+        self.url = url
+        self.retry_seconds = retry_seconds
+        self.client = connect(url)
+        self._down_until = 0.0
+
+    def available(self):
+        return self._down_until <= time.monotonic()
+
+    @asynccontextmanager
+    async def track(self):
+        # Wraps calls of the node's client, an unreachable node is marked down and the error re-raised
+        try:
+            yield self.client
+        except NODE_ERRORS as e:
+            node_failures_counter.add(1, {"cache.node": self.name})
+            if self.available():
+                logger.error('Cache node %s is unreachable, skipping it for %ss: %s', self.name, self.retry_seconds, e)
+            self._down_until = time.monotonic() + self.retry_seconds
+            raise
+
+
+class CacheBackend:
+    # Spreads cache keys over several Redis nodes with consistent hashing. Every node is placed on a
+    # hash ring `vnodes` times, a key belongs to the first point after its hash. Adding or removing a
+    # node only moves the keys of its points, and with many points per node keys spread evenly.
+    #
+    # Keys of an unavailable node go to the next available node on the ring until it is back. The
+    # cache is only a cache, those keys miss once and are fetched again.
+    #
+    # Everything that belongs to a key (its fallback copy, its fetch lock, its geo index entry) is
+    # stored on the key's node, so one pipeline per node writes it.
+
+    def __init__(self, urls, vnodes=160, retry_seconds=5):
+        self.nodes = [CacheNode(url, retry_seconds) for url in urls]
+        points = sorted((_hash('%s#%d' % (node.url, i)), index)
+                        for index, node in enumerate(self.nodes) for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [index for _, index in points]
+        meter.create_observable_gauge(
+            "cache.node.available", callbacks=[self._observe_available], unit="1",
+            description="Whether a cache node receives calls, 0 while it is skipped after a failure",
+        )
+
+    def owner(self, key):
+        # The node a key belongs to on the ring, whether it is available or not
+        return self.nodes[self._owners[bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)]]
+
+    def node_for(self, key):
+        start = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        owner = self.nodes[self._owners[start]]
+        if owner.available():
+            return owner
+        for step in range(1, len(self._hashes)):
+            node = self.nodes[self._owners[(start + step) % len(self._hashes)]]
+            if node.available():
+                return node
+        # Every node is down, try the owner anyway rather than failing without a call
+        return owner
+
+    def group(self, keys):
+        # node -> indexes of the keys that belong to it
+        groups = {}
+        for index, key in enumerate(keys):
+            groups.setdefault(self.node_for(key), []).append(index)
+        return groups
+
+    async def get(self, key):
+        async with self.node_for(key).track() as client:
+            return await client.get(key)
+
+    async def mget(self, keys):
+        # One MGET per node, run concurrently. Returns the values in the order of `keys` and the indexes
+        # of the keys whose node couldn't be reached, those are marked down and their values are None
+        values = [None] * len(keys)
+        unreachable = set()
+
+        async def mget_node(node, indexes):
+            try:
+                async with node.track() as client:
+                    for index, value in zip(indexes, await client.mget([keys[i] for i in indexes])):
+                        values[index] = value
+            except NODE_ERRORS:
+                unreachable.update(indexes)
+
+        await asyncio.gather(*(mget_node(node, indexes) for node, indexes in self.group(keys).items()))
+        return values, unreachable
+
+    def available_nodes(self):
+        return [node for node in self.nodes if node.available()] or self.nodes
+
+    async def ping(self):
+        # Returns the names of the nodes that didn't answer
+        async def ping_node(node):
+            try:
+                async with node.track() as client:
+                    await client.ping()
+            except NODE_ERRORS:
+                return node.name
+
+        return [name for name in await asyncio.gather(*map(ping_node, self.nodes)) if name is not None]
+
+    async def aclose(self):
+        await asyncio.gather(*(node.client.aclose() for node in self.nodes))
+
+    def _observe_available(self, options):
+        for node in self.nodes:
+            yield metrics.Observation(int(node.available()), {"cache.node": node.name})
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+
+from opentelemetry import metrics
+
+# Creates a meter from the global meter provider
+meter = metrics.get_meter("my.meter.name")
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+transitions_counter = meter.create_counter(
+    "circuit_breaker.transitions", unit="1", description="Counts state changes of circuit breakers, by new state"
+)
+rejected_counter = meter.create_counter(
+    "circuit_breaker.rejected", unit="1", description="Counts calls not made because the circuit was open"
+)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Reported by the circuit_breaker.state gauge
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+
+    def __init__(self, name):
+        super().__init__('Circuit %s is open' % name)
+        self.name = name
+
+
+class CircuitBreaker:
+    # Stops calling an upstream that keeps failing or is too slow.
+    #
+    #   closed     calls go through, outcomes are counted in one second buckets over `window_seconds`.
+    #              With at least `min_calls` in the window and more than `error_ratio` failed or more
+    #              than `slow_ratio` slower than `slow_ms`, the circuit opens
+    #   open       calls fail right away with CircuitOpenError for `open_seconds`
+    #   half_open  up to `probes` calls go through, the first success closes the circuit, a failure opens it again
+    #
+    # A call the caller gave up on, cancelled or ending in one of the `abandoned` exceptions like a request's
+    # deadline, isn't a failure of the upstream. It only counts as slow if it took longer than `slow_ms`.
+
+    def __init__(self, name, window_seconds=10, min_calls=10, error_ratio=0.5, slow_ms=2000, slow_ratio=0.5,
+                 open_seconds=5, probes=1, abandoned=()):
+        self.name = name
+        self.window_seconds = int(window_seconds)
+        self.min_calls = min_calls
+        self.error_ratio = error_ratio
+        self.slow_ms = slow_ms
+        self.slow_ratio = slow_ratio
+        self.open_seconds = open_seconds
+        self.probes = probes
+        self.abandoned = (asyncio.CancelledError,) + tuple(abandoned)
+
+        self.state = CLOSED
+        self._opened_at = 0.0
+        self._probes_running = 0
+        # Per second of the window: [second, calls, failures, slow calls]
+        self._buckets = [[0, 0, 0, 0] for _ in range(self.window_seconds)]
+        meter.create_observable_gauge(
+            "circuit_breaker.state", callbacks=[self._observe_state], unit="1",
+            description="State of a circuit breaker: 0 closed, 1 half open, 2 open",
+        )
+
+    def allows_calls(self):
+        # Whether a call would be let through right now, without taking a half open probe
+        if self.state == OPEN:
+            return time.monotonic() - self._opened_at >= self.open_seconds
+        if self.state == HALF_OPEN:
+            return self._probes_running < self.probes
+        return True
+
+    @asynccontextmanager
+    async def guard(self, span):
+        # Wraps one call of the upstream, failing the call when the block raises
+        probe = self._admit(span)
+        start = time.monotonic()
+        failed = True
+        abandoned = False
+        try:
+            yield
+            failed = False
+        except self.abandoned:
+            failed = False
+            abandoned = True
+            raise
+        finally:
+            if probe:
+                self._probes_running -= 1
+            # An abandoned probe proves nothing either way, the next call probes again
+            if not (probe and abandoned):
+                self._record(span, failed, (time.monotonic() - start) * 1000, probe)
+
+    def _admit(self, span):
+        if self.state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._transition(span, HALF_OPEN)
+        if self.state == OPEN or (self.state == HALF_OPEN and self._probes_running >= self.probes):
+            rejected_counter.add(1, {"breaker": self.name})
+            span.set_attribute("circuit_breaker.state", self.state)
+            raise CircuitOpenError(self.name)
+        if self.state == HALF_OPEN:
+            self._probes_running += 1
+            return True
+        return False
+
+    def _record(self, span, failed, duration_ms, probe):
+        if probe:
+            if self.state == HALF_OPEN:
+                self._transition(span, OPEN if failed else CLOSED)
+            return
+
+        second = int(time.monotonic())
+        bucket = self._buckets[second % self.window_seconds]
+        if bucket[0] != second:
+            bucket[:] = [second, 0, 0, 0]
+        bucket[1] += 1
+        bucket[2] += failed
+        bucket[3] += duration_ms > self.slow_ms
+
+        if self.state != CLOSED:
+            return
+        oldest = second - self.window_seconds
+        calls = failures = slow = 0
+        for started, bucket_calls, bucket_failures, bucket_slow in self._buckets:
+            if started > oldest:
+                calls += bucket_calls
+                failures += bucket_failures
+                slow += bucket_slow
+        if calls >= self.min_calls and (failures > calls * self.error_ratio or slow > calls * self.slow_ratio):
+            self._transition(span, OPEN)
+
+    def _transition(self, span, state):
+        previous, self.state = self.state, state
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        if state == CLOSED:
+            # Start counting afresh, the failures that opened the circuit are over
+            self._buckets = [[0, 0, 0, 0] for _ in range(self.window_seconds)]
+        logger.info('Circuit %s changed from %s to %s', self.name, previous, state)
+        transitions_counter.add(1, {"breaker": self.name, "state": state})
+        span.add_event("circuit_breaker.state_change", {"breaker": self.name, "from": previous, "to": state})
+
+    def _observe_state(self, options):
+        yield metrics.Observation(STATE_VALUES[self.state], {"breaker": self.name})
@@ -0,0 +1,160 @@
+import os
+
+# Settings for the weather service, read from the environment so they can be set in the start scripts
+
+# Upstream services, point these at fake_open_meteo.py and a local second_service.py for offline benchmarks
+OPEN_METEO_URL = os.environ.get('WEATHER_OPEN_METEO_URL', 'https://api.open-meteo.com/v1/forecast')
+SECOND_SERVICE_URL = os.environ.get('WEATHER_SECOND_SERVICE_URL', 'http://localhost:8001/test')
+
+# redis:// URL of the cache, or fakeredis:// for an in-process fake (needs `pip install fakeredis lupa`)
+REDIS_URL = os.environ.get('WEATHER_REDIS_URL', 'redis://localhost:6379/0')
+# Comma separated nodes the cache is sharded over with consistent hashing, see cache_backend.py,
+# e.g. fakeredis://a,fakeredis://b for separate in-process fakes
+REDIS_URLS = os.environ.get('WEATHER_REDIS_URLS', REDIS_URL).split(',')
+# Points per node on the hash ring, more spread keys more evenly
+CACHE_VNODES = int(os.environ.get('WEATHER_CACHE_VNODES', '160'))
+# How long a node that failed a call is skipped
+CACHE_NODE_RETRY_SECONDS = float(os.environ.get('WEATHER_CACHE_NODE_RETRY_SECONDS', '5'))
+
+# A cached forecast is fresh for the soft TTL. Until the hard TTL, when Redis drops it,
+# it is still served while a background refresh replaces it.
+CACHE_SOFT_TTL_SECONDS = float(os.environ.get('WEATHER_CACHE_SOFT_TTL_SECONDS', '4'))
+CACHE_HARD_TTL_SECONDS = int(os.environ.get('WEATHER_CACHE_HARD_TTL_SECONDS', '60'))
+
+# Cross-worker single-flight: how long a fetch lock is held at most and how long other workers wait for it
+SINGLEFLIGHT_REDIS_LOCK = os.environ.get('WEATHER_SINGLEFLIGHT_REDIS_LOCK', 'true').lower() == 'true'
+SINGLEFLIGHT_LOCK_TIMEOUT_SECONDS = float(os.environ.get('WEATHER_SINGLEFLIGHT_LOCK_TIMEOUT_SECONDS', '10'))
+SINGLEFLIGHT_LOCK_WAIT_SECONDS = float(os.environ.get('WEATHER_SINGLEFLIGHT_LOCK_WAIT_SECONDS', '5'))
+
+# In-process cache in front of Redis, a size of 0 turns it off
+L1_CACHE_SIZE = int(os.environ.get('WEATHER_L1_CACHE_SIZE', '1024'))
+L1_CACHE_TTL_SECONDS = float(os.environ.get('WEATHER_L1_CACHE_TTL_SECONDS', '1'))
+
+# Compress cached forecasts with zlib, smaller entries in Redis for a bit of CPU on every write and Redis read
+CACHE_COMPRESSION = os.environ.get('WEATHER_CACHE_COMPRESSION', 'false').lower() == 'true'
+# Response bodies stored with every cached forecast: identity (plain JSON), gzip and br, see cache_codec.py
+CACHE_RESPONSE_BODIES = tuple(
+    encoding for encoding in os.environ.get('WEATHER_CACHE_RESPONSE_BODIES', 'identity,gzip,br').split(',') if encoding
+)
+
+# Coordinate snapping before caching and fetching: exact, grid or geohash, see geo.py
+GRID_MODE = os.environ.get('WEATHER_GRID_MODE', 'grid')
+GRID_RESOLUTION_DEGREES = float(os.environ.get('WEATHER_GRID_RESOLUTION_DEGREES', '0.1'))
+GEOHASH_PRECISION = int(os.environ.get('WEATHER_GEOHASH_PRECISION', '5'))
+# On a miss, serve the forecast of the nearest cached cell within this distance, 0 turns it off
+NEAREST_CELL_RADIUS_KM = float(os.environ.get('WEATHER_NEAREST_CELL_RADIUS_KM', '5'))
+# How often cells whose forecast expired are removed from the index of the nearest cell lookup
+NEAREST_CELL_TRIM_SECONDS = float(os.environ.get('WEATHER_NEAREST_CELL_TRIM_SECONDS', '60'))
+
+# Background refresh of stale and hot forecasts, see refresh.py
+REFRESH_WORKERS = int(os.environ.get('WEATHER_REFRESH_WORKERS', '4'))
+REFRESH_QUEUE_SIZE = int(os.environ.get('WEATHER_REFRESH_QUEUE_SIZE', '1000'))
+REFRESH_SCAN_INTERVAL_SECONDS = float(os.environ.get('WEATHER_REFRESH_SCAN_INTERVAL_SECONDS', '1'))
+REFRESH_HOT_THRESHOLD = int(os.environ.get('WEATHER_REFRESH_HOT_THRESHOLD', '5'))
+REFRESH_TRACKED_KEYS = int(os.environ.get('WEATHER_REFRESH_TRACKED_KEYS', '10000'))
+
+# Most locations accepted by one POST /weather/batch request
+BATCH_MAX_LOCATIONS = int(os.environ.get('WEATHER_BATCH_MAX_LOCATIONS', '100'))
+
+# Tail sampling, see sampling.py. With a budget of 0 every trace is exported.
+TRACE_BUDGET_PER_SECOND = float(os.environ.get('WEATHER_TRACE_BUDGET_PER_SECOND', '0'))
+# Traces with one of these spans slower than the given milliseconds are always kept
+TRACE_SLOW_SPAN_MS = {
+    name: float(ms)
+    for name, ms in (
+        item.split('=') for item in os.environ.get(
+            'WEATHER_TRACE_SLOW_SPAN_MS', 'fetch_data_from_open_meteo=500,request_second_service_http_request=200'
+        ).split(',') if item
+    )
+}
+TRACE_SLOW_ROOT_MS = float(os.environ.get('WEATHER_TRACE_SLOW_ROOT_MS', '1000'))
+TRACE_BUFFER_SPANS = int(os.environ.get('WEATHER_TRACE_BUFFER_SPANS', '10000'))
+
+# How request stages are instrumented: spans, light or off, see stage_timing.py
+INSTRUMENTATION_MODE = os.environ.get('WEATHER_INSTRUMENTATION_MODE', 'spans')
+# Share of successful, fast requests whose stages become spans in light mode when tail sampling is off
+INSTRUMENTATION_PROMOTE_RATIO = float(os.environ.get('WEATHER_INSTRUMENTATION_PROMOTE_RATIO', '0.01'))
+
+# Where metrics go: otlp (configured with the OTEL_EXPORTER_OTLP_* variables), console or none
+METRICS_EXPORTER = os.environ.get('WEATHER_METRICS_EXPORTER', 'otlp')
+METRICS_EXPORT_INTERVAL_MS = float(os.environ.get('WEATHER_METRICS_EXPORT_INTERVAL_MS', '10000'))
+# Stage latency histograms: explicit buckets with the boundaries below, or exponential
+METRICS_HISTOGRAM = os.environ.get('WEATHER_METRICS_HISTOGRAM', 'explicit')
+STAGE_BUCKETS_MS = [
+    float(ms) for ms in os.environ.get(
+        'WEATHER_STAGE_BUCKETS_MS', '0.25,0.5,1,2.5,5,10,25,50,100,250,500,1000,2500,5000,10000'
+    ).split(',')
+]
+
+# Where spans and log records go: otlp through the bounded export queues of export_pipeline.py, or none.
+# The launch scripts turn the exporters of opentelemetry-instrument off and set these instead.
+TRACES_EXPORTER = os.environ.get('WEATHER_TRACES_EXPORTER', 'none')
+LOGS_EXPORTER = os.environ.get('WEATHER_LOGS_EXPORTER', 'none')
+# Per signal: items queued at most, items per export, longest wait before exporting a partial batch
+EXPORT_QUEUE_SIZE = int(os.environ.get('WEATHER_EXPORT_QUEUE_SIZE', '2048'))
+EXPORT_BATCH_SIZE = int(os.environ.get('WEATHER_EXPORT_BATCH_SIZE', '512'))
+EXPORT_SCHEDULE_DELAY_MS = float(os.environ.get('WEATHER_EXPORT_SCHEDULE_DELAY_MS', '1000'))
+# Timeout of one export call to the collector, for spans, log records and metrics
+EXPORT_TIMEOUT_MS = float(os.environ.get('WEATHER_EXPORT_TIMEOUT_MS', '10000'))
+# What a full export queue drops: drop_newest or drop_oldest
+EXPORT_DROP_POLICY = os.environ.get('WEATHER_EXPORT_DROP_POLICY', 'drop_newest')
+
+# Cache analytics, see cache_analytics.py
+ANALYTICS_SKETCH_WIDTH = int(os.environ.get('WEATHER_ANALYTICS_SKETCH_WIDTH', '2048'))
+ANALYTICS_SKETCH_DEPTH = int(os.environ.get('WEATHER_ANALYTICS_SKETCH_DEPTH', '4'))
+ANALYTICS_TOP_K = int(os.environ.get('WEATHER_ANALYTICS_TOP_K', '20'))
+ANALYTICS_TRACKED_KEYS = int(os.environ.get('WEATHER_ANALYTICS_TRACKED_KEYS', '10000'))
+ANALYTICS_DECAY_SECONDS = float(os.environ.get('WEATHER_ANALYTICS_DECAY_SECONDS', '300'))
+ANALYTICS_TARGET_HIT_RATIO = float(os.environ.get('WEATHER_ANALYTICS_TARGET_HIT_RATIO', '0.9'))
+
+# Logging through a background thread, see log_pipeline.py. A queue size of 0 logs on the calling thread.
+LOG_QUEUE_SIZE = int(os.environ.get('WEATHER_LOG_QUEUE_SIZE', '10000'))
+LOG_BURST = int(os.environ.get('WEATHER_LOG_BURST', '10'))
+LOG_WINDOW_SECONDS = float(os.environ.get('WEATHER_LOG_WINDOW_SECONDS', '10'))
+
+# Second service client, see second_service_client.py. Replicas are comma separated URLs.
+SECOND_SERVICE_URLS = os.environ.get('WEATHER_SECOND_SERVICE_URLS', SECOND_SERVICE_URL).split(',')
+SECOND_SERVICE_TIMEOUT_SECONDS = float(os.environ.get('WEATHER_SECOND_SERVICE_TIMEOUT_SECONDS', '2'))
+SECOND_SERVICE_HTTP2 = os.environ.get('WEATHER_SECOND_SERVICE_HTTP2', 'false').lower() == 'true'
+SECOND_SERVICE_IN_PROCESS = os.environ.get('WEATHER_SECOND_SERVICE_IN_PROCESS', 'false').lower() == 'true'
+# Send a backup request after this percentile of recent latencies, 0 turns hedging off
+SECOND_SERVICE_HEDGE_PERCENTILE = float(os.environ.get('WEATHER_SECOND_SERVICE_HEDGE_PERCENTILE', '95'))
+SECOND_SERVICE_HEDGE_MIN_DELAY_MS = float(os.environ.get('WEATHER_SECOND_SERVICE_HEDGE_MIN_DELAY_MS', '5'))
+# Share of requests that may be hedged
+SECOND_SERVICE_HEDGE_BUDGET = float(os.environ.get('WEATHER_SECOND_SERVICE_HEDGE_BUDGET', '0.1'))
+
+# Time budget of a request in milliseconds, shared by its stages and sent along to the second service, 0 turns it off
+REQUEST_DEADLINE_MS = float(os.environ.get('WEATHER_REQUEST_DEADLINE_MS', '5000'))
+
+# Circuit breaker around Open-Meteo, see circuit_breaker.py
+BREAKER_WINDOW_SECONDS = int(os.environ.get('WEATHER_BREAKER_WINDOW_SECONDS', '10'))
+BREAKER_MIN_CALLS = int(os.environ.get('WEATHER_BREAKER_MIN_CALLS', '10'))
+BREAKER_ERROR_RATIO = float(os.environ.get('WEATHER_BREAKER_ERROR_RATIO', '0.5'))
+BREAKER_SLOW_MS = float(os.environ.get('WEATHER_BREAKER_SLOW_MS', '2000'))
+BREAKER_SLOW_RATIO = float(os.environ.get('WEATHER_BREAKER_SLOW_RATIO', '0.5'))
+BREAKER_OPEN_SECONDS = float(os.environ.get('WEATHER_BREAKER_OPEN_SECONDS', '5'))
+# How long the last good forecast is kept for when Open-Meteo is down
+FALLBACK_TTL_SECONDS = int(os.environ.get('WEATHER_FALLBACK_TTL_SECONDS', '86400'))
+
+# Worker processes of start_workers.sh. Per process limits like the trace budget are divided between them
+WORKERS = max(int(os.environ.get('WEATHER_WORKERS', '1')), 1)
+# Set by gunicorn.conf.py for every worker, reported as the worker.id resource attribute
+WORKER_ID = int(os.environ.get('WEATHER_WORKER_ID', '0'))
+
+# Cache pre-warming at startup from a snapshot of the most requested coordinates, '' turns it off
+PREWARM_SNAPSHOT_PATH = os.environ.get('WEATHER_PREWARM_SNAPSHOT_PATH', 'access_snapshot.json')
+PREWARM_SNAPSHOT_INTERVAL_SECONDS = float(os.environ.get('WEATHER_PREWARM_SNAPSHOT_INTERVAL_SECONDS', '60'))
+# At most WEATHER_ANALYTICS_TOP_K, the snapshot holds the top keys of cache_analytics.py
+PREWARM_TOP_N = int(os.environ.get('WEATHER_PREWARM_TOP_N', '20'))
+PREWARM_TIMEOUT_SECONDS = float(os.environ.get('WEATHER_PREWARM_TIMEOUT_SECONDS', '30'))
+
+# On-disk cache below Redis, one directory per worker in it, '' turns it off
+DISK_CACHE_DIR = os.environ.get('WEATHER_DISK_CACHE_DIR', 'disk_cache')
+DISK_CACHE_MAX_BYTES = int(os.environ.get('WEATHER_DISK_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+DISK_CACHE_SEGMENT_BYTES = int(os.environ.get('WEATHER_DISK_CACHE_SEGMENT_BYTES', str(16 * 1024 * 1024)))
+# How old a forecast from disk may be while Redis is unreachable, while it is up the hard TTL applies
+DISK_CACHE_MAX_AGE_SECONDS = float(os.environ.get('WEATHER_DISK_CACHE_MAX_AGE_SECONDS', '86400'))
+DISK_CACHE_FSYNC_SECONDS = float(os.environ.get('WEATHER_DISK_CACHE_FSYNC_SECONDS', '1'))
+
+# Serialized summaries of POST /weather/aggregate kept in memory, 0 turns memoizing off
+AGGREGATE_CACHE_SIZE = int(os.environ.get('WEATHER_AGGREGATE_CACHE_SIZE', '4096'))
@@ -0,0 +1,104 @@
+import asyncio
+import contextvars
+import functools
+import math
+import time
+from contextlib import asynccontextmanager
+
+from fastapi import HTTPException
+from opentelemetry import metrics, trace
+
+import config
+
+# A time budget per request. The endpoint sets the deadline, every stage gets what is left of it and
+# the rest is sent along to the second service in the DEADLINE_HEADER, so it can give up on work
+# nobody will wait for. A caller can ask for a tighter deadline with the same header.
+
+# Remaining budget in milliseconds, relative so the clocks of the services don't have to agree
+DEADLINE_HEADER = 'x-request-deadline-ms'
+
+# Creates a meter from the global meter provider
+meter = metrics.get_meter("my.meter.name")
+
+deadline_exceeded_counter = meter.create_counter(
+    "deadline.exceeded", unit="1", description="Counts stages that ran out of their request's time budget"
+)
+
+# time.monotonic() by which the current request has to be answered, None without a deadline
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+
+    def __init__(self, stage):
+        super().__init__('Deadline exceeded in %s' % stage)
+        self.stage = stage
+
+
+def remaining():
+    # Seconds left for the current request, None without a deadline
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0.0)
+
+
+def header_value():
+    left = remaining()
+    return None if left is None else str(int(left * 1000))
+
+
+def detached(fn):
+    # Wraps a coroutine function to run without the caller's deadline, for work shared by several requests
+    # like a coalesced fetch. Each of them waits for it within its own budget.
+    async def run():
+        _deadline.set(None)
+        return await fn()
+    return run
+
+
+@asynccontextmanager
+async def budget(span, stage):
+    # Cancels the block when the request's deadline passes and records on `span` that `stage` ran out of time
+    left = remaining()
+    if left is None:
+        yield
+        return
+    try:
+        if left <= 0:
+            raise TimeoutError
+        async with asyncio.timeout(left):
+            yield
+    except TimeoutError:
+        span.set_attributes({"deadline.exceeded": True, "deadline.stage": stage})
+        deadline_exceeded_counter.add(1, {"stage": stage})
+        raise DeadlineExceeded(stage) from None
+
+
+def with_deadline(endpoint):
+    # Decorator for endpoints with a `request` parameter: sets the deadline from WEATHER_REQUEST_DEADLINE_MS
+    # or the caller's DEADLINE_HEADER, whichever is shorter, and answers 504 when it passes
+    @functools.wraps(endpoint)
+    async def wrapper(*args, **kwargs):
+        budget_ms = config.REQUEST_DEADLINE_MS or None
+        requested = kwargs['request'].headers.get(DEADLINE_HEADER)
+        if requested is not None:
+            try:
+                requested_ms = float(requested)
+            except ValueError:
+                requested_ms = None
+            # nan, inf and budgets that already ran out are ignored like unreadable values
+            if requested_ms is not None and math.isfinite(requested_ms) and requested_ms > 0:
+                budget_ms = min(requested_ms, budget_ms or requested_ms)
+        if budget_ms is None:
+            return await endpoint(*args, **kwargs)
+
+        token = _deadline.set(time.monotonic() + budget_ms / 1000)
+        try:
+            return await endpoint(*args, **kwargs)
+        except DeadlineExceeded as e:
+            trace.get_current_span().set_attributes({"deadline.exceeded": True, "deadline.stage": e.stage})
+            raise HTTPException(status_code=504, detail=str(e))
+        finally:
+            _deadline.reset(token)
+    return wrapper
@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import os
+import struct
+import time
+import zlib
+
+from opentelemetry import metrics
+
+# Creates a meter from the global meter provider
+meter = metrics.get_meter("my.meter.name")
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+lookups_counter = meter.create_counter(
+    "disk_cache.lookups", unit="1", description="Counts lookups of the on-disk cache by result"
+)
+evicted_counter = meter.create_counter(
+    "disk_cache.evicted_segments", unit="1", description="Counts segment files removed to stay under the size limit"
+)
+
+# Every record: CRC32 of everything after the CRC, time written, key length, value length, then key and value
+RECORD_HEADER = struct.Struct('<IdHI')
+
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.log'
+
+
+class DiskCache:
+    # Keeps the recently stored forecasts on local disk, below Redis. Records are appended to segment
+    # files and never changed, an index in memory points to the latest record of every key. On open
+    # the index is rebuilt by reading the segments, a record whose CRC doesn't match, like the half
+    # written last one of a crashed process, ends its segment and is cut off.
+    #
+    # When the segments together grow beyond `max_bytes` the oldest one is deleted. Forecasts that are
+    # still asked for are stored again on every refresh, so the oldest segment mostly holds ones that
+    # were replaced or nobody wanted anymore.
+    #
+    # Reads and writes are single pread and write calls on open files, answered from the page cache in
+    # the common case, so they run on the event loop. fsync runs on a thread, every few seconds and when
+    # a segment is full.
+
+    def __init__(self, directory, max_bytes, segment_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        # key -> (segment number, offset of the value, value length, time written)
+        self._index = {}
+        # segment number -> [file descriptor, size], oldest first
+        self._segments = {}
+        self._active = None
+        self._bytes = 0
+        # fsync calls of segments that were rolled over, running on threads
+        self._syncs = set()
+        meter.create_observable_gauge(
+            "disk_cache.bytes", callbacks=[self._observe_bytes], unit="By",
+            description="Size of the segment files of the on-disk cache",
+        )
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        numbers = sorted(
+            int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+        )
+        for number in numbers:
+            self._load(number)
+        # Appending after a tail that was cut off would work too, a new segment keeps it simple
+        self._roll(numbers[-1] + 1 if numbers else 0)
+        self._evict()
+        logger.info('Opened disk cache %s: %d keys in %d segments, %d bytes',
+                    self.directory, len(self._index), len(self._segments), self._bytes)
+
+    def put(self, key, value):
+        encoded_key = key.encode()
+        now = time.time()
+        body = RECORD_HEADER.pack(0, now, len(encoded_key), len(value))[4:] + encoded_key + value
+        record = struct.pack('<I', zlib.crc32(body)) + body
+        if self._segments[self._active][1] + len(record) > self.segment_bytes:
+            self._roll(self._active + 1)
+        fd, size = self._segments[self._active]
+        try:
+            written = os.write(fd, record)
+            if written != len(record):
+                raise OSError('short write of %d of %d bytes' % (written, len(record)))
+        except OSError as e:
+            # The forecast is still in Redis, losing the local copy only matters during an outage
+            logger.error('Could not write %s to the disk cache: %s', key, e)
+            self._roll(self._active + 1)
+            return
+        self._index[key] = (self._active, size + RECORD_HEADER.size + len(encoded_key), len(value), now)
+        self._segments[self._active][1] += len(record)
+        self._bytes += len(record)
+        if self._bytes > self.max_bytes:
+            self._evict()
+
+    def get(self, key, max_age_seconds):
+        # The stored value if it was written at most `max_age_seconds` ago
+        entry = self._index.get(key)
+        if entry is None:
+            lookups_counter.add(1, {"result": "miss"})
+            return None
+        number, offset, length, written_at = entry
+        if time.time() - written_at > max_age_seconds:
+            lookups_counter.add(1, {"result": "too_old"})
+            return None
+        lookups_counter.add(1, {"result": "hit"})
+        return os.pread(self._segments[number][0], length, offset)
+
+    async def sync_periodically(self, interval_seconds):
+        # Until the records are synced, a crash of the machine (not of the process) can lose them
+        while True:
+            await asyncio.sleep(interval_seconds)
+            try:
+                await asyncio.to_thread(os.fsync, self._segments[self._active][0])
+            except OSError as e:
+                logger.error('Could not sync the disk cache: %s', e)
+
+    def close(self):
+        os.fsync(self._segments[self._active][0])
+        for fd, _ in self._segments.values():
+            os.close(fd)
+        self._segments = {}
+
+    def _path(self, number):
+        return os.path.join(self.directory, '%s%08d%s' % (SEGMENT_PREFIX, number, SEGMENT_SUFFIX))
+
+    def _load(self, number):
+        fd = os.open(self._path(number), os.O_RDWR | os.O_APPEND)
+        with open(fd, 'rb', closefd=False) as f:
+            data = f.read()
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            crc, written_at, key_length, value_length = RECORD_HEADER.unpack_from(data, offset)
+            end = offset + RECORD_HEADER.size + key_length + value_length
+            if end > len(data) or zlib.crc32(data[offset + 4:end]) != crc:
+                break
+            key_end = offset + RECORD_HEADER.size + key_length
+            self._index[data[offset + RECORD_HEADER.size:key_end].decode()] = (number, key_end, value_length, written_at)
+            offset = end
+        if offset != len(data):
+            logger.warning('Cutting off %d bytes of a torn or corrupt record in %s', len(data) - offset, self._path(number))
+            os.ftruncate(fd, offset)
+        self._segments[number] = [fd, offset]
+        self._bytes += offset
+
+    def _roll(self, number):
+        self._segments[number] = [os.open(self._path(number), os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644), 0]
+        if self._active is not None:
+            # Data written so far should reach the disk without waiting for the next periodic fsync
+            self._sync_in_background(self._segments[self._active][0])
+        self._active = number
+
+    def _sync_in_background(self, fd):
+        # On a thread like the periodic fsync, on a duplicate of the descriptor so evicting or closing the
+        # segment meanwhile doesn't pull it from under the thread
+        duplicate = os.dup(fd)
+
+        def sync():
+            try:
+                os.fsync(duplicate)
+            except OSError as e:
+                logger.error('Could not sync the disk cache: %s', e)
+            finally:
+                os.close(duplicate)
+
+        try:
+            task = asyncio.get_running_loop().create_task(asyncio.to_thread(sync))
+        except RuntimeError:
+            # Not on the event loop, like in open() outside of the app
+            sync()
+            return
+        self._syncs.add(task)
+        task.add_done_callback(self._syncs.discard)
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and len(self._segments) > 1:
+            number = next(iter(self._segments))
+            fd, size = self._segments.pop(number)
+            os.close(fd)
+            os.unlink(self._path(number))
+            self._bytes -= size
+            self._index = {key: entry for key, entry in self._index.items() if entry[0] != number}
+            evicted_counter.add(1)
+
+    def _observe_bytes(self, options):
+        yield metrics.Observation(self._bytes)
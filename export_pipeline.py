@@ -0,0 +1,247 @@
+import collections
+import logging
+import threading
+import time
+
+from opentelemetry import context, metrics
+from opentelemetry.context import _SUPPRESS_INSTRUMENTATION_KEY
+from opentelemetry.sdk._logs import LogRecordProcessor
+from opentelemetry.sdk._logs.export import LogExportResult
+from opentelemetry.sdk.metrics.export import MetricExporter, MetricExportResult
+from opentelemetry.sdk.trace import SpanProcessor
+from opentelemetry.sdk.trace.export import SpanExportResult
+
+# Exports spans and log records from a bounded queue per signal on a thread of its own. Ending a span or
+# logging only appends to the queue, so a slow or unreachable collector never adds latency to a request:
+# while the exporter is busy, retrying or waiting for a timeout the queue fills up, and once it holds
+# `max_queue_size` items further ones are dropped instead of growing memory or blocking the caller.
+#
+#   drop_newest  keeps what is queued and drops what arrives, like the BatchSpanProcessor of the SDK
+#   drop_oldest  drops the oldest queued item for every new one, so the collector gets the latest
+#                data once it is back
+#
+# The thread exports a batch once `max_batch_size` items are queued or `schedule_delay_ms` after the
+# last export. The OTLP exporters retry UNAVAILABLE answers with backoff for about a minute, meanwhile
+# the queue is the only buffer. Queue depth, dropped items and export duration are reported as metrics
+# and on GET /admin/telemetry/export.
+
+# Creates a meter from the global meter provider
+meter = metrics.get_meter("my.meter.name")
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+exported_counter = meter.create_counter(
+    "export.items", unit="1", description="Counts spans and log records handed to the exporter, by signal and outcome"
+)
+dropped_counter = meter.create_counter(
+    "export.dropped", unit="1", description="Counts spans and log records dropped because the export queue was full"
+)
+export_duration_histogram = meter.create_histogram(
+    "export.duration", unit="ms", description="Duration of the export of one batch, including the exporter's retries"
+)
+
+DROP_POLICIES = ('drop_newest', 'drop_oldest')
+
+# Every export queue of this process, for the queue depth gauge and the admin endpoint
+queues = []
+
+
+class ExportQueue:
+
+    def __init__(self, signal, export, max_queue_size=2048, max_batch_size=512, schedule_delay_ms=1000,
+                 drop_policy='drop_newest'):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError('unknown drop policy %r, expected one of %s' % (drop_policy, ', '.join(DROP_POLICIES)))
+        self.signal = signal
+        # Takes a list of items and returns whether they were exported
+        self.export = export
+        self.max_queue_size = max_queue_size
+        self.max_batch_size = max_batch_size
+        self.schedule_delay_seconds = schedule_delay_ms / 1000
+        self.drop_policy = drop_policy
+
+        self.dropped = 0
+        self.exported = 0
+        self.failed = 0
+        self.last_export_ms = None
+
+        self._items = collections.deque()
+        self._condition = threading.Condition()
+        # Events of force_flush calls, set once everything queued before them was exported
+        self._flushes = []
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='export-' + signal, daemon=True)
+        self._thread.start()
+        queues.append(self)
+
+    def put(self, item):
+        # Called on the thread that ended the span or logged the record, never waits for the exporter
+        with self._condition:
+            if self._stopping:
+                return
+            dropped = len(self._items) >= self.max_queue_size
+            if dropped:
+                self.dropped += 1
+            if not dropped or self.drop_policy == 'drop_oldest':
+                if dropped:
+                    self._items.popleft()
+                self._items.append(item)
+            if len(self._items) >= self.max_batch_size:
+                self._condition.notify()
+        if dropped:
+            dropped_counter.add(1, {"signal": self.signal, "policy": self.drop_policy})
+
+    def depth(self):
+        return len(self._items)
+
+    def flush(self, timeout_millis=30000):
+        event = threading.Event()
+        with self._condition:
+            if self._stopping:
+                return True
+            self._flushes.append(event)
+            self._condition.notify()
+        return event.wait(timeout_millis / 1000)
+
+    def shutdown(self, timeout_millis=30000):
+        # Exports what is queued, waiting at most `timeout_millis` for an unreachable collector
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._thread.join(timeout_millis / 1000)
+        if self._thread.is_alive():
+            logger.warning('Gave up exporting %d queued %s at shutdown', len(self._items), self.signal)
+
+    def report(self):
+        return {
+            'signal': self.signal,
+            'queue_depth': len(self._items),
+            'max_queue_size': self.max_queue_size,
+            'drop_policy': self.drop_policy,
+            'exported': self.exported,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'last_export_ms': round(self.last_export_ms, 3) if self.last_export_ms is not None else None,
+        }
+
+    def _run(self):
+        # The exporter's own calls, like its gRPC requests, aren't traced and exported again
+        context.attach(context.set_value(_SUPPRESS_INSTRUMENTATION_KEY, True))
+        while True:
+            with self._condition:
+                if not (self._stopping or self._flushes or len(self._items) >= self.max_batch_size):
+                    self._condition.wait(self.schedule_delay_seconds)
+                batch = [self._items.popleft() for _ in range(min(len(self._items), self.max_batch_size))]
+                drained = not self._items
+                flushes = []
+                if drained:
+                    flushes, self._flushes = self._flushes, []
+                stopping = self._stopping
+            if batch:
+                self._export_batch(batch)
+            for event in flushes:
+                event.set()
+            if stopping and drained:
+                return
+
+    def _export_batch(self, batch):
+        start = time.perf_counter()
+        try:
+            succeeded = self.export(batch)
+        except Exception as e:
+            logger.warning('Exporting %d %s failed: %s', len(batch), self.signal, e)
+            succeeded = False
+        duration_ms = (time.perf_counter() - start) * 1000
+        outcome = "success" if succeeded else "failure"
+        self.last_export_ms = duration_ms
+        if succeeded:
+            self.exported += len(batch)
+        else:
+            self.failed += len(batch)
+        export_duration_histogram.record(duration_ms, {"signal": self.signal, "outcome": outcome})
+        exported_counter.add(len(batch), {"signal": self.signal, "outcome": outcome})
+
+
+class BoundedSpanProcessor(SpanProcessor):
+    # Replaces the BatchSpanProcessor of the SDK, see ExportQueue for the options. At shutdown what is
+    # queued gets `shutdown_timeout_ms` to reach the collector.
+
+    def __init__(self, exporter, shutdown_timeout_ms=30000, **options):
+        self.exporter = exporter
+        self.shutdown_timeout_ms = shutdown_timeout_ms
+        self.queue = ExportQueue(
+            'traces', lambda spans: exporter.export(spans) == SpanExportResult.SUCCESS, **options
+        )
+
+    def on_end(self, span):
+        if span.context.trace_flags.sampled:
+            self.queue.put(span)
+
+    def shutdown(self):
+        self.queue.shutdown(self.shutdown_timeout_ms)
+        self.exporter.shutdown()
+
+    def force_flush(self, timeout_millis=30000):
+        return self.queue.flush(timeout_millis)
+
+
+class BoundedLogRecordProcessor(LogRecordProcessor):
+    # Replaces the BatchLogRecordProcessor of the SDK, see BoundedSpanProcessor
+
+    def __init__(self, exporter, shutdown_timeout_ms=30000, **options):
+        self.exporter = exporter
+        self.shutdown_timeout_ms = shutdown_timeout_ms
+        self.queue = ExportQueue(
+            'logs', lambda records: exporter.export(records) == LogExportResult.SUCCESS, **options
+        )
+
+    def emit(self, log_data):
+        self.queue.put(log_data)
+
+    def shutdown(self):
+        self.queue.shutdown(self.shutdown_timeout_ms)
+        self.exporter.shutdown()
+
+    def force_flush(self, timeout_millis=30000):
+        return self.queue.flush(timeout_millis)
+
+
+class TimedMetricExporter(MetricExporter):
+    # Metrics aren't queued, the PeriodicExportingMetricReader aggregates them in memory and exports
+    # from its own thread. This only reports the duration of its exports next to those of the queues.
+
+    def __init__(self, exporter):
+        super().__init__(
+            preferred_temporality=exporter._preferred_temporality,
+            preferred_aggregation=exporter._preferred_aggregation,
+        )
+        self.exporter = exporter
+
+    def export(self, metrics_data, timeout_millis=10000, **kwargs):
+        start = time.perf_counter()
+        result = self.exporter.export(metrics_data, timeout_millis=timeout_millis, **kwargs)
+        outcome = "success" if result == MetricExportResult.SUCCESS else "failure"
+        export_duration_histogram.record((time.perf_counter() - start) * 1000, {"signal": "metrics", "outcome": outcome})
+        return result
+
+    def force_flush(self, timeout_millis=10000):
+        return self.exporter.force_flush(timeout_millis=timeout_millis)
+
+    def shutdown(self, timeout_millis=30000, **kwargs):
+        self.exporter.shutdown(timeout_millis=timeout_millis, **kwargs)
+
+
+def report():
+    return {'queues': [queue.report() for queue in queues]}
+
+
+def _observe_depth(options):
+    for queue in queues:
+        yield metrics.Observation(queue.depth(), {"signal": queue.signal})
+
+
+meter.create_observable_gauge(
+    "export.queue_depth", callbacks=[_observe_depth], unit="1",
+    description="Spans and log records waiting in the export queue",
+)
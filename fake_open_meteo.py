@@ -0,0 +1,75 @@
+import hashlib
+import logging
+import math
+from datetime import date, timedelta
+
+from fastapi import FastAPI, Query
+from fastapi.responses import JSONResponse
+
+from fault_injection import FaultInjection
+
+# Offline stand-in for https://api.open-meteo.com/v1/forecast, answers with realistic hourly
+# temperatures that only depend on the coordinates and the start date, so runs are reproducible.
+#
+#   uvicorn fake_open_meteo:app --port 8002
+#   WEATHER_OPEN_METEO_URL=http://localhost:8002/v1/forecast bash start.sh
+#
+# Latency, errors and payload size are injected with the FAKE_OPEN_METEO_* variables, see fault_injection.py.
+# FAKE_OPEN_METEO_PAYLOAD_BYTES is ignored, the payload grows with the forecast_days parameter instead.
+
+app = FastAPI()
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+faults = FaultInjection.from_env('FAKE_OPEN_METEO')
+
+# All forecasts start on this day so the same request always gets the same answer
+START_DATE = date(2024, 1, 1)
+
+
+def location_forecast(latitude, longitude, days):
+    # A seasonal base temperature that falls towards the poles, a daily cycle peaking in the
+    # afternoon and a few degrees of per-location noise derived from the coordinates
+    seed = int.from_bytes(hashlib.sha256(('%.4f,%.4f' % (latitude, longitude)).encode()).digest()[:8], 'little')
+    offset = (seed % 1000) / 1000 * 4 - 2
+    base = 27 - abs(latitude) * 0.45 + offset
+    # The sun is overhead at noon local solar time, roughly longitude / 15 hours from UTC
+    solar_shift = longitude / 15
+
+    times = []
+    temperatures = []
+    for hour in range(days * 24):
+        day = START_DATE + timedelta(days=hour // 24)
+        times.append('%sT%02d:00' % (day.isoformat(), hour % 24))
+        daily = 4 * math.cos((hour % 24 + solar_shift - 15) / 24 * 2 * math.pi)
+        weather = 2 * math.sin((hour + seed % 97) / 37)
+        temperatures.append(round(base + daily + weather, 1))
+
+    return {
+        'latitude': round(latitude, 4),
+        'longitude': round(longitude, 4),
+        'generationtime_ms': 0.05,
+        'utc_offset_seconds': 0,
+        'timezone': 'GMT',
+        'timezone_abbreviation': 'GMT',
+        'elevation': float(seed % 300),
+        'hourly_units': {'time': 'iso8601', 'temperature_2m': '°C'},
+        'hourly': {'time': times, 'temperature_2m': temperatures},
+    }
+
+
+@app.get('/v1/forecast')
+async def forecast(latitude: str = Query(...), longitude: str = Query(...),
+                   hourly: str = Query('temperature_2m'), forecast_days: int = Query(7, ge=1, le=16)):
+    if await faults.delay():
+        return JSONResponse(status_code=500, content={'error': True, 'reason': 'Injected error'})
+
+    # Like Open-Meteo, several comma separated coordinates return a list of forecasts
+    latitudes = [float(v) for v in latitude.split(',')]
+    longitudes = [float(v) for v in longitude.split(',')]
+    if len(latitudes) != len(longitudes):
+        return JSONResponse(status_code=400, content={'error': True, 'reason': 'Parameter count mismatch'})
+
+    forecasts = [location_forecast(lat, lon, forecast_days) for lat, lon in zip(latitudes, longitudes)]
+    return forecasts if len(forecasts) > 1 else forecasts[0]
@@ -0,0 +1,134 @@
+import argparse
+import logging
+import signal
+import threading
+import time
+from concurrent import futures
+
+import grpc
+from opentelemetry.proto.collector.logs.v1 import logs_service_pb2, logs_service_pb2_grpc
+from opentelemetry.proto.collector.metrics.v1 import metrics_service_pb2, metrics_service_pb2_grpc
+from opentelemetry.proto.collector.trace.v1 import trace_service_pb2, trace_service_pb2_grpc
+
+from fault_injection import FaultInjection
+
+# Offline stand-in for an OpenTelemetry collector: accepts OTLP over gRPC, counts what it receives and
+# throws it away. Used to see how the app behaves when its collector is slow or unavailable.
+#
+#   python fake_otlp_collector.py --port 4317
+#   OTEL_EXPORTER_OTLP_ENDPOINT=http://127.0.0.1:4317 OTEL_EXPORTER_OTLP_INSECURE=true bash start.sh
+#
+# Latency and errors are injected with the FAKE_OTLP_* variables, see fault_injection.py. Injected errors
+# are answered with UNAVAILABLE, which the exporters retry with backoff, so FAKE_OTLP_ERROR_RATE=1 is a
+# collector that is up but can't take anything. FAKE_OTLP_PAYLOAD_BYTES is ignored.
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+faults = FaultInjection.from_env('FAKE_OTLP')
+
+
+class Counts:
+    # Items received per signal, and export calls answered with an error
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.received = {'spans': 0, 'log_records': 0, 'metrics': 0}
+        self.requests = 0
+        self.rejected = 0
+
+    def add(self, name, count):
+        with self._lock:
+            self.requests += 1
+            self.received[name] += count
+
+    def reject(self):
+        with self._lock:
+            self.requests += 1
+            self.rejected += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.received, requests=self.requests, rejected=self.rejected)
+
+
+counts = Counts()
+# The random generator of the fault injection is shared by the server's threads
+faults_lock = threading.Lock()
+
+
+def inject_faults(context):
+    # Called on one of the server's threads, sleeping only holds up this export call
+    with faults_lock:
+        latency = faults.sample_latency()
+        failed = faults.random.random() < faults.error_rate
+    if latency > 0:
+        time.sleep(latency)
+    if failed:
+        counts.reject()
+        context.abort(grpc.StatusCode.UNAVAILABLE, 'Injected error')
+
+
+class TraceService(trace_service_pb2_grpc.TraceServiceServicer):
+
+    def Export(self, request, context):
+        inject_faults(context)
+        counts.add('spans', sum(
+            len(scope_spans.spans) for resource_spans in request.resource_spans for scope_spans in resource_spans.scope_spans
+        ))
+        return trace_service_pb2.ExportTraceServiceResponse()
+
+
+class LogsService(logs_service_pb2_grpc.LogsServiceServicer):
+
+    def Export(self, request, context):
+        inject_faults(context)
+        counts.add('log_records', sum(
+            len(scope_logs.log_records) for resource_logs in request.resource_logs for scope_logs in resource_logs.scope_logs
+        ))
+        return logs_service_pb2.ExportLogsServiceResponse()
+
+
+class MetricsService(metrics_service_pb2_grpc.MetricsServiceServicer):
+
+    def Export(self, request, context):
+        inject_faults(context)
+        counts.add('metrics', sum(
+            len(scope_metrics.metrics) for resource_metrics in request.resource_metrics
+            for scope_metrics in resource_metrics.scope_metrics
+        ))
+        return metrics_service_pb2.ExportMetricsServiceResponse()
+
+
+def serve(port, threads=10):
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=threads))
+    trace_service_pb2_grpc.add_TraceServiceServicer_to_server(TraceService(), server)
+    logs_service_pb2_grpc.add_LogsServiceServicer_to_server(LogsService(), server)
+    metrics_service_pb2_grpc.add_MetricsServiceServicer_to_server(MetricsService(), server)
+    server.add_insecure_port('127.0.0.1:%d' % port)
+    server.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake OTLP/gRPC collector')
+    parser.add_argument('--port', type=int, default=4317)
+    parser.add_argument('--report-interval', type=float, default=10, help='seconds between printed counts, 0 for none')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    server = serve(args.port)
+    # Stopping the server ends the loop below, so the final counts are printed on SIGTERM too
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop(grace=1))
+    logger.info('Fake OTLP collector on port %d, latency %s, error rate %s', args.port, faults.latency, faults.error_rate)
+    try:
+        # Returns True when the interval passed without the server stopping
+        while server.wait_for_termination(args.report_interval or None):
+            logger.info('Received %s', counts.snapshot())
+    except KeyboardInterrupt:
+        server.stop(grace=1)
+    logger.info('Received %s', counts.snapshot())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import asyncio
+import os
+import random
+
+# Latency, error and payload size injection for the offline stand-ins of our upstreams.
+# Everything is read from environment variables with a per-service prefix, e.g. for second_service.py
+#
+#   SECOND_SERVICE_LATENCY=lognormal:20,0.5   latency in milliseconds, see LATENCY_DISTRIBUTIONS
+#   SECOND_SERVICE_ERROR_RATE=0.01            share of requests answered with a 500
+#   SECOND_SERVICE_PAYLOAD_BYTES=1024         size of the response body where the service supports it
+#   SECOND_SERVICE_SEED=42                    makes the injected latencies and errors reproducible
+
+# Distributions take their parameters in milliseconds, except the sigma of lognormal
+LATENCY_DISTRIBUTIONS = {
+    'none': lambda rng: 0,
+    'fixed': lambda rng, ms: ms,
+    'uniform': lambda rng, low, high: rng.uniform(low, high),
+    'normal': lambda rng, mean, stddev: max(rng.gauss(mean, stddev), 0),
+    'exponential': lambda rng, mean: rng.expovariate(1 / mean),
+    # Median `median` ms, sigma of the underlying normal controls how long the tail is
+    'lognormal': lambda rng, median, sigma: median * rng.lognormvariate(0, sigma),
+}
+
+
+class FaultInjection:
+
+    def __init__(self, latency='none', error_rate=0.0, payload_bytes=0, seed=None):
+        name, _, params = latency.partition(':')
+        if name not in LATENCY_DISTRIBUTIONS:
+            raise ValueError('unknown latency distribution %r' % name)
+        self._sample = LATENCY_DISTRIBUTIONS[name]
+        self._params = [float(p) for p in params.split(',')] if params else []
+        self.latency = latency
+        self.error_rate = error_rate
+        self.payload_bytes = payload_bytes
+        self.random = random.Random(seed)
+
+    @classmethod
+    def from_env(cls, prefix):
+        seed = os.environ.get(prefix + '_SEED')
+        return cls(
+            latency=os.environ.get(prefix + '_LATENCY', 'none'),
+            error_rate=float(os.environ.get(prefix + '_ERROR_RATE', '0')),
+            payload_bytes=int(os.environ.get(prefix + '_PAYLOAD_BYTES', '0')),
+            seed=int(seed) if seed is not None else None,
+        )
+
+    def sample_latency(self):
+        return self._sample(self.random, *self._params) / 1000
+
+    async def delay(self):
+        # Returns True when this request should fail
+        latency = self.sample_latency()
+        if latency > 0:
+            await asyncio.sleep(latency)
+        return self.random.random() < self.error_rate
+
+    def padding(self):
+        return 'x' * self.payload_bytes
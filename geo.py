@@ -0,0 +1,149 @@
+import asyncio
+import math
+
+import config
+from cache_backend import NODE_ERRORS
+
+# Coordinates are snapped to a cell before they are used for the cache key and the
+# Open-Meteo request, so GPS jitter from clients ends up in the same cache entry.
+#
+#   exact    no snapping, every distinct coordinate is its own entry
+#   grid     snap to a regular grid of WEATHER_GRID_RESOLUTION_DEGREES
+#   geohash  snap to the center of the geohash cell of WEATHER_GEOHASH_PRECISION characters
+
+# Redis GEO set of all cells that had a forecast cached, used to find the nearest one
+INDEX_KEY = 'weather_cells'
+
+# Earth radius Redis uses for GEO distances
+EARTH_RADIUS_KM = 6372.797560856
+
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+_BASE32_INDEX = {c: i for i, c in enumerate(_BASE32)}
+
+
+def snap(latitude, longitude):
+    if config.GRID_MODE == 'grid':
+        resolution = config.GRID_RESOLUTION_DEGREES
+        # Rounding again removes float noise such as 52.400000000000006 from the key
+        return round(round(latitude / resolution) * resolution, 6), round(round(longitude / resolution) * resolution, 6)
+    if config.GRID_MODE == 'geohash':
+        return geohash_decode(geohash_encode(latitude, longitude, config.GEOHASH_PRECISION))
+    return latitude, longitude
+
+
+def geohash_encode(latitude, longitude, precision):
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        # Bits alternate between longitude and latitude, starting with longitude
+        interval, coordinate = (lon_range, longitude) if even else (lat_range, latitude)
+        middle = (interval[0] + interval[1]) / 2
+        if coordinate >= middle:
+            value = value * 2 + 1
+            interval[0] = middle
+        else:
+            value = value * 2
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_BASE32[value])
+            bits = 0
+            value = 0
+    return ''.join(chars)
+
+
+def geohash_decode(geohash):
+    # Returns the center of the cell
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+    for c in geohash:
+        value = _BASE32_INDEX[c]
+        for shift in range(4, -1, -1):
+            interval = lon_range if even else lat_range
+            middle = (interval[0] + interval[1]) / 2
+            if value >> shift & 1:
+                interval[0] = middle
+            else:
+                interval[1] = middle
+            even = not even
+    return round((lat_range[0] + lat_range[1]) / 2, 6), round((lon_range[0] + lon_range[1]) / 2, 6)
+
+
+def index_cell(pipeline, latitude, longitude, key):
+    # Queued on the pipeline that stores the forecast, so indexing costs no extra round trip
+    if config.NEAREST_CELL_RADIUS_KM > 0:
+        pipeline.geoadd(INDEX_KEY, (longitude, latitude, key))
+
+
+def grid_spacing_km(latitude):
+    # Distance from a grid cell to its closest neighbour, the one east or west of it
+    resolution = math.radians(config.GRID_RESOLUTION_DEGREES)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.cos(math.radians(latitude)) * math.sin(resolution / 2))
+
+
+async def nearest_cell(nodes, latitude, longitude):
+    # Returns the cache key of the closest indexed cell within the configured radius, if any.
+    # Every cache node indexes the cells stored on it, so all of them are asked. A node that can't be
+    # reached is marked down and counts as having no cell nearby.
+    if config.NEAREST_CELL_RADIUS_KM <= 0:
+        return None
+    if config.GRID_MODE == 'grid' and config.NEAREST_CELL_RADIUS_KM < grid_spacing_km(latitude):
+        # No other cell is that close, at 0.1 degrees they are 11 km apart at the equator
+        return None
+
+    async def search(node):
+        try:
+            async with node.track() as redis_client:
+                return await redis_client.geosearch(
+                    INDEX_KEY, longitude=longitude, latitude=latitude,
+                    radius=config.NEAREST_CELL_RADIUS_KM, unit='km', sort='ASC', count=1, withdist=True,
+                )
+        except NODE_ERRORS:
+            return []
+
+    results = await asyncio.gather(*map(search, nodes))
+    nearest = min((match for matches in results for match in matches), key=lambda match: match[1], default=None)
+    if nearest is not None:
+        return nearest[0].decode()
+    return None
+
+
+async def forget_cell(node, key):
+    # Cells stay in the index after their cache entry expired, they are removed when found empty
+    # and by trim_index
+    try:
+        async with node.track() as redis_client:
+            await redis_client.zrem(INDEX_KEY, key)
+    except NODE_ERRORS:
+        pass
+
+
+async def trim_index(node, interval_seconds, batch_size=500):
+    # Removes the cells whose cache entry expired from the node's index every `interval_seconds`, so
+    # the index doesn't grow with every cell that was ever requested
+    while True:
+        await asyncio.sleep(interval_seconds)
+        if not node.available():
+            continue
+        try:
+            async with node.track() as redis_client:
+                # Pages by rank rather than with ZSCAN, which fakeredis can't run on a GEO set
+                start = 0
+                while True:
+                    keys = await redis_client.zrange(INDEX_KEY, start, start + batch_size - 1)
+                    if not keys:
+                        break
+                    async with redis_client.pipeline(transaction=False) as pipe:
+                        for key in keys:
+                            pipe.exists(key)
+                        exists = await pipe.execute()
+                    expired = [key for key, found in zip(keys, exists) if not found]
+                    if expired:
+                        await redis_client.zrem(INDEX_KEY, *expired)
+                    start += len(keys) - len(expired)
+        except NODE_ERRORS:
+            pass
@@ -0,0 +1,29 @@
+import os
+
+# gunicorn settings for start_workers.sh, one uvicorn worker per core:
+#
+#   WEATHER_WORKERS=4 gunicorn -c gunicorn.conf.py main:app
+
+bind = '0.0.0.0:8000'
+workers = int(os.environ.get('WEATHER_WORKERS', '1'))
+worker_class = 'uvicorn.workers.UvicornWorker'
+
+# The app is imported by each worker after the fork, not once in the master. Tracer and meter providers
+# start exporter threads and the gRPC channels of the exporters don't survive a fork, so they have to be
+# created in the process that uses them, just like the Redis connections and HTTP pools of the lifespan.
+preload_app = False
+
+# Give requests in flight, and the last batch of spans, time to finish on a restart
+graceful_timeout = 30
+
+
+def pre_fork(server, worker):
+    # Numbers the workers 0 to workers - 1. A worker that replaces a crashed one takes its number, so the
+    # worker.id resource attribute doesn't grow without bound like gunicorn's own worker.age does.
+    taken = {getattr(w, 'weather_worker_id', None) for w in server.WORKERS.values()}
+    worker.weather_worker_id = next(i for i in range(len(taken) + 1) if i not in taken)
+
+
+def post_fork(server, worker):
+    # Read by config.py when the worker imports the app
+    os.environ['WEATHER_WORKER_ID'] = str(worker.weather_worker_id)
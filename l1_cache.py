@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+
+from opentelemetry import metrics
+from redis.exceptions import ConnectionError
+
+# Creates a meter from the global meter provider
+meter = metrics.get_meter("my.meter.name")
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+hits_counter = meter.create_counter(
+    "l1_cache.hits", unit="1", description="Counts lookups answered by the in-process cache"
+)
+misses_counter = meter.create_counter(
+    "l1_cache.misses", unit="1", description="Counts lookups that had to go to Redis"
+)
+evictions_counter = meter.create_counter(
+    "l1_cache.evictions", unit="1", description="Counts entries removed from the in-process cache"
+)
+
+# Channel on which workers announce keys they have rewritten in Redis
+INVALIDATION_CHANNEL = 'weather_cache_invalidations'
+
+
+class L1Cache:
+    # Small in-process LRU cache with a TTL that sits in front of Redis.
+    # Other workers are told about rewritten keys through Redis pub/sub so their copies are dropped.
+
+    def __init__(self, name, max_size, ttl_seconds):
+        self.name = name
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        # Identifies this process so it can ignore its own invalidation messages
+        self.instance_id = '%s-%s' % (os.getpid(), uuid.uuid4().hex[:8])
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        if self.max_size <= 0:
+            return None
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                hits_counter.add(1, {"cache": self.name})
+                return value
+            del self._entries[key]
+            evictions_counter.add(1, {"cache": self.name, "reason": "expired"})
+        misses_counter.add(1, {"cache": self.name})
+        return None
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            evictions_counter.add(1, {"cache": self.name, "reason": "size"})
+
+    def invalidate(self, key):
+        if self._entries.pop(key, None) is not None:
+            evictions_counter.add(1, {"cache": self.name, "reason": "invalidated"})
+
+    def clear(self, matches=None):
+        # Drops every entry, or only the ones whose key `matches`
+        if matches is None:
+            keys = list(self._entries)
+        else:
+            keys = [key for key in self._entries if matches(key)]
+        for key in keys:
+            del self._entries[key]
+        if keys:
+            evictions_counter.add(len(keys), {"cache": self.name, "reason": "invalidated"})
+
+    def publish_invalidation(self, pipeline, key):
+        # Queued on the pipeline that writes the key, so other workers hear about it without an extra round trip
+        pipeline.publish(INVALIDATION_CHANNEL, self.instance_id + ' ' + key)
+
+    async def listen_for_invalidations(self, redis_client, owns=None, retry_seconds=1):
+        # Runs for the lifetime of the app, started as a background task in the lifespan for every cache
+        # node. Keys are announced on the node that stores them, `owns(key)` tells which keys those are.
+        subscribed = True
+        while True:
+            try:
+                async with redis_client.pubsub(ignore_subscribe_messages=True) as pubsub:
+                    await pubsub.subscribe(INVALIDATION_CHANNEL)
+                    subscribed = True
+                    async for message in pubsub.listen():
+                        sender, key = message['data'].decode().split(' ', 1)
+                        if sender != self.instance_id:
+                            self.invalidate(key)
+            except ConnectionError:
+                # Invalidations of this node's keys may have been missed while disconnected, those are
+                # dropped once. Retries of a node that stays down don't touch the other nodes' keys.
+                if subscribed:
+                    logger.error('Lost connection to the invalidation channel, retrying every %ss', retry_seconds)
+                    self.clear(owns)
+                    subscribed = False
+                await asyncio.sleep(retry_seconds)
@@ -0,0 +1,257 @@
+import argparse
+import asyncio
+import bisect
+import json
+import math
+import platform
+import random
+import time
+
+import httpx
+
+# Load generator for the /weather endpoint of main.py and part1-part5.
+#
+#   open loop    requests start at a fixed rate no matter how fast the service answers, latency is
+#                measured from the planned start so a stalled service can't hide its queueing delay
+#   closed loop  a fixed number of clients, each sends its next request when the previous one finished
+#
+# Latencies are recorded in a log-linear histogram (HDR style, about 1% precision) and broken down by the
+# X-Cache response header (hit, stale, miss) and by error type. Results are written as JSON so runs can
+# be compared over time, e.g.
+#
+#   python loadgen.py --mode open --rps 200 --duration 30 --distribution zipf --output results/main.json
+
+
+class Histogram:
+    # Log-linear histogram of integer values, here microseconds. Values below 2^SUB_BITS are exact,
+    # above that every power of two is split into 2^(SUB_BITS - 1) buckets.
+    SUB_BITS = 8
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, value):
+        value = max(int(value), 0)
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.min = value if self.min is None else min(self.min, value)
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0
+        target = max(1, math.ceil(self.count * percent / 100))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self._highest_value(index), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total / self.count / 1000, 3) if self.count else 0,
+            'min_ms': round((self.min or 0) / 1000, 3),
+            'max_ms': round(self.max / 1000, 3),
+            **{'p%s_ms' % str(p).replace('.', ''): round(self.percentile(p) / 1000, 3) for p in (50, 95, 99, 99.9)},
+        }
+
+    def _index(self, value):
+        exponent = max(value.bit_length() - self.SUB_BITS, 0)
+        return (exponent << self.SUB_BITS) + (value >> exponent)
+
+    def _highest_value(self, index):
+        exponent, sub = index >> self.SUB_BITS, index & ((1 << self.SUB_BITS) - 1)
+        return ((sub + 1) << exponent) - 1
+
+
+class Coordinates:
+    # Picks the coordinates of the next request. `keys` distinct locations are spread around the center,
+    # the distribution decides how often each one is asked for.
+
+    def __init__(self, distribution, keys, center, spread, zipf_s, jitter, seed):
+        self.distribution = distribution
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.locations = [
+            (round(center[0] + self.random.uniform(-spread, spread), 4),
+             round(center[1] + self.random.uniform(-spread, spread), 4))
+            for _ in range(keys)
+        ]
+        if distribution == 'zipf':
+            weights = [1 / (rank + 1) ** zipf_s for rank in range(keys)]
+            total = sum(weights)
+            self.cumulative = []
+            running = 0
+            for weight in weights:
+                running += weight / total
+                self.cumulative.append(running)
+
+    def next(self):
+        if self.distribution == 'hot':
+            latitude, longitude = self.locations[0]
+        elif self.distribution == 'zipf':
+            index = bisect.bisect_left(self.cumulative, self.random.random())
+            latitude, longitude = self.locations[min(index, len(self.locations) - 1)]
+        else:
+            latitude, longitude = self.random.choice(self.locations)
+        if self.jitter:
+            # GPS style noise on top of the location
+            latitude += self.random.uniform(-self.jitter, self.jitter)
+            longitude += self.random.uniform(-self.jitter, self.jitter)
+        return round(latitude, 6), round(longitude, 6)
+
+
+class Results:
+
+    def __init__(self):
+        self.all = Histogram()
+        self.by_cache = {}
+        self.by_error = {}
+        self.started = 0
+
+    def record(self, latency_us, cache_status=None, error=None):
+        self.all.record(latency_us)
+        if error is None:
+            self.by_cache.setdefault(cache_status or 'unknown', Histogram()).record(latency_us)
+        else:
+            self.by_error.setdefault(error, Histogram()).record(latency_us)
+
+
+async def send(client, path, coordinates, results, planned_start):
+    latitude, longitude = coordinates.next()
+    try:
+        response = await client.get(path, params={'latitude': latitude, 'longitude': longitude})
+    except httpx.TimeoutException:
+        results.record((time.perf_counter() - planned_start) * 1e6, error='timeout')
+        return
+    except httpx.HTTPError as e:
+        results.record((time.perf_counter() - planned_start) * 1e6, error=type(e).__name__)
+        return
+    latency_us = (time.perf_counter() - planned_start) * 1e6
+    if response.status_code == 200:
+        results.record(latency_us, cache_status=response.headers.get('x-cache'))
+    else:
+        results.record(latency_us, error='http_%d' % response.status_code)
+
+
+async def open_loop(client, args, coordinates, results):
+    interval = 1 / args.rps
+    in_flight = set()
+    skipped = 0
+    start = time.perf_counter()
+    sent = 0
+    while True:
+        planned = start + sent * interval
+        if planned - start >= args.duration:
+            break
+        delay = planned - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        sent += 1
+        if len(in_flight) >= args.max_in_flight:
+            # The service can't keep up, count the request instead of piling up unbounded tasks
+            skipped += 1
+            continue
+        task = asyncio.create_task(send(client, args.path, coordinates, results, planned))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+    await asyncio.gather(*in_flight)
+    return skipped
+
+
+async def closed_loop(client, args, coordinates, results):
+    deadline = time.perf_counter() + args.duration
+
+    async def worker():
+        while time.perf_counter() < deadline:
+            await send(client, args.path, coordinates, results, time.perf_counter())
+
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    return 0
+
+
+async def run(args):
+    center = tuple(float(v) for v in args.center.split(','))
+    coordinates = Coordinates(args.distribution, args.keys, center, args.spread, args.zipf_s, args.jitter, args.seed)
+    limits = httpx.Limits(max_connections=args.max_in_flight, max_keepalive_connections=args.max_in_flight)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=args.timeout) as client:
+        loop = open_loop if args.mode == 'open' else closed_loop
+        if args.warmup > 0:
+            warmup_args = argparse.Namespace(**{**vars(args), 'duration': args.warmup})
+            await loop(client, warmup_args, coordinates, Results())
+
+        results = Results()
+        started = time.perf_counter()
+        skipped = await loop(client, args, coordinates, results)
+        elapsed = time.perf_counter() - started
+
+    return {
+        'label': args.label,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'host': platform.node(),
+        'config': {k: v for k, v in vars(args).items() if k != 'output'},
+        'elapsed_s': round(elapsed, 3),
+        'requests': results.all.count,
+        'skipped': skipped,
+        'throughput_rps': round(results.all.count / elapsed, 2),
+        'latency': results.all.summary(),
+        'by_cache': {status: histogram.summary() for status, histogram in sorted(results.by_cache.items())},
+        'by_error': {error: histogram.summary() for error, histogram in sorted(results.by_error.items())},
+    }
+
+
+def print_report(report):
+    print('%s: %d requests in %.1fs, %.1f req/s, %d skipped' % (
+        report['label'], report['requests'], report['elapsed_s'], report['throughput_rps'], report['skipped']))
+    print('%-20s %8s %9s %9s %9s %9s %9s' % ('', 'count', 'mean', 'p50', 'p95', 'p99', 'p99.9'))
+    rows = [('all', report['latency'])]
+    rows += [('cache ' + k, v) for k, v in report['by_cache'].items()]
+    rows += [('error ' + k, v) for k, v in report['by_error'].items()]
+    for name, s in rows:
+        print('%-20s %8d %9.2f %9.2f %9.2f %9.2f %9.2f' % (
+            name, s['count'], s['mean_ms'], s['p50_ms'], s['p95_ms'], s['p99_ms'], s['p999_ms']))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Load generator for the weather service')
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--path', default='/weather')
+    parser.add_argument('--label', default='weather', help='name of the run in the results, e.g. main or part3')
+    parser.add_argument('--mode', choices=['open', 'closed'], default='closed')
+    parser.add_argument('--rps', type=float, default=100, help='request rate in open loop mode')
+    parser.add_argument('--concurrency', type=int, default=10, help='clients in closed loop mode')
+    parser.add_argument('--max-in-flight', type=int, default=1000, help='open loop requests in flight at most')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to measure')
+    parser.add_argument('--warmup', type=float, default=0, help='seconds to send load before measuring')
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--distribution', choices=['hot', 'zipf', 'uniform'], default='zipf')
+    parser.add_argument('--keys', type=int, default=100, help='number of distinct locations')
+    parser.add_argument('--zipf-s', type=float, default=1.1, help='skew of the zipf distribution')
+    parser.add_argument('--center', default='52.374,4.8897', help='latitude,longitude the locations are spread around')
+    parser.add_argument('--spread', type=float, default=2.0, help='degrees around the center')
+    parser.add_argument('--jitter', type=float, default=0.0, help='degrees of random noise per request')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+from opentelemetry import context, metrics, trace
+from opentelemetry.trace import NonRecordingSpan
+
+import config
+
+# Moves log formatting and export off the event loop. The handlers on the root logger (the OTLP
+# LoggingHandler opentelemetry-instrument installs, console handlers) are replaced by a QueueHandler
+# that only puts records on a bounded queue, a QueueListener thread hands them to the original handlers.
+#
+# The same message logged over and over, like 'Checking Redis for weather data' on every request, is
+# let through at most WEATHER_LOG_BURST times per WEATHER_LOG_WINDOW_SECONDS. What is held back is
+# reported as one summary record per message and window, so log volume stops growing with the request rate.
+
+# Creates a meter from the global meter provider
+meter = metrics.get_meter("my.meter.name")
+
+dropped_counter = meter.create_counter(
+    "logs.dropped", unit="1", description="Counts log records dropped because the log queue was full"
+)
+suppressed_counter = meter.create_counter(
+    "logs.suppressed", unit="1", description="Counts repeated log records replaced by a summary"
+)
+
+
+class RepeatSampler:
+    # Counts records per logger, level and message template in fixed windows. Called from the threads
+    # that log and from the listener thread, hence the lock.
+
+    def __init__(self, burst, window_seconds):
+        self.burst = burst
+        self.window_seconds = window_seconds
+        self._lock = threading.Lock()
+        # (logger name, level, template) -> [window start, records seen, example record]
+        self._windows = {}
+
+    def allow(self, record):
+        # Returns whether the record should be logged, and a summary record for the previous window if one is due
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+        summary = None
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.window_seconds:
+                if window is not None:
+                    summary = self._summary(window)
+                window = self._windows[key] = [now, 0, record]
+            window[1] += 1
+            allowed = window[1] <= self.burst
+        if not allowed:
+            suppressed_counter.add(1, {"logger": record.name})
+        return allowed, summary
+
+    def expired_summaries(self):
+        # Summaries of windows that ended without another record of their message arriving
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, window in self._windows.items() if now - window[0] >= self.window_seconds]
+            windows = [self._windows.pop(key) for key in expired]
+        return [summary for summary in map(self._summary, windows) if summary is not None]
+
+    def _summary(self, window):
+        started, seen, example = window
+        suppressed = seen - self.burst
+        if suppressed <= 0:
+            return None
+        return logging.makeLogRecord({
+            'name': example.name,
+            'levelno': example.levelno,
+            'levelname': example.levelname,
+            'pathname': example.pathname,
+            'lineno': example.lineno,
+            'msg': 'Suppressed %d more "%s" messages in the last %.0f seconds',
+            'args': (suppressed, example.msg, time.monotonic() - started),
+            'suppressed': suppressed,
+        })
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    # Runs on the logging thread: samples, remembers the current span and enqueues without formatting
+
+    def __init__(self, log_queue, sampler):
+        super().__init__(log_queue)
+        self.sampler = sampler
+
+    def emit(self, record):
+        try:
+            allowed, summary = self.sampler.allow(record)
+            if summary is not None:
+                self.enqueue(summary)
+            if allowed:
+                self.enqueue(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+    def prepare(self, record):
+        # The listener thread doesn't have the request's context, the OTLP handler reads the span from there
+        record.otel_span_context = trace.get_current_span().get_span_context()
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_counter.add(1, {"logger": record.name})
+
+
+class ContextQueueListener(logging.handlers.QueueListener):
+    # Hands records to the original handlers with the span that was current when they were logged
+
+    def __init__(self, log_queue, handlers, sampler):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.sampler = sampler
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(timeout=self.sampler.window_seconds)
+            except queue.Empty:
+                for summary in self.sampler.expired_summaries():
+                    self.handle(summary)
+
+    def handle(self, record):
+        span_context = getattr(record, 'otel_span_context', None)
+        if span_context is None or not span_context.is_valid:
+            super().handle(record)
+            return
+        token = context.attach(trace.set_span_in_context(NonRecordingSpan(span_context)))
+        try:
+            super().handle(record)
+        finally:
+            context.detach(token)
+
+    def stop(self):
+        if self._thread is None:
+            return
+        super().stop()
+        for summary in self.sampler.expired_summaries():
+            self.handle(summary)
+
+
+listener = None
+
+
+def setup_logging():
+    # Called in the telemetry phase of the app lifespan and on import of second_service.py, after
+    # opentelemetry-instrument and telemetry.setup_log_export have set up their handlers
+    global listener
+    if listener is not None or not config.LOG_QUEUE_SIZE:
+        return
+
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    if not handlers:
+        # Without handlers Python prints warnings and errors to stderr, keep doing that
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setLevel(logging.WARNING)
+        handlers = [handler]
+
+    log_queue = queue.Queue(maxsize=config.LOG_QUEUE_SIZE)
+    sampler = RepeatSampler(config.LOG_BURST, config.LOG_WINDOW_SECONDS)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(BoundedQueueHandler(log_queue, sampler))
+
+    listener = ContextQueueListener(log_queue, handlers, sampler)
+    listener.start()
+    # Registered after the OpenTelemetry shutdown hooks, so it runs before them and the last records are exported
+    atexit.register(listener.stop)
@@ -1,35 +1,146 @@
+import asyncio
+import json
+import os
 import random
+import time
+from contextlib import asynccontextmanager
+from typing import Annotated
 
-import requests
+import httpx
 import logging
-import redis
-from fastapi import FastAPI, HTTPException, Query
+import orjson
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
 from opentelemetry import trace
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
-from opentelemetry.instrumentation.requests import RequestsInstrumentor
-from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
+from opentelemetry.instrumentation.redis import RedisInstrumentor
+
+import cache_codec
+import config
+import deadline
+import export_pipeline
+import geo
+import log_pipeline
+import sampling
+import telemetry
+from aggregation import SummaryCache, SummaryOptions
+from cache_analytics import CacheAnalytics
+from cache_backend import NODE_ERRORS, CacheBackend
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from disk_cache import DiskCache
+from l1_cache import L1Cache
+from orchestration import run_concurrently
+from refresh import BackgroundRefresher
+from second_service_client import SecondServiceClient
+from singleflight import RedisSingleFlight, SingleFlight
+from stage_timing import exemplars, instrumented_route, stage
+from startup import StartupPhases, load_snapshot, save_snapshot
 
 from opentelemetry import metrics
-from opentelemetry.sdk.metrics import MeterProvider
-from opentelemetry.sdk.metrics.export import (
-    ConsoleMetricExporter,
-    PeriodicExportingMetricReader,
-)
-
-metric_reader = PeriodicExportingMetricReader(ConsoleMetricExporter())
-provider = MeterProvider(metric_readers=[metric_reader])
-
-# Sets the global default meter provider
-metrics.set_meter_provider(provider)
 
 # Creates a meter from the global meter provider
 meter = metrics.get_meter("my.meter.name")
 
-# Create FastAPI app
-app = FastAPI()
+# Shared clients, created once per process in the app lifespan
+http_client = None
+# The Redis nodes the cache is sharded over, see cache_backend.py
+redis_cache = None
+# Recent forecasts on local disk, served while Redis misses them or is unreachable
+disk_cache = None
+# Kept-alive, hedged calls of the second service and its replicas
+second_service = SecondServiceClient(config.SECOND_SERVICE_URLS)
+
+# Hot coordinates are answered from memory before going to Redis
+l1_cache = L1Cache("weather", config.L1_CACHE_SIZE, config.L1_CACHE_TTL_SECONDS)
+
+# Serialized summaries of POST /weather/aggregate, per cache entry version and options
+summary_cache = SummaryCache(config.AGGREGATE_CACHE_SIZE)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global http_client, redis_cache, disk_cache
+    # Everything that starts threads or opens connections happens here, in the process that serves
+    # the requests, and each phase is timed. See GET /health/ready.
+    startup_phases.begin()
+    with startup_phases.phase("telemetry"):
+        setup_telemetry()
+    with startup_phases.phase("http_clients"):
+        # One pooled HTTP client for all upstream calls, connections are kept alive between requests
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30),
+            timeout=httpx.Timeout(10.0),
+        )
+        await second_service.start()
+    with startup_phases.phase("redis"):
+        # Set WEATHER_REDIS_URLS if your Redis servers don't run on localhost:6379, every node gets its own pool
+        redis_cache = CacheBackend(config.REDIS_URLS, vnodes=config.CACHE_VNODES,
+                                   retry_seconds=config.CACHE_NODE_RETRY_SECONDS)
+        unreachable = await redis_cache.ping()
+        if unreachable:
+            # Their keys go to the other nodes until they are back
+            logger.error('Cache nodes not reachable at startup: %s', ', '.join(unreachable))
+    if config.DISK_CACHE_DIR:
+        with startup_phases.phase("disk_cache"):
+            # Workers don't share segment files, each appends to its own
+            disk_cache = DiskCache(os.path.join(config.DISK_CACHE_DIR, 'worker-%d' % config.WORKER_ID),
+                                   max_bytes=config.DISK_CACHE_MAX_BYTES, segment_bytes=config.DISK_CACHE_SEGMENT_BYTES)
+            disk_cache.open()
+        background_syncs = [asyncio.create_task(disk_cache.sync_periodically(config.DISK_CACHE_FSYNC_SECONDS))]
+    else:
+        background_syncs = []
+    # Drops local copies of keys that other workers rewrite, they are announced on the node of the key
+    invalidation_listeners = [
+        asyncio.create_task(l1_cache.listen_for_invalidations(
+            node.client, owns=lambda key, node=node: redis_cache.owner(key) is node, retry_seconds=node.retry_seconds,
+        ))
+        for node in redis_cache.nodes
+    ]
+    # Removes expired cells from the index of the nearest cell lookup
+    index_trims = [
+        asyncio.create_task(geo.trim_index(node, config.NEAREST_CELL_TRIM_SECONDS))
+        for node in redis_cache.nodes if config.NEAREST_CELL_RADIUS_KM > 0
+    ]
+    refresher.start()
+    # Runs while the server already accepts requests, readiness waits for it
+    background = [asyncio.create_task(prewarm_cache()), asyncio.create_task(snapshot_accesses())]
+    yield
+    for task in background + invalidation_listeners + index_trims + background_syncs:
+        task.cancel()
+    save_access_snapshot()
+    await refresher.stop()
+    await http_client.aclose()
+    await second_service.aclose()
+    await redis_cache.aclose()
+    if disk_cache is not None:
+        disk_cache.close()
+
+
+def setup_telemetry():
+    # Sets the global default meter provider, unless opentelemetry-instrument already did. Instruments
+    # created on import of the modules record through it from now on.
+    telemetry.setup_metrics()
+
+    # Set up the TracerProvider and span export, with tail sampling when a trace budget is configured
+    telemetry.setup_tracing()
+
+    # Instrument HTTPX and Redis, before the clients are created
+    HTTPXClientInstrumentor().instrument()
+    RedisInstrumentor().instrument()
+
+    # Export log records through the bounded queue of export_pipeline.py
+    telemetry.setup_log_export()
+
+    # Format and export log records on a background thread
+    log_pipeline.setup_logging()
+
+    logger.info("hello from startup")
+
 
-# Set up the TracerProvider
-trace.set_tracer_provider(TracerProvider())
+# Create FastAPI app
+app = FastAPI(lifespan=lifespan)
 
 # Creates a tracer from the global tracer provider
 tracer = trace.get_tracer("open-telemetry.example")
@@ -38,28 +149,45 @@ tracer = trace.get_tracer("open-telemetry.example")
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-# Instrument FastAPI
+# Instrument FastAPI. This adds a middleware, which has to happen before the app starts, the spans go
+# to the tracer provider set up in the lifespan
 FastAPIInstrumentor.instrument_app(app)
-RequestsInstrumentor().instrument()
 
-# Connect to Redis
-# Replace 'localhost' and '6379' with your Redis server's host and port if different
-redis_client = redis.Redis(host='localhost', port=6379, db=0)
+# Durations of the startup phases and whether the cache is warm, served on GET /health/ready
+startup_phases = StartupPhases()
 
-logger.info("hello from startup")
 
 
+# Key popularity and how well the TTL fits the traffic, served on GET /admin/cache/analytics
+cache_analytics = CacheAnalytics(meter)
 
 exceptions_raised_counter = meter.create_counter(
     "exceptions.raised", unit="1", description="Counts the amount of exceptions raised"
 )
 
+# Stops calling Open-Meteo while it keeps failing, cached forecasts are served instead
+open_meteo_breaker = CircuitBreaker(
+    "open_meteo",
+    window_seconds=config.BREAKER_WINDOW_SECONDS,
+    min_calls=config.BREAKER_MIN_CALLS,
+    error_ratio=config.BREAKER_ERROR_RATIO,
+    slow_ms=config.BREAKER_SLOW_MS,
+    slow_ratio=config.BREAKER_SLOW_RATIO,
+    open_seconds=config.BREAKER_OPEN_SECONDS,
+    # Running out of a request's time budget says nothing about Open-Meteo
+    abandoned=(deadline.DeadlineExceeded,),
+)
+
+# Cache misses for the same coordinates share one Open-Meteo fetch, inside this process or across workers
+open_meteo_flight = SingleFlight("open_meteo")
+open_meteo_redis_flight = RedisSingleFlight("open_meteo")
 
-def maybe_raise_random_error():
+
+async def maybe_raise_random_error():
     # This creates a new span that's the child of the current one
-    with tracer.start_as_current_span("maybe_raise_random_error") as span:
+    with stage("maybe_raise_random_error") as span:
         if random.random() < 0.5:
-            exceptions_raised_counter.add(1, {"exception.type": HTTPException})
+            exceptions_raised_counter.add(1, {"exception.type": "HTTPException"})
             logger.error('Random error occurred')
             # Return an error response 50% of the time
             raise HTTPException(status_code=500, detail='Random error occurred')
@@ -69,25 +197,126 @@ def get_redis_key(latitude, longitude):
     return 'weather_data_' + str(latitude) + '_' + str(longitude)
 
 
-def get_data_from_redis(latitude, longitude):
-    with tracer.start_as_current_span("get_data_from_redis") as span:
-        logger.info('Checking Redis for weather data')
+def get_coordinates(redisKey):
+    # Inverse of get_redis_key
+    latitude, longitude = redisKey[len('weather_data_'):].split('_')
+    return float(latitude), float(longitude)
+
+
+def get_fallback_key(redisKey):
+    # Long-lived copy of the last good forecast, served while the Open-Meteo circuit is open
+    return 'fallback_' + redisKey
+
+
+async def get_data_from_redis(latitude, longitude):
+    with stage("get_data_from_redis") as span:
         redisKey = get_redis_key(latitude, longitude)
-        redisData = redis_client.get(redisKey)
+        forecast = l1_cache.get(redisKey)
+        if forecast is not None:
+            span.set_attribute("cache.layer", "l1")
+            return forecast
+
+        logger.info('Checking Redis for weather data')
+        try:
+            async with deadline.budget(span, "get_data_from_redis"):
+                node = redis_cache.node_for(redisKey)
+                span.set_attribute("cache.node", node.name)
+                async with node.track() as redis_client:
+                    redisData = await redis_client.get(redisKey)
+                # The key the data is cached under, the neighbour's if it comes from the nearest cell
+                dataKey = redisKey
+                if redisData is None:
+                    # Fall back to the closest cell that has a forecast cached
+                    nearestKey = await geo.nearest_cell(redis_cache.available_nodes(), latitude, longitude)
+                    if nearestKey is not None and nearestKey != redisKey:
+                        try:
+                            redisData = await redis_cache.get(nearestKey)
+                        except NODE_ERRORS:
+                            # Only a better answer than a miss, the node is skipped from now on
+                            redisData = None
+                        else:
+                            if redisData is None:
+                                await geo.forget_cell(redis_cache.node_for(nearestKey), nearestKey)
+                            else:
+                                span.set_attribute("cache.nearest_cell", nearestKey)
+                                dataKey = nearestKey
+        except NODE_ERRORS:
+            # Redis is unreachable, a forecast kept on disk is served as stale like while Open-Meteo is down.
+            # Without one it is a miss, the forecast is fetched and kept on disk and in memory only.
+            span.set_attribute("cache.redis_unavailable", True)
+            redisData = get_from_disk(redisKey, config.DISK_CACHE_MAX_AGE_SECONDS)
+            if redisData is None:
+                return None
+            span.set_attribute("cache.layer", "disk")
+            return decode_cached(redisKey, redisData)
         if redisData is not None:
             logger.info('Found weather data in Redis')
-            return redisData
+            span.set_attribute("cache.layer", "redis")
+            return decode_cached(dataKey, redisData)
 
+        # Redis lost the entry, e.g. in a restart. The copy on disk is good for as long as Redis would have kept it.
+        redisData = get_from_disk(redisKey, config.CACHE_HARD_TTL_SECONDS)
+        if redisData is not None:
+            span.set_attribute("cache.layer", "disk")
+            return decode_cached(redisKey, redisData)
 
-def store_data_in_redis(latitude, longitude, data):
-    with tracer.start_as_current_span("store_data_in_redis") as span:
-        logger.info('Storing weather data in Redis')
-        redisKey = get_redis_key(latitude, longitude)
-        redis_client.set(redisKey, str(data), ex=4)
 
+def get_from_disk(redisKey, maxAgeSeconds):
+    if disk_cache is None:
+        return None
+    return disk_cache.get(redisKey, maxAgeSeconds)
 
-def fetch_data_from_open_meteo(latitude, longitude):
-    with tracer.start_as_current_span("fetch_data_from_open_meteo") as span:
+
+def decode_cached(redisKey, redisData):
+    try:
+        forecast = cache_codec.decode(redisData)
+    except cache_codec.CacheFormatError as e:
+        # Written by an older version of the service, treat it as a miss
+        logger.info('Ignoring unreadable cache entry %s: %s', redisKey, e)
+        return None
+    l1_cache.set(redisKey, forecast)
+    return forecast
+
+
+async def store_data_in_redis(latitude, longitude, data):
+    with stage("store_data_in_redis") as span:
+        logger.info('Storing weather data in Redis')
+        # Not cut short by the request's deadline, the forecast is worth keeping for the next request
+        redisKey = get_redis_key(latitude, longitude)
+        value, forecast = keep_locally(redisKey, data)
+        node = redis_cache.node_for(redisKey)
+        span.set_attribute("cache.node", node.name)
+        try:
+            async with node.track() as redis_client, redis_client.pipeline(transaction=False) as pipe:
+                queue_store(pipe, latitude, longitude, value)
+                await pipe.execute()
+        except NODE_ERRORS:
+            # The forecast is still answered, and kept on disk and in memory until Redis is back
+            span.set_attribute("cache.redis_unavailable", True)
+        return forecast
+
+
+def keep_locally(redisKey, data):
+    # Encodes a fetched forecast and keeps it on disk and in the L1 cache, returns the value for Redis and the forecast
+    value = cache_codec.encode(data, compress=config.CACHE_COMPRESSION, encodings=config.CACHE_RESPONSE_BODIES)
+    if disk_cache is not None:
+        disk_cache.put(redisKey, value)
+    forecast = cache_codec.decode(value)
+    l1_cache.set(redisKey, forecast)
+    return value, forecast
+
+
+def queue_store(pipe, latitude, longitude, value):
+    # Queues everything that belongs to storing one encoded forecast in Redis on a pipeline
+    redisKey = get_redis_key(latitude, longitude)
+    pipe.set(redisKey, value, ex=config.CACHE_HARD_TTL_SECONDS)
+    pipe.set(get_fallback_key(redisKey), value, ex=config.FALLBACK_TTL_SECONDS)
+    geo.index_cell(pipe, latitude, longitude, redisKey)
+    l1_cache.publish_invalidation(pipe, redisKey)
+
+
+async def fetch_data_from_open_meteo(latitude, longitude):
+    with stage("fetch_data_from_open_meteo") as span:
         logger.info('Fetching weather data from Open-Meteo')
         # Define the parameters for your request here
         params = {
@@ -96,21 +325,100 @@ def fetch_data_from_open_meteo(latitude, longitude):
             'hourly': 'temperature_2m'
         }
 
-        # Make a GET request to the Open-Meteo API using requests
-        response = requests.get('https://api.open-meteo.com/v1/forecast', params=params)
+        # Make a GET request to the Open-Meteo API using the shared HTTP client
+        async with open_meteo_breaker.guard(span):
+            async with deadline.budget(span, "fetch_data_from_open_meteo"):
+                response = await http_client.get(config.OPEN_METEO_URL, params=params)
 
-        logger.info('Received response from Open-Meteo %s', response)
-        if response.status_code == 200:
-            return response.json()
-        else:
-            # Handle errors
-            raise HTTPException(status_code=500, detail='Failed to fetch data from Open-Meteo')
+            logger.info('Received response from Open-Meteo %s', response)
+            if response.status_code != 200:
+                # Handle errors
+                raise HTTPException(status_code=500, detail='Failed to fetch data from Open-Meteo')
+        return response.json()
 
 
-def request_second_service_http_request():
-    with tracer.start_as_current_span("request_second_service_http_request") as span:
+async def fetch_many_from_open_meteo(locations):
+    with stage("fetch_many_from_open_meteo") as span:
+        span.set_attribute("locations", len(locations))
+        logger.info('Fetching weather data for %d locations from Open-Meteo', len(locations))
+        # Open-Meteo accepts comma separated coordinates and answers with one forecast per location
+        params = {
+            'latitude': ','.join(str(latitude) for latitude, _ in locations),
+            'longitude': ','.join(str(longitude) for _, longitude in locations),
+            'hourly': 'temperature_2m'
+        }
+        async with open_meteo_breaker.guard(span):
+            response = await http_client.get(config.OPEN_METEO_URL, params=params)
+
+            logger.info('Received response from Open-Meteo %s', response)
+            if response.status_code != 200:
+                raise HTTPException(status_code=500, detail='Failed to fetch data from Open-Meteo')
+        data = response.json()
+        # A single location comes back as an object instead of a list
+        return data if isinstance(data, list) else [data]
+
+
+async def get_many_from_redis(keys):
+    # Looks up many cache keys with one MGET per cache node, returns the forecasts found by key
+    with stage("get_many_from_redis") as span:
+        found = {}
+        for redisKey in keys:
+            forecast = l1_cache.get(redisKey)
+            if forecast is not None:
+                found[redisKey] = forecast
+        missing = [redisKey for redisKey in keys if redisKey not in found]
+        if missing:
+            values, unreachable = await redis_cache.mget(missing)
+            if unreachable:
+                # Keys of an unreachable node are served from disk if kept there, the rest are misses,
+                # see get_data_from_redis. The other nodes' values are used as usual.
+                span.set_attribute("cache.redis_unavailable", True)
+            for index, (redisKey, redisData) in enumerate(zip(missing, values)):
+                if redisData is None:
+                    redisData = get_from_disk(redisKey, config.DISK_CACHE_MAX_AGE_SECONDS if index in unreachable
+                                              else config.CACHE_HARD_TTL_SECONDS)
+                if redisData is not None:
+                    forecast = decode_cached(redisKey, redisData)
+                    if forecast is not None:
+                        found[redisKey] = forecast
+        span.set_attributes({"keys": len(keys), "cache.hits": len(found)})
+        return found
+
+
+async def store_many_in_redis(locations, data):
+    with stage("store_many_in_redis") as span:
+        span.set_attribute("locations", len(locations))
+        forecasts = [None] * len(locations)
+
+        # One pipeline per cache node, run concurrently
+        async def store_on(node, indexes):
+            values = []
+            for index in indexes:
+                latitude, longitude = locations[index]
+                value, forecasts[index] = keep_locally(get_redis_key(latitude, longitude), data[index])
+                values.append(value)
+            try:
+                async with node.track() as redis_client, redis_client.pipeline(transaction=False) as pipe:
+                    for index, value in zip(indexes, values):
+                        queue_store(pipe, *locations[index], value)
+                    await pipe.execute()
+            except NODE_ERRORS:
+                # Kept on disk and in memory only, see store_data_in_redis
+                span.set_attribute("cache.redis_unavailable", True)
+
+        groups = redis_cache.group([get_redis_key(latitude, longitude) for latitude, longitude in locations])
+        span.set_attribute("cache.nodes", len(groups))
+        await asyncio.gather(*(store_on(node, indexes) for node, indexes in groups.items()))
+        return forecasts
+
+
+async def request_second_service_http_request():
+    with stage("request_second_service_http_request") as span:
         logger.info('Requesting second service')
-        response = requests.get('http://localhost:8001/test')
+        # The second service makes the same sampling decision for this trace
+        with sampling.propagate_ratio():
+            async with deadline.budget(span, "request_second_service_http_request"):
+                response = await second_service.get()
         logger.info('Received response from second service %s', response)
         if response.status_code == 200:
             return response.json()
@@ -120,18 +428,343 @@ def request_second_service_http_request():
 
 
 @app.get('/weather')
-async def get_weather(latitude: float = Query(..., description="Latitude of the location"),
+@instrumented_route('/weather', ['run_concurrently', 'maybe_raise_random_error', 'request_second_service_http_request',
+                                 'get_data_from_redis', 'fetch_data_from_open_meteo', 'store_data_in_redis'])
+@deadline.with_deadline
+async def get_weather(request: Request,
+                      latitude: float = Query(..., description="Latitude of the location"),
                       longitude: float = Query(..., description="Longitude of the location")):
-    maybe_raise_random_error()
-
-    request_second_service_http_request()
-
-    redisData = get_data_from_redis(latitude, longitude)
-    if redisData is not None:
-        return redisData
-
-    data = fetch_data_from_open_meteo(latitude, longitude)
-
-    store_data_in_redis(latitude, longitude, data)
-
-    return data
+    # Nearby coordinates share one cache entry and one upstream request
+    latitude, longitude = geo.snap(latitude, longitude)
+    trace.get_current_span().set_attributes({"weather.latitude": latitude, "weather.longitude": longitude})
+
+    # The random error, the second service and the cache lookup don't depend on each other,
+    # so they run concurrently and the first failure cancels the rest
+    results = await run_concurrently({
+        'maybe_raise_random_error': maybe_raise_random_error(),
+        'request_second_service_http_request': request_second_service_http_request(),
+        'get_data_from_redis': get_data_from_redis(latitude, longitude),
+    })
+
+    forecast = results['get_data_from_redis']
+    cacheStatus = 'hit'
+    if forecast is None:
+        cacheStatus = 'miss'
+        try:
+            forecast = await fetch_data_once(latitude, longitude)
+        except CircuitOpenError:
+            # Open-Meteo keeps failing, the last good forecast is better than an error
+            forecast = await get_fallback_from_redis(latitude, longitude)
+            cacheStatus = 'stale'
+    elif not is_fresh(forecast):
+        # Past the soft TTL: answer right away and let a background task fetch a new forecast
+        cacheStatus = 'stale'
+        refresher.serve_stale(get_redis_key(latitude, longitude), latitude, longitude, forecast.fetched_at)
+
+    trace.get_current_span().set_attribute("cache.status", cacheStatus)
+    refresher.record_access(get_redis_key(latitude, longitude), latitude, longitude, forecast.fetched_at)
+    cache_analytics.record(get_redis_key(latitude, longitude), cacheStatus, forecast.fetched_at)
+    return forecast_response(request, forecast, cacheStatus)
+
+
+async def get_fallback_from_redis(latitude, longitude):
+    with stage("get_fallback_from_redis") as span:
+        redisKey = get_redis_key(latitude, longitude)
+        # Stored on the node of the forecast's key
+        try:
+            async with redis_cache.node_for(redisKey).track() as redis_client:
+                redisData = await redis_client.get(get_fallback_key(redisKey))
+        except NODE_ERRORS:
+            redisData = None
+        if redisData is None:
+            redisData = get_from_disk(redisKey, config.DISK_CACHE_MAX_AGE_SECONDS)
+        forecast = None
+        if redisData is not None:
+            try:
+                forecast = cache_codec.decode(redisData)
+            except cache_codec.CacheFormatError:
+                pass
+        span.set_attribute("cache.fallback", forecast is not None)
+        if forecast is None:
+            raise HTTPException(status_code=503, detail='Open-Meteo is unavailable and no forecast is cached')
+        return forecast
+
+
+def is_fresh(forecast):
+    return time.time() - forecast.fetched_at < config.CACHE_SOFT_TTL_SECONDS
+
+
+def forecast_response(request, forecast, cacheStatus):
+    # Clients that understand the cache format get the cached bytes without any re-encoding,
+    # everyone else gets the same JSON document Open-Meteo returned, for hits and misses alike.
+    # The JSON body and its compressed variants are made once when the forecast is stored, so
+    # answering a request only picks the one the client accepts.
+    # X-Cache tells load tests and clients whether the forecast came from the cache.
+    headers = {'X-Cache': cacheStatus, 'Vary': 'Accept, Accept-Encoding'}
+    if cache_codec.MEDIA_TYPE in request.headers.get('accept', ''):
+        return Response(content=forecast.raw, media_type=cache_codec.MEDIA_TYPE, headers=headers)
+    encoding = negotiate_encoding(request.headers.get('accept-encoding', ''), forecast.bodies)
+    if encoding == 'identity':
+        return Response(content=forecast.json_body(), media_type='application/json', headers=headers)
+    headers['Content-Encoding'] = encoding
+    return Response(content=bytes(forecast.bodies[encoding]), media_type='application/json', headers=headers)
+
+
+def negotiate_encoding(acceptEncoding, available):
+    # Picks brotli or gzip if the client accepts it and the body is available in it, preferring brotli
+    accepted = {}
+    for part in acceptEncoding.split(','):
+        name, _, params = part.partition(';')
+        params = params.strip()
+        quality = 1.0
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    best, bestQuality = 'identity', 0.0
+    for encoding in ('br', 'gzip'):
+        quality = accepted.get(encoding, accepted.get('*', 0.0))
+        if encoding in available and quality > bestQuality:
+            best, bestQuality = encoding, quality
+    return best
+
+
+async def fetch_data_once(latitude, longitude, replaces=None):
+    # `replaces` is the fetched_at of a cached forecast being refreshed, only a newer one is good enough
+    async def fetch_and_store():
+        data = await fetch_data_from_open_meteo(latitude, longitude)
+        return await store_data_in_redis(latitude, longitude, data)
+
+    async def fetched_by_other_worker():
+        forecast = await get_data_from_redis(latitude, longitude)
+        if forecast is not None and is_fresh(forecast) and (replaces is None or forecast.fetched_at > replaces):
+            return forecast
+
+    # Don't take the fetch lock for a call the circuit breaker is going to reject anyway
+    if not open_meteo_breaker.allows_calls():
+        raise CircuitOpenError(open_meteo_breaker.name)
+
+    redisKey = get_redis_key(latitude, longitude)
+    if config.SINGLEFLIGHT_REDIS_LOCK:
+        # Without a reachable node the lock isn't taken and only fetches inside this process are coalesced
+        node = redis_cache.node_for(redisKey)
+        return await open_meteo_redis_flight.do(node, redisKey, fetch_and_store, fetched_by_other_worker)
+    return await open_meteo_flight.do(redisKey, fetch_and_store)
+
+
+# Refreshes stale and hot forecasts off the request path
+refresher = BackgroundRefresher(fetch_data_once)
+
+
+
+class Location(BaseModel):
+    latitude: float
+    longitude: float
+
+
+class BatchRequest(BaseModel):
+    locations: list[Location] = Field(..., min_length=1, max_length=config.BATCH_MAX_LOCATIONS)
+
+
+@app.post('/weather/batch')
+async def get_weather_batch(batch: BatchRequest):
+    # Cached forecasts are looked up with one MGET, all misses are fetched with one Open-Meteo request
+    # and stored with one pipeline. Results are streamed as newline delimited JSON as soon as they are
+    # ready, each line carries the index of the location in the request.
+    cells = [geo.snap(location.latitude, location.longitude) for location in batch.locations]
+    keys = [get_redis_key(latitude, longitude) for latitude, longitude in cells]
+    found = await get_many_from_redis(list(dict.fromkeys(keys)))
+
+    return StreamingResponse(stream_batch(cells, keys, found), media_type='application/x-ndjson')
+
+
+async def stream_batch(cells, keys, found):
+    misses = {}
+    for index, (redisKey, (latitude, longitude)) in enumerate(zip(keys, cells)):
+        forecast = found.get(redisKey)
+        if forecast is None:
+            misses.setdefault(redisKey, []).append(index)
+            continue
+        if not is_fresh(forecast):
+            refresher.serve_stale(redisKey, latitude, longitude, forecast.fetched_at)
+        refresher.record_access(redisKey, latitude, longitude, forecast.fetched_at)
+        yield forecast_line(index, forecast)
+
+    if not misses:
+        return
+
+    locations = [cells[indexes[0]] for indexes in misses.values()]
+    try:
+        data = await fetch_many_from_open_meteo(locations)
+        if len(data) != len(locations):
+            raise HTTPException(status_code=500, detail='Open-Meteo returned a different number of locations')
+        forecasts = await store_many_in_redis(locations, data)
+    except Exception as e:
+        # The status code is already sent, whatever failed is reported on the lines of the affected locations
+        logger.error('Fetching %d locations of a batch failed: %r', len(locations), e)
+        error = batch_error(e)
+        for indexes in misses.values():
+            for index in indexes:
+                yield batch_line(index, error=error)
+        return
+
+    for indexes, forecast in zip(misses.values(), forecasts):
+        for index in indexes:
+            yield forecast_line(index, forecast)
+
+
+def batch_error(e):
+    # Message for the locations of a batch that couldn't be fetched
+    if isinstance(e, HTTPException):
+        return e.detail
+    if isinstance(e, CircuitOpenError):
+        return str(e)
+    return 'Failed to fetch the forecast: %s' % type(e).__name__
+
+
+def batch_line(index, **fields):
+    return json.dumps({'index': index, **fields}) + '\n'
+
+
+def forecast_line(index, forecast):
+    # Same as batch_line(index, forecast=...), with the stored JSON body pasted in instead of re-encoded
+    return b'{"index":%d,"forecast":%s}\n' % (index, forecast.json_body())
+
+
+class AggregateRequest(BaseModel):
+    locations: list[Location] = Field(..., min_length=1, max_length=config.BATCH_MAX_LOCATIONS)
+    rolling_hours: int = Field(0, ge=0, le=168, description="Window of the rolling mean in hours, 0 leaves it out")
+    percentiles: list[Annotated[float, Field(ge=0, le=100)]] = Field([10, 50, 90], max_length=20)
+    anomaly_z: float = Field(3.0, ge=0, description="Standard deviations that make an hour an anomaly, 0 leaves them out")
+    threshold: float | None = Field(None, description="Temperature whose crossings are reported")
+
+
+@app.post('/weather/aggregate')
+async def aggregate_weather(request: AggregateRequest):
+    # Summaries of the hourly temperatures instead of the series itself, see aggregation.py. They are
+    # computed from the cache entries and memoized per entry version, so a summary of a cached
+    # forecast is mostly a lookup. Locations missing from the cache are fetched as in /weather/batch.
+    options = SummaryOptions(request.rolling_hours, request.percentiles, request.anomaly_z, request.threshold)
+    cells = [geo.snap(location.latitude, location.longitude) for location in request.locations]
+    keys = [get_redis_key(latitude, longitude) for latitude, longitude in cells]
+    found = await get_many_from_redis(list(dict.fromkeys(keys)))
+
+    error = None
+    misses = {redisKey: cell for redisKey, cell in zip(keys, cells) if redisKey not in found}
+    if misses:
+        try:
+            data = await fetch_many_from_open_meteo(list(misses.values()))
+            if len(data) != len(misses):
+                raise HTTPException(status_code=500, detail='Open-Meteo returned a different number of locations')
+            found.update(zip(misses, await store_many_in_redis(list(misses.values()), data)))
+        except Exception as e:
+            # Reported on the affected locations, the others are still answered
+            logger.error('Fetching %d locations of an aggregate failed: %r', len(misses), e)
+            error = batch_error(e)
+
+    with stage("aggregate_forecasts") as span:
+        items = []
+        for index, (redisKey, (latitude, longitude)) in enumerate(zip(keys, cells)):
+            forecast = found.get(redisKey)
+            if forecast is None:
+                items.append(orjson.dumps({'index': index, 'latitude': latitude, 'longitude': longitude, 'error': error}))
+                continue
+            if not is_fresh(forecast):
+                refresher.serve_stale(redisKey, latitude, longitude, forecast.fetched_at)
+            refresher.record_access(redisKey, latitude, longitude, forecast.fetched_at)
+            items.append(b'{"index":%d,"latitude":%s,"longitude":%s,"fetched_at":%s,"summary":%s}' % (
+                index, orjson.dumps(latitude), orjson.dumps(longitude), orjson.dumps(forecast.fetched_at),
+                summary_cache.get(redisKey, forecast, options),
+            ))
+        span.set_attributes({"locations": len(keys), "locations.fetched": len(misses)})
+    return Response(content=b'[' + b','.join(items) + b']', media_type='application/json')
+
+
+@app.get('/metrics/exemplars')
+async def get_exemplars():
+    # The slowest recent sample per stage.duration bucket with its trace ID, see stage_timing.Exemplars
+    return exemplars.snapshot()
+
+
+@app.get('/admin/cache/analytics')
+async def get_cache_analytics():
+    return cache_analytics.report()
+
+
+@app.get('/admin/telemetry/export')
+async def get_telemetry_export():
+    # Depth, drops and exports of the span and log record export queues of this worker
+    return export_pipeline.report()
+
+
+@app.get('/health/ready')
+async def get_readiness():
+    # 503 until the cache is pre-warmed, so a load balancer only sends traffic to a warm instance
+    return JSONResponse(startup_phases.report(), status_code=200 if startup_phases.ready else 503)
+
+
+# Only one worker fetches the snapshot's forecasts, the others wait for it and read them from Redis
+PREWARM_LOCK_KEY = 'prewarm_lock'
+
+
+async def prewarm_cache():
+    # Fetches forecasts for the most requested coordinates of the last snapshot that aren't cached and
+    # fresh, so the first requests after a deploy or restart don't all go to Open-Meteo
+    locations = load_snapshot(config.PREWARM_SNAPSHOT_PATH, config.PREWARM_TOP_N)
+    try:
+        with startup_phases.phase("prewarm") as span:
+            span.set_attribute("prewarm.locations", len(locations))
+            if locations:
+                async with asyncio.timeout(config.PREWARM_TIMEOUT_SECONDS):
+                    fetched = await prewarm_locations(locations)
+                span.set_attribute("prewarm.fetched", fetched)
+                logger.info('Pre-warmed the cache for %d locations, %d fetched', len(locations), fetched)
+    except TimeoutError:
+        logger.warning('Cache pre-warming took longer than %ss, reporting ready anyway', config.PREWARM_TIMEOUT_SECONDS)
+    except Exception as e:
+        # A cold cache is slower, not broken
+        logger.error('Cache pre-warming failed: %s', e)
+    finally:
+        startup_phases.finish()
+
+
+async def prewarm_locations(locations):
+    redis_client = redis_cache.node_for(PREWARM_LOCK_KEY).client
+    locked = await redis_client.set(PREWARM_LOCK_KEY, l1_cache.instance_id, nx=True,
+                                    ex=max(int(config.PREWARM_TIMEOUT_SECONDS), 1))
+    try:
+        if not locked:
+            while await redis_client.exists(PREWARM_LOCK_KEY):
+                await asyncio.sleep(0.1)
+        keys = [get_redis_key(latitude, longitude) for latitude, longitude in locations]
+        found = await get_many_from_redis(keys)
+        missing = [location for location, redisKey in zip(locations, keys)
+                   if redisKey not in found or not is_fresh(found[redisKey])]
+        # As many locations per Open-Meteo request as the batch endpoint sends
+        for start in range(0, len(missing), config.BATCH_MAX_LOCATIONS):
+            chunk = missing[start:start + config.BATCH_MAX_LOCATIONS]
+            data = await fetch_many_from_open_meteo(chunk)
+            await store_many_in_redis(chunk, data)
+        return len(missing)
+    finally:
+        if locked:
+            await redis_client.delete(PREWARM_LOCK_KEY)
+
+
+def save_access_snapshot():
+    try:
+        save_snapshot(config.PREWARM_SNAPSHOT_PATH, [
+            (*get_coordinates(redisKey), count) for redisKey, count in cache_analytics.top_keys.top()
+        ])
+    except OSError as e:
+        logger.error('Could not save the access snapshot: %s', e)
+
+
+async def snapshot_accesses():
+    # Every worker writes its own top keys, they see the same traffic so the last one written is as good as any
+    while True:
+        await asyncio.sleep(config.PREWARM_SNAPSHOT_INTERVAL_SECONDS)
+        save_access_snapshot()
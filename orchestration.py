@@ -0,0 +1,44 @@
+import asyncio
+import logging
+
+from stage_timing import stage
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+async def run_concurrently(stages):
+    # Runs independent stages at the same time and returns their results by stage name.
+    # `stages` maps a stage name to a coroutine. The first stage that fails cancels the
+    # others and its exception is raised as is, so an HTTPException keeps its status code.
+    with stage("run_concurrently") as span:
+        span.set_attribute("stages", list(stages))
+
+        # Tasks copy the current context, so spans created inside the stages become
+        # siblings under this span and overlap in the trace
+        tasks = {asyncio.create_task(coro, name=name): name for name, coro in stages.items()}
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        except asyncio.CancelledError:
+            # The request itself was cancelled, don't leave the stages running
+            await _cancel(tasks, tasks, span)
+            raise
+
+        failed = [task for task in done if task.exception() is not None]
+        if failed:
+            name = tasks[failed[0]]
+            span.set_attribute("failed_stage", name)
+            logger.info('Stage %s failed, cancelling %d other stage(s)', name, len(pending))
+            await _cancel(pending, tasks, span)
+            raise failed[0].exception()
+
+        return {name: task.result() for task, name in tasks.items()}
+
+
+async def _cancel(pending, names, span):
+    for task in pending:
+        if not task.done():
+            task.cancel()
+            span.add_event("stage_cancelled", {"stage": names[task]})
+    # Wait for the cancelled stages so their spans and connections are cleaned up
+    await asyncio.gather(*pending, return_exceptions=True)
@@ -1,13 +1,30 @@
-import requests
+from contextlib import asynccontextmanager
+
+import httpx
 import logging
 from fastapi import FastAPI, HTTPException, Query
 from opentelemetry import trace
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
-from opentelemetry.instrumentation.requests import RequestsInstrumentor
+from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
 from opentelemetry.sdk.trace import TracerProvider
 
+import config
+
+# Clients are created once when the app starts and shared by all requests
+http_client = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global http_client
+    # Pooled HTTP client, connections are kept alive between requests
+    http_client = httpx.AsyncClient(timeout=10.0)
+    yield
+    await http_client.aclose()
+
+
 # Create FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Set up the TracerProvider
 trace.set_tracer_provider(TracerProvider())
@@ -19,42 +36,40 @@ tracer = trace.get_tracer("open-telemetry.part1")
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-# Instrument FastAPI and Requests
+# Instrument FastAPI and HTTPX
 FastAPIInstrumentor.instrument_app(app)
-RequestsInstrumentor().instrument()
+HTTPXClientInstrumentor().instrument()
 
 # Example logging from part 1
 logger.info("hello from part 1")
 
-# Tracer annotation which will automatically create a span for this function
-@tracer.start_as_current_span("fetch_data_from_open_meteo")
-def fetch_data_from_open_meteo(latitude, longitude):
-    # Alternative way of creating a span
-    # with tracer.start_as_current_span("fetch_data_from_open_meteo") as span:
-
-    logger.info('Fetching weather data from Open-Meteo')
-    # Define the parameters for your request here
-    params = {
-        'latitude': latitude,  # Example latitude
-        'longitude': longitude,  # Example longitude
-        'hourly': 'temperature_2m'
-    }
+# The span decorator does not cover awaits inside a coroutine in this OpenTelemetry version,
+# so the async functions create their spans with a context manager instead
+async def fetch_data_from_open_meteo(latitude, longitude):
+    with tracer.start_as_current_span("fetch_data_from_open_meteo"):
+        logger.info('Fetching weather data from Open-Meteo')
+        # Define the parameters for your request here
+        params = {
+            'latitude': latitude,  # Example latitude
+            'longitude': longitude,  # Example longitude
+            'hourly': 'temperature_2m'
+        }
 
-    # Make a GET request to the Open-Meteo API using requests
-    response = requests.get('https://api.open-meteo.com/v1/forecast', params=params)
+        # Make a GET request to the Open-Meteo API using the shared HTTP client
+        response = await http_client.get(config.OPEN_METEO_URL, params=params)
 
-    logger.info('Received response from Open-Meteo %s', response)
-    if response.status_code == 200:
-        return response.json()
-    else:
-        # Handle errors
-        raise HTTPException(status_code=500, detail='Failed to fetch data from Open-Meteo')
+        logger.info('Received response from Open-Meteo %s', response)
+        if response.status_code == 200:
+            return response.json()
+        else:
+            # Handle errors
+            raise HTTPException(status_code=500, detail='Failed to fetch data from Open-Meteo')
 
 
 # Endpoint for getting weather data, defined via annotation and using Query parameters
 @app.get('/weather')
 async def get_weather(latitude: float = Query(..., description="Latitude of the location"),
                       longitude: float = Query(..., description="Longitude of the location")):
-    data = fetch_data_from_open_meteo(latitude, longitude)
+    data = await fetch_data_from_open_meteo(latitude, longitude)
 
     return data
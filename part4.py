@@ -1,17 +1,40 @@
-import requests
+from contextlib import asynccontextmanager
+
+import httpx
 import logging
-import redis
 
 from fastapi import FastAPI, HTTPException, Query
 from opentelemetry import trace
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
-from opentelemetry.instrumentation.requests import RequestsInstrumentor
+from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
+from opentelemetry.instrumentation.redis import RedisInstrumentor
 from opentelemetry.sdk.trace import TracerProvider
+
+import cache_backend
+import config
 import random
 
 
+# Clients are created once when the app starts and shared by all requests
+http_client = None
+redis_client = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global http_client, redis_client
+    # Pooled HTTP client, connections are kept alive between requests
+    http_client = httpx.AsyncClient(timeout=10.0)
+    # Connect to Redis
+    # Set WEATHER_REDIS_URL if your Redis server doesn't run on localhost:6379
+    redis_client = cache_backend.connect(config.REDIS_URL)
+    yield
+    await http_client.aclose()
+    await redis_client.aclose()
+
+
 # Create FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Set up the TracerProvider
 trace.set_tracer_provider(TracerProvider())
@@ -23,13 +46,10 @@ tracer = trace.get_tracer("open-telemetry.part4")
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-# Instrument FastAPI and Requests
+# Instrument FastAPI, HTTPX and Redis
 FastAPIInstrumentor.instrument_app(app)
-RequestsInstrumentor().instrument()
-
-# Connect to Redis
-# Replace 'localhost' and '6379' with your Redis server's host and port if different
-redis_client = redis.Redis(host='localhost', port=6379, db=0)
+HTTPXClientInstrumentor().instrument()
+RedisInstrumentor().instrument()
 
 logger.info("hello from part 3")
 
@@ -38,46 +58,44 @@ def get_redis_key(latitude, longitude):
     # Create a unique key for the Redis entry
     return 'weather_data_' + str(latitude) + '_' + str(longitude)
 
-@tracer.start_as_current_span("get_data_from_redis")
-def get_data_from_redis(latitude, longitude):
-    logger.info('Checking Redis for weather data')
-    redisKey = get_redis_key(latitude, longitude)
-    redisData = redis_client.get(redisKey)
-    if redisData is not None:
-        logger.info('Found weather data in Redis')
-        return redisData
-
-@tracer.start_as_current_span("store_data_in_redis")
-def store_data_in_redis(latitude, longitude, data):
-    logger.info('Storing weather data in Redis')
-    redisKey = get_redis_key(latitude, longitude)
-    # Store the data in Redis with a TTL of 4 seconds
-    redis_client.set(redisKey, str(data), ex=4)
-
-
-# Tracer annotation which will automatically create a span for this function
-@tracer.start_as_current_span("fetch_data_from_open_meteo")
-def fetch_data_from_open_meteo(latitude, longitude):
-    # Alternative way of creating a span
-    # with tracer.start_as_current_span("fetch_data_from_open_meteo") as span:
-
-    logger.info('Fetching weather data from Open-Meteo')
-    # Define the parameters for your request here
-    params = {
-        'latitude': latitude,  # Example latitude
-        'longitude': longitude,  # Example longitude
-        'hourly': 'temperature_2m'
-    }
-
-    # Make a GET request to the Open-Meteo API using requests
-    response = requests.get('https://api.open-meteo.com/v1/forecast', params=params)
-
-    logger.info('Received response from Open-Meteo %s', response)
-    if response.status_code == 200:
-        return response.json()
-    else:
-        # Handle errors
-        raise HTTPException(status_code=500, detail='Failed to fetch data from Open-Meteo')
+# The span decorator does not cover awaits inside a coroutine in this OpenTelemetry version,
+# so the async functions create their spans with a context manager instead
+async def get_data_from_redis(latitude, longitude):
+    with tracer.start_as_current_span("get_data_from_redis"):
+        logger.info('Checking Redis for weather data')
+        redisKey = get_redis_key(latitude, longitude)
+        redisData = await redis_client.get(redisKey)
+        if redisData is not None:
+            logger.info('Found weather data in Redis')
+            return redisData
+
+async def store_data_in_redis(latitude, longitude, data):
+    with tracer.start_as_current_span("store_data_in_redis"):
+        logger.info('Storing weather data in Redis')
+        redisKey = get_redis_key(latitude, longitude)
+        # Store the data in Redis with a TTL of 4 seconds
+        await redis_client.set(redisKey, str(data), ex=4)
+
+
+async def fetch_data_from_open_meteo(latitude, longitude):
+    with tracer.start_as_current_span("fetch_data_from_open_meteo"):
+        logger.info('Fetching weather data from Open-Meteo')
+        # Define the parameters for your request here
+        params = {
+            'latitude': latitude,  # Example latitude
+            'longitude': longitude,  # Example longitude
+            'hourly': 'temperature_2m'
+        }
+
+        # Make a GET request to the Open-Meteo API using the shared HTTP client
+        response = await http_client.get(config.OPEN_METEO_URL, params=params)
+
+        logger.info('Received response from Open-Meteo %s', response)
+        if response.status_code == 200:
+            return response.json()
+        else:
+            # Handle errors
+            raise HTTPException(status_code=500, detail='Failed to fetch data from Open-Meteo')
 
 @tracer.start_as_current_span("maybe_raise_random_error")
 def maybe_raise_random_error():
@@ -87,16 +105,16 @@ def maybe_raise_random_error():
         # Return an error response 50% of the time
         raise HTTPException(status_code=500, detail='Random error occurred')
 
-@tracer.start_as_current_span("request_second_service_http_request")
-def request_second_service_http_request():
-    logger.info('Requesting second service')
-    response = requests.get('http://localhost:8001/test')
-    logger.info('Received response from second service %s', response)
-    if response.status_code == 200:
-        return response.json()
-    else:
-        # Handle errors
-        raise HTTPException(status_code=500, detail='Failed to fetch data from second service')
+async def request_second_service_http_request():
+    with tracer.start_as_current_span("request_second_service_http_request"):
+        logger.info('Requesting second service')
+        response = await http_client.get(config.SECOND_SERVICE_URL)
+        logger.info('Received response from second service %s', response)
+        if response.status_code == 200:
+            return response.json()
+        else:
+            # Handle errors
+            raise HTTPException(status_code=500, detail='Failed to fetch data from second service')
 
 # Endpoint for getting weather data, defined via annotation and using Query parameters
 @app.get('/weather')
@@ -104,18 +122,18 @@ async def get_weather(latitude: float = Query(..., description="Latitude of the
                       longitude: float = Query(..., description="Longitude of the location")):
     maybe_raise_random_error()
 
-    request_second_service_http_request()
+    await request_second_service_http_request()
 
     # Check Redis for weather data
-    redisData = get_data_from_redis(latitude, longitude)
+    redisData = await get_data_from_redis(latitude, longitude)
     if redisData is not None:
         # Return data from Redis if it exists
         return redisData
 
     # Fetch data from Open-Meteo
-    data = fetch_data_from_open_meteo(latitude, longitude)
+    data = await fetch_data_from_open_meteo(latitude, longitude)
 
     # Store data in Redis
-    store_data_in_redis(latitude, longitude, data)
+    await store_data_in_redis(latitude, longitude, data)
 
     return data
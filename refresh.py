@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import time
+
+from opentelemetry import metrics, trace
+
+import config
+
+tracer = trace.get_tracer("open-telemetry.example.refresh")
+
+# Creates a meter from the global meter provider
+meter = metrics.get_meter("my.meter.name")
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+stale_served_counter = meter.create_counter(
+    "cache.stale_served", unit="1", description="Counts forecasts served after their soft TTL while a refresh runs"
+)
+refresh_scheduled_counter = meter.create_counter(
+    "refresh.scheduled", unit="1", description="Counts background refreshes that were queued"
+)
+refresh_latency_histogram = meter.create_histogram(
+    "refresh.latency", unit="ms", description="Duration of background forecast refreshes"
+)
+
+
+class BackgroundRefresher:
+    # Refreshes cached forecasts off the request path.
+    #
+    # Stale entries, between the soft and the hard TTL, are queued by the request that found them.
+    # Hot entries, keys accessed at least WEATHER_REFRESH_HOT_THRESHOLD times per scan interval,
+    # are queued shortly before they go stale so their readers never see the refresh at all.
+
+    def __init__(self, refresh_fn):
+        # refresh_fn(latitude, longitude, replaces) fetches and stores a forecast newer than `replaces`,
+        # the fetched_at of the entry being refreshed
+        self.refresh_fn = refresh_fn
+        self._queue = asyncio.Queue(maxsize=config.REFRESH_QUEUE_SIZE)
+        self._queued = set()
+        # key -> [accesses since the last scan, latitude, longitude, fetched_at of the served entry]
+        self._accesses = {}
+        self._tasks = []
+        meter.create_observable_gauge(
+            "refresh.queue_depth", callbacks=[self._observe_queue_depth], unit="1",
+            description="Number of forecast refreshes waiting to run",
+        )
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(config.REFRESH_WORKERS)]
+        self._tasks.append(asyncio.create_task(self._scan_hot_keys()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def record_access(self, key, latitude, longitude, fetched_at):
+        entry = self._accesses.get(key)
+        if entry is None:
+            if len(self._accesses) >= config.REFRESH_TRACKED_KEYS:
+                return
+            self._accesses[key] = [1, latitude, longitude, fetched_at]
+        else:
+            entry[0] += 1
+            entry[3] = fetched_at
+
+    def serve_stale(self, key, latitude, longitude, fetched_at):
+        stale_served_counter.add(1)
+        self.schedule(key, latitude, longitude, fetched_at, "stale")
+
+    def schedule(self, key, latitude, longitude, fetched_at, reason):
+        if key in self._queued:
+            return
+        try:
+            # The span of the request that asked for the refresh, linked from the refresh span
+            requested_by = trace.get_current_span().get_span_context()
+            self._queue.put_nowait((key, latitude, longitude, fetched_at, requested_by))
+        except asyncio.QueueFull:
+            logger.info('Refresh queue is full, not refreshing %s', key)
+            return
+        self._queued.add(key)
+        refresh_scheduled_counter.add(1, {"reason": reason})
+
+    async def _work(self):
+        while True:
+            key, latitude, longitude, fetched_at, requested_by = await self._queue.get()
+            # Not a child of the request span, the request has usually finished by now
+            with tracer.start_as_current_span(
+                "background_refresh", context=trace.set_span_in_context(trace.INVALID_SPAN),
+                links=[trace.Link(requested_by)],
+            ) as span:
+                span.set_attribute("cache.key", key)
+                start = time.perf_counter()
+                try:
+                    await self.refresh_fn(latitude, longitude, fetched_at)
+                except Exception as e:
+                    # The stale entry keeps being served until the hard TTL, the next reader tries again
+                    logger.error('Background refresh of %s failed: %s', key, e)
+                finally:
+                    self._queued.discard(key)
+                    refresh_latency_histogram.record((time.perf_counter() - start) * 1000)
+
+    async def _scan_hot_keys(self):
+        interval = config.REFRESH_SCAN_INTERVAL_SECONDS
+        while True:
+            await asyncio.sleep(interval)
+            # Refresh when the entry would go stale before the next scan
+            refresh_after = config.CACHE_SOFT_TTL_SECONDS - interval
+            now = time.time()
+            for key, entry in list(self._accesses.items()):
+                count, latitude, longitude, fetched_at = entry
+                if count >= config.REFRESH_HOT_THRESHOLD and now - fetched_at >= refresh_after:
+                    self.schedule(key, latitude, longitude, fetched_at, "hot")
+                if count == 0:
+                    del self._accesses[key]
+                else:
+                    entry[0] = 0
+
+    def _observe_queue_depth(self, options):
+        yield metrics.Observation(self._queue.qsize())
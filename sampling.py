@@ -0,0 +1,198 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from opentelemetry import baggage, context, metrics, trace
+from opentelemetry.sdk.trace import SpanProcessor
+from opentelemetry.trace import StatusCode
+
+# Creates a meter from the global meter provider
+meter = metrics.get_meter("my.meter.name")
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+traces_kept_counter = meter.create_counter(
+    "traces.kept", unit="1", description="Counts traces that were exported, by the reason they were kept"
+)
+traces_dropped_counter = meter.create_counter(
+    "traces.dropped", unit="1", description="Counts traces that were not exported, by the reason they were dropped"
+)
+
+# Baggage entry carrying the sampling ratio of the service that started the trace
+RATIO_BAGGAGE_KEY = 'sampling.ratio'
+
+_UINT64 = 2 ** 64
+
+
+class TailSamplingSpanProcessor(SpanProcessor):
+    # Holds the spans of a trace until its local root span ends, then decides whether the whole
+    # trace is exported through `next_processor`:
+    #
+    #   error   a span ended with an error status
+    #   slow    a span took longer than its threshold in `slow_span_ms`, or the root longer than `slow_root_ms`
+    #   budget  the trace ID falls below the current ratio, which adapts so that about
+    #           `traces_per_second` traces per second are kept
+    #
+    # The budget decision only depends on the trace ID and the ratio. The service that starts a
+    # trace sends its ratio along as baggage (see propagate_ratio) and downstream services use
+    # that ratio instead of their own, so both keep the same budget traces.
+
+    def __init__(self, next_processor, traces_per_second, slow_span_ms=None, slow_root_ms=None,
+                 max_buffered_spans=10000, max_trace_age_seconds=30):
+        self.next_processor = next_processor
+        self.traces_per_second = traces_per_second
+        self.slow_span_ms = slow_span_ms or {}
+        self.slow_root_ms = slow_root_ms
+        self.max_buffered_spans = max_buffered_spans
+        self.max_trace_age_seconds = max_trace_age_seconds
+        self.ratio = 1.0
+
+        self._lock = threading.Lock()
+        # trace_id -> [started, ratio, spans]
+        self._traces = OrderedDict()
+        self._buffered_spans = 0
+        # Decisions of recent traces, for spans that end after their local root
+        self._decided = OrderedDict()
+        self._window_start = time.monotonic()
+        self._window_roots = 0
+
+    def on_start(self, span, parent_context=None):
+        parent = span.parent
+        if parent is not None and not parent.is_remote:
+            return
+        # A local root span: this is where the trace enters this service
+        ratio = None
+        if parent is not None:
+            propagated = baggage.get_baggage(RATIO_BAGGAGE_KEY, parent_context)
+            if propagated is not None:
+                try:
+                    ratio = float(propagated)
+                except ValueError:
+                    pass
+        with self._lock:
+            if ratio is None:
+                ratio = self._next_ratio()
+            entry = self._traces.get(span.context.trace_id)
+            if entry is None:
+                self._traces[span.context.trace_id] = [time.monotonic(), ratio, []]
+            else:
+                entry[1] = ratio
+
+    def on_end(self, span):
+        trace_id = span.context.trace_id
+        with self._lock:
+            decided = self._decided.get(trace_id)
+            if decided is not None:
+                if decided:
+                    self.next_processor.on_end(span)
+                return
+
+            entry = self._traces.get(trace_id)
+            if entry is None:
+                # The local root started before this processor was installed
+                entry = self._traces[trace_id] = [time.monotonic(), self.ratio, []]
+            entry[2].append(span)
+            self._buffered_spans += 1
+
+            parent = span.parent
+            if parent is None or parent.is_remote:
+                self._decide(trace_id, span)
+            self._evict()
+
+    def current_ratio(self, trace_id):
+        with self._lock:
+            entry = self._traces.get(trace_id)
+            return entry[1] if entry is not None else self.ratio
+
+    def shutdown(self):
+        self.next_processor.shutdown()
+
+    def force_flush(self, timeout_millis=30000):
+        return self.next_processor.force_flush(timeout_millis)
+
+    def _next_ratio(self):
+        # Counts local roots per second and adapts the ratio once per second, called with the lock held
+        self._window_roots += 1
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed >= 1:
+            rate = self._window_roots / elapsed
+            target = min(1.0, self.traces_per_second / rate) if rate else 1.0
+            # Cut down right away when traffic grows, recover gradually so one quiet second doesn't
+            # let the next burst through at full rate
+            self.ratio = target if target < self.ratio else 0.5 * self.ratio + 0.5 * target
+            self._window_start = now
+            self._window_roots = 0
+        return self.ratio
+
+    def _decide(self, trace_id, root):
+        started, ratio, spans = self._traces.pop(trace_id)
+        self._buffered_spans -= len(spans)
+
+        reason = self._keep_reason(spans, root, ratio, trace_id)
+        self._decided[trace_id] = reason is not None
+        while len(self._decided) > 10000:
+            self._decided.popitem(last=False)
+
+        if reason is None:
+            traces_dropped_counter.add(1, {"reason": "sampled_out"})
+            return
+        traces_kept_counter.add(1, {"reason": reason})
+        for span in spans:
+            self.next_processor.on_end(span)
+
+    def _keep_reason(self, spans, root, ratio, trace_id):
+        for span in spans:
+            if span.status.status_code is StatusCode.ERROR:
+                return "error"
+        for span in spans:
+            threshold = self.slow_span_ms.get(span.name)
+            if threshold is not None and _duration_ms(span) > threshold:
+                return "slow"
+        if self.slow_root_ms is not None and _duration_ms(root) > self.slow_root_ms:
+            return "slow"
+        if in_budget(trace_id, ratio):
+            return "budget"
+        return None
+
+    def _evict(self):
+        # Drops traces whose root never ended or that don't fit into the buffer anymore
+        now = time.monotonic()
+        while self._traces:
+            trace_id, (started, _, spans) = next(iter(self._traces.items()))
+            if self._buffered_spans <= self.max_buffered_spans and now - started <= self.max_trace_age_seconds:
+                break
+            del self._traces[trace_id]
+            self._buffered_spans -= len(spans)
+            self._decided[trace_id] = False
+            traces_dropped_counter.add(1, {"reason": "evicted"})
+
+
+def in_budget(trace_id, ratio):
+    return (trace_id & (_UINT64 - 1)) < ratio * _UINT64
+
+
+def _duration_ms(span):
+    return (span.end_time - span.start_time) / 1e6
+
+
+# The processor installed by telemetry.setup_tracing, if tail sampling is enabled
+processor = None
+
+
+@contextmanager
+def propagate_ratio():
+    # Puts the sampling ratio of the current trace into the baggage of outgoing requests,
+    # so the called service makes the same budget decision for this trace
+    if processor is None:
+        yield
+        return
+    trace_id = trace.get_current_span().get_span_context().trace_id
+    token = context.attach(baggage.set_baggage(RATIO_BAGGAGE_KEY, repr(processor.current_ratio(trace_id))))
+    try:
+        yield
+    finally:
+        context.detach(token)
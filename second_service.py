@@ -3,17 +3,28 @@ import random
 import requests
 import logging
 import redis
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request
 from opentelemetry import trace
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
 from opentelemetry.instrumentation.requests import RequestsInstrumentor
-from opentelemetry.sdk.trace import TracerProvider
+
+import deadline
+import log_pipeline
+import telemetry
+from fault_injection import FaultInjection
 
 # Create FastAPI app
 app = FastAPI()
 
-# Set up the TracerProvider
-trace.set_tracer_provider(TracerProvider())
+# Set up the TracerProvider, with tail sampling when a trace budget is configured
+telemetry.setup_tracing()
+
+# Export log records through the bounded queue of export_pipeline.py, the start script turns off those
+# of opentelemetry-instrument
+telemetry.setup_log_export()
+
+# Format and export log records on a background thread
+log_pipeline.setup_logging()
 
 # Creates a tracer from the global tracer provider
 tracer = trace.get_tracer("open-telemetry.example.second-service")
@@ -27,9 +38,19 @@ FastAPIInstrumentor.instrument_app(app)
 
 logger.info("hello from startup second service")
 
+# Latency, errors and payload size for offline benchmarks, set with the SECOND_SERVICE_* variables
+faults = FaultInjection.from_env('SECOND_SERVICE')
+
 
 @app.get('/test')
-async def test():
+@deadline.with_deadline
+async def test(request: Request):
     with tracer.start_as_current_span("second_service_http_test_server") as span:
         logger.info("test - hey there from the second service")
-        return "Hey there"
+        # Gives up once the caller's deadline, sent along in a header, has passed
+        async with deadline.budget(span, "second_service_http_test_server"):
+            failed = await faults.delay()
+        if failed:
+            span.set_attribute("fault.injected", True)
+            raise HTTPException(status_code=500, detail='Injected error')
+        return "Hey there" + faults.padding()
@@ -0,0 +1,160 @@
+import asyncio
+import itertools
+import logging
+import time
+from array import array
+
+import httpx
+from opentelemetry import metrics, propagate, trace
+
+import config
+import deadline
+
+# Creates a meter from the global meter provider
+meter = metrics.get_meter("my.meter.name")
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+requests_counter = meter.create_counter(
+    "second_service.requests", unit="1", description="Counts calls of the second service, without hedges"
+)
+hedges_counter = meter.create_counter(
+    "second_service.hedges", unit="1", description="Counts backup requests sent because a replica was slow"
+)
+hedge_wins_counter = meter.create_counter(
+    "second_service.hedge_wins", unit="1", description="Counts backup requests that answered first"
+)
+
+# Latencies the hedge delay is computed from
+LATENCY_SAMPLES = 1000
+
+
+class SecondServiceClient:
+    # Calls the second service over one pool of kept-alive connections, HTTP/2 if h2 is installed and
+    # WEATHER_SECOND_SERVICE_HTTP2 is set. With WEATHER_SECOND_SERVICE_IN_PROCESS the app is called
+    # through ASGI without any network, for when both apps run in the same process.
+    #
+    # Requests go round robin over the replicas. When a replica hasn't answered after the
+    # WEATHER_SECOND_SERVICE_HEDGE_PERCENTILE of recent latencies, the same request is sent to the
+    # next replica and the first successful answer wins. Hedges are limited to
+    # WEATHER_SECOND_SERVICE_HEDGE_BUDGET of the requests, so a slow service doesn't get twice the load.
+
+    def __init__(self, urls):
+        self.urls = urls
+        self.client = None
+        self.in_process = config.SECOND_SERVICE_IN_PROCESS
+        self._next_replica = itertools.cycle(range(len(urls)))
+        self._latencies = array('d', [0.0] * LATENCY_SAMPLES)
+        self._samples = 0
+        self._hedge_delay = None
+        self._hedge_tokens = 0.0
+
+    async def start(self):
+        if self.in_process:
+            # Imported here, the second service sets up its own tracing on import
+            import second_service
+            transport = httpx.ASGITransport(app=second_service.app)
+            self.client = httpx.AsyncClient(transport=transport, timeout=config.SECOND_SERVICE_TIMEOUT_SECONDS)
+            return
+        self.client = httpx.AsyncClient(
+            http2=config.SECOND_SERVICE_HTTP2 and _h2_installed(),
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=60),
+            timeout=config.SECOND_SERVICE_TIMEOUT_SECONDS,
+        )
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def get(self):
+        requests_counter.add(1)
+        # Every request earns a fraction of a hedge, at most 10 hedges can be saved up for a burst
+        self._hedge_tokens = min(self._hedge_tokens + config.SECOND_SERVICE_HEDGE_BUDGET, 10.0)
+        span = trace.get_current_span()
+        first = next(self._next_replica)
+        attempts = {asyncio.create_task(self._attempt(first)): first}
+        hedged = False
+        delay = self._current_hedge_delay()
+        failure = None
+        try:
+            while attempts:
+                timeout = delay if not hedged and delay is not None else None
+                done, _ = await asyncio.wait(attempts, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # The replica is slower than usual, try another one if the budget allows
+                    hedged = True
+                    if self._take_hedge_token():
+                        replica = next(self._next_replica)
+                        attempts[asyncio.create_task(self._attempt(replica))] = replica
+                        hedges_counter.add(1)
+                        span.add_event("hedge_sent", {"replica": self.urls[replica], "delay_ms": delay * 1000})
+                    continue
+                for task in done:
+                    replica = attempts.pop(task)
+                    try:
+                        response, latency = task.result()
+                    except httpx.HTTPError as e:
+                        failure = e
+                        continue
+                    if response.status_code >= 500 and attempts:
+                        # Another attempt is still running and may do better
+                        failure = response
+                        continue
+                    self._record_latency(latency)
+                    won_by_hedge = replica != first
+                    if won_by_hedge:
+                        hedge_wins_counter.add(1)
+                    span.set_attributes({"second_service.replica": self.urls[replica], "hedge.won": won_by_hedge})
+                    return response
+        finally:
+            for task in attempts:
+                task.cancel()
+        if isinstance(failure, httpx.Response):
+            return failure
+        raise failure
+
+    async def _attempt(self, replica):
+        headers = {}
+        if self.in_process:
+            # ASGITransport isn't instrumented, carry the trace and baggage to the second service by hand
+            propagate.inject(headers)
+        timeout = config.SECOND_SERVICE_TIMEOUT_SECONDS
+        left = deadline.remaining()
+        if left is not None:
+            # The second service stops working on the request once nobody waits for the answer anymore
+            headers[deadline.DEADLINE_HEADER] = deadline.header_value()
+            timeout = min(timeout, left)
+        start = time.perf_counter()
+        response = await self.client.get(self.urls[replica], headers=headers, timeout=timeout)
+        return response, time.perf_counter() - start
+
+    def _record_latency(self, latency):
+        self._latencies[self._samples % LATENCY_SAMPLES] = latency
+        self._samples += 1
+        # Sorting the samples on every request would cost more than hedging saves
+        if self._samples % 100 == 0:
+            self._hedge_delay = None
+
+    def _current_hedge_delay(self):
+        if not config.SECOND_SERVICE_HEDGE_PERCENTILE or self._samples < 100:
+            return None
+        if self._hedge_delay is None:
+            samples = sorted(self._latencies[:min(self._samples, LATENCY_SAMPLES)])
+            percentile = samples[int(len(samples) * config.SECOND_SERVICE_HEDGE_PERCENTILE / 100) - 1]
+            self._hedge_delay = max(percentile, config.SECOND_SERVICE_HEDGE_MIN_DELAY_MS / 1000)
+        return self._hedge_delay
+
+    def _take_hedge_token(self):
+        if self._hedge_tokens < 1:
+            return False
+        self._hedge_tokens -= 1
+        return True
+
+
+def _h2_installed():
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logger.info('h2 is not installed, using HTTP/1.1 keep-alive for the second service')
+        return False
+    return True
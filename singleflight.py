@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import time
+
+from opentelemetry import metrics, trace
+from redis.exceptions import LockError
+
+import config
+import deadline
+from cache_backend import NODE_ERRORS
+
+tracer = trace.get_tracer("open-telemetry.example.singleflight")
+
+# Creates a meter from the global meter provider
+meter = metrics.get_meter("my.meter.name")
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+coalesced_counter = meter.create_counter(
+    "singleflight.coalesced", unit="1", description="Counts callers that shared another caller's in-flight fetch"
+)
+lock_wait_histogram = meter.create_histogram(
+    "singleflight.lock_wait", unit="ms", description="Time spent waiting for the cross-worker fetch lock"
+)
+
+
+class SingleFlight:
+    # Makes sure there is at most one in-flight call per key inside this process,
+    # everyone else asking for the same key waits for that call and gets its result
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+
+    async def do(self, key, fn):
+        task = self._calls.get(key)
+        if task is not None:
+            coalesced_counter.add(1, {"singleflight": self.name, "singleflight.scope": "process"})
+            trace.get_current_span().add_event("singleflight_coalesced", {"key": key})
+        else:
+            # The call runs in its own task so a cancelled caller doesn't cancel it for the other waiters.
+            # The task would inherit the deadline of the first caller, it runs without one instead.
+            task = asyncio.create_task(deadline.detached(fn)())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+        # Every caller gives up on its own deadline, the call goes on for the others
+        async with deadline.budget(trace.get_current_span(), "singleflight_" + self.name):
+            return await asyncio.shield(task)
+
+    def _finished(self, key, task):
+        self._calls.pop(key, None)
+        # Every waiter may have given up already, the error is then only retrieved here
+        if not task.cancelled():
+            task.exception()
+
+
+class RedisSingleFlight:
+    # Same idea across workers: a Redis lock per key, on the cache node of the key, decides which worker
+    # calls `fn`. The others wait for the lock and then find the result in the cache through `check`.
+    # When the node can't be reached the lock counts as not acquired, so callers are still coalesced
+    # inside this process.
+
+    def __init__(self, name):
+        self.name = name
+        self._local = SingleFlight(name)
+
+    async def do(self, node, key, fn, check):
+        # Only one task per process competes for the Redis lock
+        return await self._local.do(key, lambda: self._do_locked(node, key, fn, check))
+
+    async def _do_locked(self, node, key, fn, check):
+        with tracer.start_as_current_span("singleflight_lock") as span:
+            lock = node.client.lock(
+                'lock_' + key,
+                timeout=config.SINGLEFLIGHT_LOCK_TIMEOUT_SECONDS,
+                blocking_timeout=config.SINGLEFLIGHT_LOCK_WAIT_SECONDS,
+            )
+            start = time.perf_counter()
+            try:
+                async with node.track():
+                    acquired = await lock.acquire()
+            except NODE_ERRORS:
+                span.set_attribute("lock.unavailable", True)
+                acquired = False
+            wait_ms = (time.perf_counter() - start) * 1000
+            lock_wait_histogram.record(wait_ms, {"singleflight": self.name, "lock.acquired": acquired})
+            span.set_attribute("lock.acquired", acquired)
+            span.set_attribute("lock.wait_ms", wait_ms)
+
+            try:
+                # Another worker may have stored the result while we were waiting
+                cached = await check()
+                if cached is not None:
+                    coalesced_counter.add(1, {"singleflight": self.name, "singleflight.scope": "redis"})
+                    return cached
+                if not acquired:
+                    # The lock holder is taking too long, fetch it ourselves rather than failing the request
+                    logger.info('Timed out waiting for lock on %s', key)
+                return await fn()
+            finally:
+                if acquired:
+                    try:
+                        async with node.track():
+                            await lock.release()
+                    except LockError:
+                        # The lock expired while fetching, nothing left to release
+                        logger.info('Lock on %s expired before release', key)
+                    except NODE_ERRORS:
+                        # Expires on its own
+                        pass
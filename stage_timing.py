@@ -0,0 +1,287 @@
+import asyncio
+import bisect
+import contextvars
+import functools
+import time
+from array import array
+from contextlib import contextmanager
+
+from opentelemetry import metrics, trace
+from opentelemetry.trace import Status, StatusCode
+
+import config
+import sampling
+import telemetry
+
+# Instrumentation of the stages of a request (cache lookup, upstream calls, ...), in one of three modes:
+#
+#   spans  every stage is a span, as with tracer.start_as_current_span
+#   light  stages only record their timing into preallocated per-route counters and a small per-request
+#          list. The list is turned into spans when the request failed, was slow or its trace is kept
+#          by the sampler, so requests nobody will look at don't pay for span objects and context switches.
+#   off    nothing is recorded
+#
+# In spans and light mode the duration of every stage also goes into the stage.duration histogram.
+#
+# Stage spans of light mode are created after the fact as direct children of the request span.
+
+tracer = trace.get_tracer("open-telemetry.example.stages")
+
+# Creates a meter from the global meter provider
+meter = metrics.get_meter("my.meter.name")
+
+mode = config.INSTRUMENTATION_MODE
+
+# Stages recorded by the current request in light mode, None outside of an instrumented route
+_recorded = contextvars.ContextVar('recorded_stages', default=None)
+
+
+class RouteStats:
+    # Call counts and total and maximum duration per stage of one route, in fixed size arrays
+    # so recording a stage doesn't allocate
+
+    def __init__(self, route, stages):
+        self.route = route
+        self.index = {name: i for i, name in enumerate(stages)}
+        self.stages = list(stages)
+        self.calls = array('q', bytes(8 * len(stages)))
+        self.total_ns = array('q', bytes(8 * len(stages)))
+        self.max_ns = array('q', bytes(8 * len(stages)))
+
+    def record(self, name, duration_ns):
+        i = self.index.get(name)
+        if i is None:
+            # A stage nobody declared, grow once and keep recording it from then on
+            i = self.index[name] = len(self.stages)
+            self.stages.append(name)
+            for values in (self.calls, self.total_ns, self.max_ns):
+                values.append(0)
+        self.calls[i] += 1
+        self.total_ns[i] += duration_ns
+        if duration_ns > self.max_ns[i]:
+            self.max_ns[i] = duration_ns
+
+
+class StageRecord:
+    # Stands in for the span of a stage in light mode, keeps what the stage sets on it
+
+    __slots__ = ('name', 'start_ns', 'end_ns', 'attributes', 'events', 'error')
+
+    def __init__(self, name, start_ns):
+        self.name = name
+        self.start_ns = start_ns
+        self.end_ns = None
+        self.attributes = None
+        self.events = None
+        self.error = None
+
+    def set_attribute(self, key, value):
+        if self.attributes is None:
+            self.attributes = {}
+        self.attributes[key] = value
+
+    def set_attributes(self, attributes):
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+
+    def add_event(self, name, attributes=None):
+        if self.events is None:
+            self.events = []
+        self.events.append((name, attributes, time.time_ns()))
+
+    def is_recording(self):
+        return True
+
+
+_routes = {}
+
+
+def route_stats(route, stages=()):
+    stats = _routes.get(route)
+    if stats is None:
+        stats = _routes[route] = RouteStats(route, stages)
+    return stats
+
+
+@contextmanager
+def stage(name):
+    if mode == 'off':
+        yield trace.INVALID_SPAN
+        return
+
+    recorded = _recorded.get() if mode == 'light' else None
+    if recorded is None:
+        # Spans mode, or a stage outside of an instrumented route, e.g. a background refresh or the batch endpoint
+        with tracer.start_as_current_span(name) as span:
+            start = time.perf_counter_ns()
+            outcome = 'ok'
+            try:
+                yield span
+            except BaseException as e:
+                outcome = _outcome(e)
+                raise
+            finally:
+                _observe(name, time.perf_counter_ns() - start, outcome, span.get_span_context())
+        return
+
+    stats, records = recorded
+    start = time.perf_counter_ns()
+    record = StageRecord(name, time.time_ns())
+    records.append(record)
+    outcome = 'ok'
+    try:
+        yield record
+    except BaseException as e:
+        record.error = e
+        outcome = _outcome(e)
+        raise
+    finally:
+        duration = time.perf_counter_ns() - start
+        record.end_ns = record.start_ns + duration
+        stats.record(name, duration)
+        _observe(name, duration, outcome, trace.get_current_span().get_span_context())
+
+
+def _outcome(error):
+    return 'cancelled' if isinstance(error, (asyncio.CancelledError, GeneratorExit)) else 'error'
+
+
+def _observe(name, duration_ns, outcome, span_context):
+    duration_ms = duration_ns / 1e6
+    histogram = duration_histogram()
+    if histogram is not None:
+        histogram.record(duration_ms, {"stage": name, "outcome": outcome})
+    exemplars.offer(name, duration_ms, span_context)
+
+
+class Exemplars:
+    # Keeps the slowest recent sample of every histogram bucket per stage together with its trace,
+    # so an outlier in the latency distribution leads to a trace showing where the time went.
+    # The SDK doesn't support exemplars yet, GET /metrics/exemplars serves them instead.
+
+    def __init__(self, boundaries, max_age_seconds):
+        self.boundaries = boundaries
+        self.max_age_seconds = max_age_seconds
+        # stage -> per bucket (duration_ms, trace_id, span_id, timestamp) or None
+        self.samples = {}
+
+    def offer(self, name, duration_ms, span_context):
+        if not span_context.trace_flags.sampled:
+            return
+        buckets = self.samples.get(name)
+        if buckets is None:
+            buckets = self.samples[name] = [None] * (len(self.boundaries) + 1)
+        i = bisect.bisect_left(self.boundaries, duration_ms)
+        now = time.time()
+        current = buckets[i]
+        # Replace older samples, so exemplars belong to traces that are still around
+        if current is None or duration_ms >= current[0] or now - current[3] > self.max_age_seconds:
+            buckets[i] = (duration_ms, span_context.trace_id, span_context.span_id, now)
+
+    def snapshot(self):
+        upper_bounds = self.boundaries + [None]
+        return {
+            name: [
+                {
+                    'le': le,
+                    'duration_ms': round(sample[0], 3),
+                    'trace_id': '%032x' % sample[1],
+                    'span_id': '%016x' % sample[2],
+                    'timestamp': sample[3],
+                }
+                for le, sample in zip(upper_bounds, buckets) if sample is not None
+            ]
+            for name, buckets in sorted(self.samples.items())
+        }
+
+
+# Created on first use once telemetry.setup_metrics ran in the app lifespan, stages that end before
+# that are only kept in the route stats and exemplars
+_duration_histogram = None
+
+
+def duration_histogram():
+    global _duration_histogram
+    if _duration_histogram is None and telemetry.meter_provider is not None:
+        _duration_histogram = telemetry.meter_provider.get_meter("my.meter.name").create_histogram(
+            "stage.duration", unit="ms", description="Duration of the stages of a request, by stage and outcome"
+        )
+    return _duration_histogram
+
+exemplars = Exemplars(config.STAGE_BUCKETS_MS, config.METRICS_EXPORT_INTERVAL_MS / 1000)
+
+
+def instrumented_route(route, stages):
+    # Decorator for an endpoint whose stages should be recorded in light mode
+    stats = route_stats(route, stages)
+
+    def decorator(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            if mode != 'light':
+                return await endpoint(*args, **kwargs)
+            records = []
+            token = _recorded.set((stats, records))
+            start = time.perf_counter_ns()
+            failed = False
+            try:
+                return await endpoint(*args, **kwargs)
+            except BaseException:
+                failed = True
+                raise
+            finally:
+                _recorded.reset(token)
+                duration_ms = (time.perf_counter_ns() - start) / 1e6
+                if records and _should_promote(records, failed, duration_ms):
+                    _promote(records)
+        return wrapper
+    return decorator
+
+
+def _should_promote(records, failed, duration_ms):
+    span_context = trace.get_current_span().get_span_context()
+    if not span_context.trace_flags.sampled:
+        return False
+    if failed or duration_ms > config.TRACE_SLOW_ROOT_MS:
+        return True
+    for record in records:
+        threshold = config.TRACE_SLOW_SPAN_MS.get(record.name)
+        if record.error is not None or (threshold is not None and (record.end_ns - record.start_ns) / 1e6 > threshold):
+            return True
+    # Same decision as the tail sampler's budget, so promoted stages end up in traces it keeps
+    if sampling.processor is not None:
+        ratio = sampling.processor.current_ratio(span_context.trace_id)
+    else:
+        ratio = config.INSTRUMENTATION_PROMOTE_RATIO
+    return sampling.in_budget(span_context.trace_id, ratio)
+
+
+def _promote(records):
+    for record in records:
+        span = tracer.start_span(record.name, start_time=record.start_ns, attributes=record.attributes)
+        for name, attributes, timestamp in record.events or ():
+            span.add_event(name, attributes, timestamp)
+        if record.error is not None and not isinstance(record.error, GeneratorExit):
+            span.record_exception(record.error)
+            span.set_status(Status(StatusCode.ERROR, str(record.error)))
+        span.end(end_time=record.end_ns)
+
+
+def _observe_calls(options):
+    for stats in list(_routes.values()):
+        for name, i in stats.index.items():
+            yield metrics.Observation(stats.calls[i], {"route": stats.route, "stage": name})
+
+
+def _observe_time(options):
+    for stats in list(_routes.values()):
+        for name, i in stats.index.items():
+            yield metrics.Observation(stats.total_ns[i] / 1e6, {"route": stats.route, "stage": name})
+
+
+meter.create_observable_counter(
+    "stage.calls", callbacks=[_observe_calls], unit="1", description="Stages run in light instrumentation mode"
+)
+meter.create_observable_counter(
+    "stage.time", callbacks=[_observe_time], unit="ms", description="Total time spent in each stage in light mode"
+)
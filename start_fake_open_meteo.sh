@@ -0,0 +1,7 @@
+#!/usr/bin/env bash
+
+# Offline stand-in for the Open-Meteo API, see fake_open_meteo.py
+# Example: 50ms median latency with a long tail and 1% errors
+#   FAKE_OPEN_METEO_LATENCY=lognormal:50,0.6 FAKE_OPEN_METEO_ERROR_RATE=0.01 bash start_fake_open_meteo.sh
+
+uvicorn fake_open_meteo:app --port 8002
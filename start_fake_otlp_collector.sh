@@ -0,0 +1,8 @@
+#!/usr/bin/env bash
+
+# Offline stand-in for the OpenTelemetry collector, see fake_otlp_collector.py
+# Example: a collector that takes 2 seconds per export call, or one that rejects everything
+#   FAKE_OTLP_LATENCY=fixed:2000 bash start_fake_otlp_collector.sh
+#   FAKE_OTLP_ERROR_RATE=1 bash start_fake_otlp_collector.sh
+
+python fake_otlp_collector.py --port 4317
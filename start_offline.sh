@@ -0,0 +1,41 @@
+#!/usr/bin/env bash
+
+# Runs the weather service with every dependency on this machine, for reproducible benchmarks:
+# the fake Open-Meteo on port 8002, second_service on port 8001 and an ephemeral Redis on port 6380.
+# Without redis-server installed an in-process fake Redis is used (`pip install fakeredis lupa`).
+#
+# Latency and errors of the upstreams are set with FAKE_OPEN_METEO_* and SECOND_SERVICE_*,
+# see fault_injection.py. The app to run can be passed as the first argument, e.g.
+#   bash start_offline.sh part3
+
+APP=${1:-main}
+
+trap 'kill $(jobs -p) 2>/dev/null' EXIT
+
+# WEATHER_REDIS_NODES=3 shards the cache of main.py over three Redis servers on ports 6380-6382, or three fakes
+NODES=${WEATHER_REDIS_NODES:-1}
+URLS=""
+if command -v redis-server > /dev/null; then
+  for i in $(seq 0 $((NODES - 1))); do
+    redis-server --port $((6380 + i)) --save '' --appendonly no > /dev/null &
+    URLS="$URLS,redis://localhost:$((6380 + i))/0"
+  done
+else
+  echo "redis-server not found, using an in-process fake Redis"
+  for i in $(seq 0 $((NODES - 1))); do
+    URLS="$URLS,fakeredis://node$i"
+  done
+fi
+export WEATHER_REDIS_URLS=${URLS#,}
+# part1-part5 use a single Redis, the first node
+export WEATHER_REDIS_URL=${WEATHER_REDIS_URLS%%,*}
+
+uvicorn fake_open_meteo:app --port 8002 --log-level warning &
+uvicorn second_service:app --port 8001 --log-level warning &
+
+# No collector runs offline, WEATHER_METRICS_EXPORTER=console prints the metrics instead
+export WEATHER_METRICS_EXPORTER=${WEATHER_METRICS_EXPORTER:-none}
+export WEATHER_OPEN_METEO_URL=http://localhost:8002/v1/forecast
+export WEATHER_SECOND_SERVICE_URL=http://localhost:8001/test
+
+uvicorn $APP:app --port 8000 --log-level warning
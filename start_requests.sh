@@ -1,7 +1,7 @@
 #!/usr/bin/env bash
 
-while true
-do
-  curl "http://127.0.0.1:8000/weather?latitude=52.374&longitude=4.8897" -v
-  sleep 1
-done
\ No newline at end of file
+# Sends load to the weather service and prints throughput and latency percentiles.
+# Extra arguments are passed to loadgen.py, see `python loadgen.py --help`, e.g.
+#   bash start_requests.sh --mode open --rps 200 --duration 60 --label part3 --output results-part3.json
+
+python loadgen.py --url http://127.0.0.1:8000 "$@"
@@ -5,8 +5,11 @@
 
 export OTEL_SERVICE_NAME=opentelemetry-example-second
 
-export OTEL_TRACES_EXPORTER=otlp
-export OTEL_LOGS_EXPORTER=otlp
+# The app exports spans and log records itself through bounded queues, see export_pipeline.py
+export OTEL_TRACES_EXPORTER=none
+export OTEL_LOGS_EXPORTER=none
+export WEATHER_TRACES_EXPORTER=otlp
+export WEATHER_LOGS_EXPORTER=otlp
 export OTEL_METRICS_EXPORTER=otlp
 
 export OTEL_PYTHON_LOGGING_AUTO_INSTRUMENTATION_ENABLED=true
@@ -0,0 +1,30 @@
+#!/usr/bin/env bash
+
+# Runs the weather service with WEATHER_WORKERS worker processes, see gunicorn.conf.py.
+#
+# opentelemetry-instrument would set up tracing in the gunicorn master before the workers are forked,
+# so it isn't used here. Every worker sets up its own providers and export threads instead, see telemetry.py.
+
+export WEATHER_WORKERS=${WEATHER_WORKERS:-$(nproc)}
+
+export OTEL_SERVICE_NAME=opentelemetry-example
+
+# Spans and log records are exported through bounded queues, see export_pipeline.py
+export WEATHER_TRACES_EXPORTER=otlp
+export WEATHER_LOGS_EXPORTER=otlp
+
+export OTEL_PYTHON_LOG_CORRELATION=true
+
+# Enable gzip compression.
+export OTEL_EXPORTER_OTLP_COMPRESSION=gzip
+# Prefer delta temporality.
+export OTEL_EXPORTER_OTLP_METRICS_TEMPORALITY_PREFERENCE=DELTA
+
+# Uptrace Login
+export OTEL_EXPORTER_OTLP_HEADERS="uptrace-dsn=http://SomeRandomToken@localhost:14318?grpc=14317"
+
+# Export endpoint, local Uptrace instance
+export OTEL_EXPORTER_OTLP_ENDPOINT=127.0.0.1:14317
+export OTEL_EXPORTER_OTLP_INSECURE=true
+
+gunicorn -c gunicorn.conf.py main:app
@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from opentelemetry import metrics, trace
+
+tracer = trace.get_tracer("open-telemetry.example.startup")
+
+# Creates a meter from the global meter provider
+meter = metrics.get_meter("my.meter.name")
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+phase_duration_histogram = meter.create_histogram(
+    "startup.phase.duration", unit="ms", description="Duration of the phases of the app's startup"
+)
+
+
+class StartupPhases:
+    # Times the phases of the lifespan startup, each one a child span of one `startup` span so a slow
+    # start shows up as one trace. Cache pre-warming runs after the server accepts requests, the
+    # readiness endpoint reports ready once finish() is called.
+
+    def __init__(self):
+        self.phases = {}
+        self.ready = False
+        self._span = None
+        self._started = None
+        self._started_ns = None
+        self._duration_ms = None
+
+    def begin(self):
+        self._started = time.perf_counter()
+        self._started_ns = time.time_ns()
+
+    @contextmanager
+    def phase(self, name):
+        if self._span is None or not self._span.is_recording():
+            # Without opentelemetry-instrument there is no tracer provider before the telemetry phase
+            # set it up, the startup span is started then and backdated to begin()
+            self._span = tracer.start_span("startup", start_time=self._started_ns)
+        start = time.perf_counter()
+        with tracer.start_as_current_span("startup." + name, context=trace.set_span_in_context(self._span)) as span:
+            try:
+                yield span
+            finally:
+                duration_ms = (time.perf_counter() - start) * 1000
+                self.phases[name] = round(duration_ms, 3)
+                phase_duration_histogram.record(duration_ms, {"phase": name})
+                logger.info('Startup phase %s took %.1f ms', name, duration_ms)
+
+    def finish(self):
+        self._duration_ms = (time.perf_counter() - self._started) * 1000
+        # Phases that ran before tracing was set up only show up here
+        self._span.set_attributes({"startup.%s_ms" % name: ms for name, ms in self.phases.items()})
+        self._span.set_attribute("startup.duration_ms", self._duration_ms)
+        self._span.end()
+        self.ready = True
+        logger.info('Ready after %.1f ms', self._duration_ms)
+
+    def report(self):
+        return {
+            'ready': self.ready,
+            'duration_ms': round(self._duration_ms, 3) if self._duration_ms is not None else None,
+            'phases_ms': self.phases,
+        }
+
+
+def save_snapshot(path, locations):
+    # `locations` are (latitude, longitude, estimated requests), most requested first. Written to a
+    # temporary file and renamed, so a worker starting at the same time never reads half a file.
+    if not path or not locations:
+        # Don't replace a good snapshot with the empty one of an app that served no traffic
+        return
+    snapshot = {
+        'saved_at': time.time(),
+        'locations': [
+            {'latitude': latitude, 'longitude': longitude, 'requests': requests}
+            for latitude, longitude, requests in locations
+        ],
+    }
+    temporary = '%s.%d.tmp' % (path, os.getpid())
+    with open(temporary, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(temporary, path)
+
+
+def load_snapshot(path, limit):
+    # The `limit` most requested (latitude, longitude) of the last snapshot, none without one
+    if not path or not limit:
+        return []
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+        return [(entry['latitude'], entry['longitude']) for entry in snapshot['locations'][:limit]]
+    except FileNotFoundError:
+        return []
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning('Ignoring unreadable access snapshot %s: %s', path, e)
+        return []
@@ -0,0 +1,146 @@
+import logging
+import os
+import socket
+
+from opentelemetry import _logs, metrics, trace
+from opentelemetry.exporter.otlp.proto.grpc._log_exporter import OTLPLogExporter
+from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
+from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+from opentelemetry.sdk._logs import LoggerProvider, LoggingHandler
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import ConsoleMetricExporter, PeriodicExportingMetricReader
+from opentelemetry.sdk.metrics.view import (
+    ExplicitBucketHistogramAggregation,
+    ExponentialBucketHistogramAggregation,
+    View,
+)
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+
+import config
+import export_pipeline
+import sampling
+
+# Everything here is set up in the "telemetry" phase of the app lifespan, in the process that serves the
+# requests. Under gunicorn (start_workers.sh) every worker gets its own providers, exporter threads and
+# connections. Instruments created on import through metrics.get_meter are proxies until then.
+
+
+def resource():
+    # Workers of one deployment share the service name and differ in the instance, so their metrics
+    # aren't added up as if they came from one process. worker.id stays the same when gunicorn replaces
+    # a worker, see gunicorn.conf.py.
+    return Resource.create({
+        "service.instance.id": "%s-%d" % (socket.gethostname(), os.getpid()),
+        "process.pid": os.getpid(),
+        "worker.id": config.WORKER_ID,
+    })
+
+
+def export_options():
+    return dict(
+        max_queue_size=config.EXPORT_QUEUE_SIZE,
+        max_batch_size=config.EXPORT_BATCH_SIZE,
+        schedule_delay_ms=config.EXPORT_SCHEDULE_DELAY_MS,
+        drop_policy=config.EXPORT_DROP_POLICY,
+        # An unreachable collector delays shutting down by one export timeout at most
+        shutdown_timeout_ms=config.EXPORT_TIMEOUT_MS,
+    )
+
+
+# The processors exporting spans and log records, see setup_tracing and setup_log_export
+span_processor = None
+log_processor = None
+
+
+def setup_tracing():
+    # opentelemetry-instrument already installs a TracerProvider, only create one when running without it
+    global span_processor
+    provider = trace.get_tracer_provider()
+    if not isinstance(provider, TracerProvider):
+        provider = TracerProvider(resource=resource())
+        trace.set_tracer_provider(provider)
+
+    # Both apps can run in one process, the export pipeline is only installed once. The launch scripts
+    # set OTEL_TRACES_EXPORTER=none, so opentelemetry-instrument doesn't export the spans a second time.
+    if span_processor is None and config.TRACES_EXPORTER == 'otlp':
+        span_processor = export_pipeline.BoundedSpanProcessor(
+            OTLPSpanExporter(timeout=config.EXPORT_TIMEOUT_MS / 1000), **export_options()
+        )
+        if config.TRACE_BUDGET_PER_SECOND > 0:
+            # Tail sampling decides which traces reach the export queue
+            sampling.processor = sampling.TailSamplingSpanProcessor(
+                span_processor,
+                # The budget is for the whole deployment, every worker keeps its share
+                traces_per_second=config.TRACE_BUDGET_PER_SECOND / config.WORKERS,
+                slow_span_ms=config.TRACE_SLOW_SPAN_MS,
+                slow_root_ms=config.TRACE_SLOW_ROOT_MS,
+                max_buffered_spans=config.TRACE_BUFFER_SPANS,
+            )
+            provider.add_span_processor(sampling.processor)
+        else:
+            provider.add_span_processor(span_processor)
+    return provider
+
+
+# The provider stage histograms are recorded with, see setup_metrics
+meter_provider = None
+
+
+def setup_metrics(readers=None):
+    # opentelemetry-instrument installs a MeterProvider that can't be given views anymore, so the stage
+    # histograms get a provider of their own with their buckets and attribute keys. Without
+    # opentelemetry-instrument it becomes the global provider and exports every other metric as well.
+    #
+    # Recording only updates the aggregation in memory. Collecting and exporting runs on the thread of
+    # the PeriodicExportingMetricReader, so a slow or unreachable collector never delays a request.
+    global meter_provider
+    if meter_provider is not None:
+        return meter_provider
+
+    if config.METRICS_HISTOGRAM == 'exponential':
+        aggregation = ExponentialBucketHistogramAggregation()
+    else:
+        aggregation = ExplicitBucketHistogramAggregation(config.STAGE_BUCKETS_MS)
+    views = [View(instrument_name="stage.duration", aggregation=aggregation, attribute_keys={"stage", "outcome"})]
+
+    if readers is None:
+        readers = []
+    if config.METRICS_EXPORTER != 'none' and not readers:
+        if config.METRICS_EXPORTER == 'console':
+            exporter = ConsoleMetricExporter()
+        else:
+            exporter = OTLPMetricExporter(timeout=config.EXPORT_TIMEOUT_MS / 1000)
+        readers.append(PeriodicExportingMetricReader(
+            export_pipeline.TimedMetricExporter(exporter),
+            export_interval_millis=config.METRICS_EXPORT_INTERVAL_MS,
+            export_timeout_millis=config.EXPORT_TIMEOUT_MS,
+        ))
+
+    meter_provider = MeterProvider(metric_readers=readers, views=views, resource=resource())
+    if not isinstance(metrics.get_meter_provider(), MeterProvider):
+        metrics.set_meter_provider(meter_provider)
+    return meter_provider
+
+
+def setup_log_export():
+    # Log records are exported through the export pipeline. opentelemetry-instrument installs a
+    # LoggerProvider and adds trace ids to the records, without it the same is set up here. Has to run
+    # before log_pipeline.setup_logging, which moves the handlers of the root logger behind its queue.
+    global log_processor
+    if log_processor is not None or config.LOGS_EXPORTER != 'otlp':
+        return
+    provider = _logs.get_logger_provider()
+    if not isinstance(provider, LoggerProvider):
+        provider = LoggerProvider(resource=resource())
+        _logs.set_logger_provider(provider)
+        logging.getLogger().addHandler(LoggingHandler(logger_provider=provider))
+
+        if os.environ.get('OTEL_PYTHON_LOG_CORRELATION', 'false').lower() == 'true':
+            from opentelemetry.instrumentation.logging import LoggingInstrumentor
+            LoggingInstrumentor().instrument(set_logging_format=True)
+
+    log_processor = export_pipeline.BoundedLogRecordProcessor(
+        OTLPLogExporter(timeout=config.EXPORT_TIMEOUT_MS / 1000), **export_options()
+    )
+    provider.add_log_record_processor(log_processor)